@@ -1,6 +1,26 @@
 from django.contrib import admin
 
-from .models import Contest, Submission
+from . import caching
+from .models import Contest, DiscordMessage, Submission, UserStats
+
+
+@admin.register(Contest)
+class ContestAdmin(admin.ModelAdmin):
+	actions = ["expire_cached_pages"]
+
+	@admin.action(description="Re-render the cached pages for the selected contests")
+	def expire_cached_pages(self, request, queryset):
+		""" Saving a contest (or its clues) already does this; this is for changes the signals can't see, like a
+		renamed user on a closed contest's page
+		"""
+		contest_ids = list(queryset.values_list("id", flat=True))
+		caching.bump_versions(
+			caching.version_key(caching.CONTEST_LISTS),
+			*(caching.version_key(caching.CONTEST, contest_id) for contest_id in contest_ids),
+		)
+		self.message_user(request, f"Expired the cached pages for {len(contest_ids)} contests")
+
 
-admin.site.register(Contest)
 admin.site.register(Submission)
+admin.site.register(UserStats)
+admin.site.register(DiscordMessage)
@@ -3,3 +3,8 @@ from django.apps import AppConfig
 
 class CrypticsConfig(AppConfig):
     name = 'apps.cryptics'
+
+    def ready(self):
+        # Imported for the side effect of registering the signal handlers (and adding the leaderboard
+        # methods to the User manager)
+        from . import leaderboard, query_log, signals  # pylint: disable=import-outside-toplevel,unused-import
@@ -0,0 +1,225 @@
+""" Version-keyed caching for pages and querysets that only change when contests, submissions, or likes do
+
+Each thing a page depends on (a contest, a user, the leaderboard as a whole, or the lists of
+contests on the main page) has a version counter in the cache, which the signal handlers in
+signals.py bump whenever it changes.  Cached values are stored under keys that include the
+versions they were built from, so bumping a counter orphans everything that depended on it
+without having to find and delete it (the backend evicts the old entries in time).  Only
+get_many, add, incr, get, and set are used, so this works with any backend, but the counters are
+only bumped in the process that handled the change, so the cache has to be shared between all the
+web and Celery workers (file-based, database, or memcached).  With the default per-process locmem
+backend, other workers would keep serving stale pages, so VIEW_CACHE_TIMEOUT defaults to 0 (off).
+
+Contests also change phase purely because time passes, which no signal reports, so anything
+that depends on phases is cached only until the next phase change (see
+ContestQuerySet.next_phase_change).
+"""
+import hashlib
+import math
+import time
+from functools import wraps
+
+from django.conf import settings
+from django.contrib import messages
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.utils import timezone
+from django.utils.cache import get_conditional_response, patch_vary_headers
+from django.utils.http import http_date, quote_etag
+
+from .metrics import count_cache_lookup
+
+CONTEST = "contest"
+USER = "user"
+LEADERBOARD = "leaderboard"
+# The lists of contests on the main page, which only change when a contest is added, edited, or declared
+CONTEST_LISTS = "contest_lists"
+
+
+def version_key(scope, obj_id=None):
+	""" The cache key of a version counter, e.g. version_key(CONTEST, 3) or version_key(LEADERBOARD) """
+	if obj_id is None:
+		return f"cryptics:version:{scope}"
+	return f"cryptics:version:{scope}:{obj_id}"
+
+
+def get_versions(*keys):
+	""" The current value of each of the given version counters, in the same order """
+	versions = cache.get_many(keys)
+	for key in keys:
+		if key not in versions:
+			# Start from the current time rather than 1, so that if the cache is ever cleared, values
+			# cached at the old versions can't be mistaken for current ones
+			cache.add(key, time.time_ns(), timeout=None)
+			cache.add(f"{key}:changed", time.time(), timeout=None)
+			versions[key] = cache.get(key)
+	return [versions[key] for key in keys]
+
+
+def get_version(key):
+	return get_versions(key)[0]
+
+
+def bump_version(key):
+	""" Increment a version counter, returning its new value """
+	cache.set(f"{key}:changed", time.time(), timeout=None)
+	try:
+		return cache.incr(key)
+	except ValueError:
+		get_version(key)
+		return cache.incr(key)
+
+
+def last_changed(*keys):
+	""" When any of the given version counters was last bumped (or created), as a Unix timestamp """
+	changed = cache.get_many([f"{key}:changed" for key in keys])
+	return max(changed.values(), default=None)
+
+
+def bump_versions(*keys):
+	for key in set(keys):
+		bump_version(key)
+
+
+def versioned_key(name, version_keys):
+	""" The cache key for the value called name, as built from the current versions of version_keys """
+	versions = ".".join(str(version) for version in get_versions(*version_keys))
+	return f"cryptics:cached:{hashlib.md5(f'{name}@{versions}'.encode()).hexdigest()}"
+
+
+def timeout_until(moment):
+	""" How long to cache something that might change at moment (or None if it only changes with its versions) """
+	timeout = settings.VIEW_CACHE_TIMEOUT
+	if moment is not None:
+		timeout = min(timeout, max(1, math.ceil((moment - timezone.now()).total_seconds())))
+	return timeout
+
+
+def cached(name, version_keys, compute, expires=None):
+	""" Return the cached value called name, calling compute() to build it if it isn't cached at the current versions
+
+	expires, if given, is called after compute() and returns when the value might change for
+	reasons other than its versions.  The value is stored with that time and not used from then
+	on, so (unlike the backend's whole-second timeouts) it can't outlive a phase change even briefly.
+	"""
+	if not settings.VIEW_CACHE_TIMEOUT:
+		return compute()
+
+	key = versioned_key(name, version_keys)
+	entry = cache.get(key)
+	hit = entry is not None and (entry[0] is None or timezone.now() < entry[0])
+	count_cache_lookup(name.split(":")[0], hit)
+	if hit:
+		return entry[1]
+
+	value = compute()
+	expires_at = expires() if expires else None
+	cache.set(key, (expires_at, value), timeout=timeout_until(expires_at))
+	return value
+
+
+def cached_forever(name, version_keys, compute):
+	""" Like cached, for values that never change on their own (such as a closed contest's clues)
+
+	These are kept until one of their versions is bumped, rather than for VIEW_CACHE_TIMEOUT.
+	"""
+	if not settings.VIEW_CACHE_TIMEOUT:
+		return compute()
+
+	key = versioned_key(name, version_keys)
+	value = cache.get(key)
+	count_cache_lookup(name.split(":")[0], value is not None)
+	if value is None:
+		value = compute()
+		cache.set(key, value, timeout=None)
+	return value
+
+
+def cache_anonymous_page(get_version_keys, expires=None):
+	""" Cache a view's rendered HTML for logged-out visitors, under the versions given by get_version_keys
+
+	get_version_keys and expires are called with the view's URL arguments.  Only plain GETs are
+	cached, and not if there are messages waiting to be shown or the page used a CSRF token, since
+	those are specific to the visitor.
+	"""
+	def decorator(view):
+		@wraps(view)
+		def wrapper(request, *args, **kwargs):
+			if (
+				not settings.VIEW_CACHE_TIMEOUT
+				or request.method != "GET"
+				or request.user.is_authenticated
+				or len(messages.get_messages(request))
+			):
+				return view(request, *args, **kwargs)
+
+			key = versioned_key(f"page:{request.get_full_path()}", get_version_keys(*args, **kwargs))
+			content = cache.get(key)
+			count_cache_lookup(f"page:{view.__name__}", content is not None)
+			if content is not None:
+				return HttpResponse(content)
+
+			response = view(request, *args, **kwargs)
+			if response.status_code == 200 and not request.META.get("CSRF_COOKIE_NEEDS_UPDATE"):
+				timeout = timeout_until(expires(*args, **kwargs) if expires else None)
+				cache.set(key, response.content, timeout=timeout)
+			return response
+		return wrapper
+	return decorator
+
+
+def conditional_page(get_version_keys, get_contests=None):
+	""" Answer If-None-Match and If-Modified-Since for a view with 304 Not Modified, without calling it
+
+	The ETag comes from the current versions of get_version_keys (called with the view's URL
+	arguments), who's viewing, and, if get_contests is given, the last phase change among the
+	contests it returns, since those change the page without bumping anything.  Last-Modified is
+	the latest of when those versions were bumped and that phase change, and is only sent to
+	anonymous viewers: unlike the ETag, it doesn't say who the page was for, so a client that only
+	sends If-Modified-Since could otherwise get a 304 for a page from before it logged in or out.
+	Responses vary on the session cookie for the same reason.  All of that comes from
+	the cache (the phase change is itself cached until the next one), so a repeat visit runs no
+	queries and never renders the template.  Like the rest of this module, it's off when
+	VIEW_CACHE_TIMEOUT is 0.
+	"""
+	def decorator(view):
+		@wraps(view)
+		def wrapper(request, *args, **kwargs):
+			if (
+				not settings.VIEW_CACHE_TIMEOUT
+				or request.method not in ("GET", "HEAD")
+				or len(messages.get_messages(request))
+			):
+				return view(request, *args, **kwargs)
+
+			version_keys = get_version_keys(*args, **kwargs)
+			versions = ".".join(str(version) for version in get_versions(*version_keys))
+			phase_change = None
+			if get_contests:
+				contests = get_contests(*args, **kwargs)
+				phase_change = cached(
+					f"last-phase-change:{view.__module__}.{view.__name__}:{args}:{sorted(kwargs.items())}",
+					version_keys,
+					contests.last_phase_change,
+					expires=contests.next_phase_change,
+				)
+			validator = f"{versions}:{request.user.id}:{phase_change}"
+			etag = quote_etag(hashlib.md5(validator.encode()).hexdigest())
+
+			last_modified = None
+			if not request.user.is_authenticated:
+				changes = [last_changed(*version_keys), phase_change.timestamp() if phase_change else None]
+				changes = [change for change in changes if change is not None]
+				last_modified = math.ceil(max(changes)) if changes else None
+
+			response = get_conditional_response(request, etag=etag, last_modified=last_modified)
+			if response is None:
+				response = view(request, *args, **kwargs)
+				if response.status_code == 200:
+					response.headers.setdefault("ETag", etag)
+					if last_modified is not None:
+						response.headers.setdefault("Last-Modified", http_date(last_modified))
+			patch_vary_headers(response, ["Cookie"])
+			return response
+		return wrapper
+	return decorator
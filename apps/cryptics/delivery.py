@@ -0,0 +1,131 @@
+""" Delivering the DiscordMessage outbox (see utils.to_discord): claiming due messages, posting them, and retrying
+
+These work on the DiscordMessage manager they're given, rather than importing the model, so that
+models.py can wrap them without a circular import.
+"""
+import datetime
+import logging
+from collections import defaultdict
+from http import HTTPStatus
+
+from django.utils import timezone
+import requests
+
+from .utils import combine_for_discord, get_retry_after, get_site_url, get_webhook_client, post_to_discord
+from .webhooks import CircuitOpenError
+
+logger = logging.getLogger(__name__)
+
+# How many times a message is tried before it's marked as failed
+MAX_ATTEMPTS = 8
+# How long a worker has to post the messages it's claimed before they can be claimed again
+LEASE_LENGTH = datetime.timedelta(minutes=5)
+
+
+def deliver_due(outbox, batch_size=50):
+	""" Post the oldest pending messages in outbox (DiscordMessage.objects) that are due, returning the number sent
+
+	Messages are claimed by pushing their next_attempt_at out by LEASE_LENGTH (stamped with this
+	call's own time, so two workers never claim the same message); if the worker dies mid-batch
+	the lease simply runs out and they're retried.  Failures are retried with exponential
+	backoff, and a 429 from Discord pauses everything still in the batch for as long as Discord
+	asks.
+
+	Messages that share a digest_key are posted together, joined into as few Discord messages
+	as the length limit allows, at the position of the oldest of them.
+
+	Each webhook's messages are posted in order, but different webhooks are posted to at the same
+	time (see WebhookClient.fan_out), so one slow or failing server doesn't hold up the others.
+	The worker threads only talk to Discord; the results are saved back here.
+	"""
+	pending, sent_status = outbox.model.PENDING, outbox.model.SENT
+	now = timezone.now()
+	due_ids = list(
+		outbox.filter(status=pending, next_attempt_at__lte=now).order_by("id").values_list("id", flat=True)[:batch_size]
+	)
+	if not due_ids:
+		return 0
+
+	lease = timezone.now() + LEASE_LENGTH
+	outbox.filter(id__in=due_ids, status=pending, next_attempt_at__lte=now).update(next_attempt_at=lease)
+	claimed = list(outbox.filter(status=pending, next_attempt_at=lease).order_by("id"))
+
+	lanes = defaultdict(list)
+	for target, content, messages in _combine_digests(claimed):
+		lanes[target].append((target, content, messages))
+
+	get_site_url()  # Warm the cache, so the worker threads don't need a database connection
+	sent = 0
+	for results in get_webhook_client().fan_out(_deliver_to_webhook, lanes.values()):
+		for messages, error, retry_at in results:
+			if retry_at:
+				outbox.filter(id__in=[message.id for message in messages]).update(next_attempt_at=retry_at)
+			elif error:
+				for message in messages:
+					record_failure(message, error)
+			else:
+				outbox.filter(id__in=[message.id for message in messages]).update(
+					status=sent_status, sent_at=timezone.now()
+				)
+				sent += len(messages)
+
+	return sent
+
+
+def record_failure(message, error):
+	""" Schedule a retry of message with exponential backoff, or give up after MAX_ATTEMPTS """
+	message.attempts += 1
+	message.last_error = error
+	if message.attempts >= MAX_ATTEMPTS:
+		logger.error("Giving up on Discord message %d: %s", message.id, error)
+		message.status = message.FAILED
+	else:
+		logger.warning("Discord message %d failed (attempt %d): %s", message.id, message.attempts, error)
+		message.next_attempt_at = timezone.now() + datetime.timedelta(seconds=min(2**message.attempts * 15, 3600))
+	message.save(update_fields=["attempts", "last_error", "status", "next_attempt_at"])
+
+
+def _combine_digests(messages):
+	""" Turn a list of messages into a list of (target, content, messages) tuples, one per Discord post """
+	groups = {}
+	for message in messages:
+		groups.setdefault((message.target, message.digest_key or message.id), []).append(message)
+
+	posts = []
+	for (target, _), group in groups.items():
+		start = 0
+		for content, count in combine_for_discord([message.content for message in group]):
+			posts.append((target, content, group[start:start + count]))
+			start += count
+	return posts
+
+
+def _deliver_to_webhook(posts):
+	""" Post one webhook's (target, content, messages) posts in order, in a worker thread
+
+	Returns a (messages, error, retry_at) result for each post, for deliver_due to save.  A 429, or
+	the circuit breaker refusing to call a failing webhook, puts off everything that's left.
+	"""
+	results = []
+	for i, (target, content, messages) in enumerate(posts):
+		try:
+			response = post_to_discord(content, target=target)
+		except CircuitOpenError as err:
+			retry_at = err.retry_at
+		except requests.RequestException as err:
+			results.append((messages, repr(err), None))
+			continue
+		else:
+			if response is None or response.ok:
+				results.append((messages, None, None))
+				continue
+			if response.status_code != HTTPStatus.TOO_MANY_REQUESTS:
+				results.append((messages, f"HTTP {response.status_code}: {response.text[:500]}", None))
+				continue
+			retry_at = timezone.now() + datetime.timedelta(seconds=get_retry_after(response))
+			logger.warning("Rate limited by Discord webhook %s until %s", target, retry_at)
+
+		results.extend((rest, None, retry_at) for _, _, rest in posts[i:])
+		break
+
+	return results
@@ -1,8 +1,11 @@
+import datetime
+
 from django import forms
 from django.core.exceptions import ValidationError
 from django.template.defaultfilters import pluralize
 
 from .models import Contest, Submission
+from .utils import decode_cursor
 
 
 class ContestForm(forms.ModelForm):
@@ -23,7 +26,7 @@ class ContestForm(forms.ModelForm):
     def clean_started_by(self):
         """ Make sure a user only has a single open contest at a time """
         started_by = self.cleaned_data["started_by"]
-        if started_by.contests_started.filter(status=Contest.SUBMISSIONS).exists():
+        if started_by.contests_started.with_effective_status(Contest.SUBMISSIONS).exists():
             raise ValidationError("Each user can only have one active contest at a time.", code="already_open_contest")
         return started_by
 
@@ -68,7 +71,6 @@ class SubmissionForm(forms.ModelForm):
 
     def clean_contest(self):
         contest = self.cleaned_data["contest"]
-        contest.check_if_too_old()
         if not contest.is_submissions:
             raise ValidationError("Sorry, this contest has closed.")
         return contest
@@ -88,3 +90,51 @@ class ContestSearchForm(forms.Form):
     different sort orders or pagination)
     """
     search = forms.CharField()
+
+
+class ClueSearchForm(forms.Form):
+    """ Form for the GET params of the clue search page (and its JSON endpoint) """
+    q = forms.CharField(label="Search clues", widget=forms.TextInput(attrs={"size": 40}))
+    author = forms.CharField(required=False, label="By (username)")
+    status = forms.ChoiceField(
+        required=False,
+        choices=[("", "Any contest")] + [(value, f"{label.title()} contests") for value, label in Contest.STATUS_CHOICES],
+    )
+
+
+class WordplayForm(forms.Form):
+    """ Form for the GET params of the wordplay helper """
+    pattern = forms.RegexField(
+        r"^[A-Za-z?._]+$",
+        required=False,
+        error_messages={"invalid": "Use letters, with ? (or . or _) for unknown letters."},
+    )
+
+
+class ArchivePageForm(forms.Form):
+    """ Form for the GET params of the archive page (and its JSON endpoint) """
+    after = forms.CharField(required=False)
+
+    def clean_after(self):
+        """ Turn the cursor into the (created_at, id) key that Contest.objects.page_after takes """
+        if not self.cleaned_data["after"]:
+            return None
+        try:
+            return decode_cursor(self.cleaned_data["after"], (datetime.datetime, int))
+        except ValueError as e:
+            raise ValidationError("Invalid page.") from e
+
+
+class UserPageForm(forms.Form):
+    """ Form for the GET params of the user page """
+    after = forms.CharField(required=False)
+    highlight = forms.IntegerField(required=False)
+
+    def clean_after(self):
+        """ Turn the cursor into the (like_count, created_at, id) key that Submission.objects.page_by_likes takes """
+        if not self.cleaned_data["after"]:
+            return None
+        try:
+            return decode_cursor(self.cleaned_data["after"], (int, datetime.datetime, int))
+        except ValueError as e:
+            raise ValidationError("Invalid page.") from e
@@ -0,0 +1,83 @@
+""" Compare the indexed contest search against a plain icontains scan on a large synthetic archive """
+import random
+import statistics
+import string
+import time
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from apps.cryptics.models import Contest, ContestTrigram
+from apps.cryptics.utils import normalize_word
+
+
+class Rollback(Exception):
+	""" Raised to throw away the synthetic contests once the benchmark is done """
+
+
+class Command(BaseCommand):
+	help = (
+		"Time contest searches against a synthetic archive, using both the trigram index and the old icontains "
+		"query.  Everything is created inside a transaction that's rolled back at the end."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument("--contests", type=int, default=100_000, help="Number of contests to create")
+		parser.add_argument("--searches", type=int, default=200, help="Number of searches to time")
+
+	def handle(self, *args, **kwargs):
+		try:
+			with transaction.atomic():
+				self.run(kwargs["contests"], kwargs["searches"])
+				raise Rollback
+		except Rollback:
+			pass
+
+	def run(self, n_contests, n_searches):
+		rng = random.Random(0)
+		user = User.objects.create(username="benchmark_contest_search")
+
+		def random_word():
+			words = ["".join(rng.choices(string.ascii_uppercase, k=rng.randint(3, 9))) for _ in range(rng.randint(1, 3))]
+			return f"{' '.join(words)} ({','.join(str(len(word)) for word in words)})"
+
+		self.stdout.write(f"Creating {n_contests} contests...")
+		contests = Contest.objects.bulk_create(
+			[Contest(word=random_word(), started_by=user) for _ in range(n_contests)], batch_size=1000
+		)
+		for contest in contests:
+			contest.search_word = normalize_word(contest.word)
+		Contest.objects.bulk_update(contests, ["search_word"], batch_size=1000)
+		for start in range(0, len(contests), 1000):
+			ContestTrigram.objects.index(contests[start:start + 1000])
+
+		# Search for pieces of real words, as check_for_repeats.js would
+		searches = []
+		for contest in rng.sample(contests, n_searches):
+			length = rng.randint(3, len(contest.search_word))
+			start = rng.randint(0, len(contest.search_word) - length)
+			searches.append(contest.search_word[start:start + length])
+
+		def old_search(text):
+			contests = Contest.objects.filter(word__icontains=text).order_by("created_at")
+			if contests.count() < 10:
+				list(contests)
+
+		def new_search(text):
+			list(Contest.objects.search(text).only("word")[:10])
+
+		timings = {}
+		for name, search in (("icontains", old_search), ("trigram index", new_search)):
+			times = []
+			for text in searches:
+				start = time.perf_counter()
+				search(text)
+				times.append((time.perf_counter() - start) * 1000)
+			times.sort()
+			timings[name] = statistics.median(times)
+			self.stdout.write(
+				f"{name:>14}: median {timings[name]:.2f} ms, 95th percentile {times[int(len(times) * 0.95)]:.2f} ms"
+			)
+
+		self.stdout.write(self.style.SUCCESS(f"Speed-up: {timings['icontains'] / timings['trigram index']:.1f}x"))
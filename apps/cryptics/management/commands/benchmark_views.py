@@ -0,0 +1,159 @@
+""" Time the site's main pages through the test client, and save the results to compare between releases """
+import json
+import platform
+import statistics
+import time
+
+import django
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from django.db.models import Count
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+
+from apps.cryptics.models import Contest, Submission, UserStats
+
+# How much slower (as a ratio of median times) a page has to get before --compare calls it a regression
+REGRESSION_THRESHOLD = 1.2
+
+
+class Command(BaseCommand):
+	help = (
+		"Request the main page, a contest in each phase, the busiest user's page, the user list, the archives, and "
+		"the contest search a number of times each, and report the median and 95th percentile times and the "
+		"number of queries.  Run generate_sample_data first to have something realistic to measure."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument("--requests", type=int, default=50, help="Number of timed requests per page")
+		parser.add_argument("--warmup", type=int, default=3, help="Number of untimed requests per page first")
+		parser.add_argument("--user", help="Username to log in as (default: request the pages anonymously)")
+		parser.add_argument(
+			"--no-cache", action="store_true", help="Turn off the view cache, to time the pages being built"
+		)
+		parser.add_argument("--output", help="Write the results to this file as JSON")
+		parser.add_argument("--compare", help="Compare against the results in this JSON file from an earlier run")
+
+	def handle(self, *args, **kwargs):
+		client = Client()
+		if kwargs["user"]:
+			try:
+				client.force_login(User.objects.get(username=kwargs["user"]))
+			except User.DoesNotExist as err:
+				raise CommandError(f"No user called {kwargs['user']}") from err
+
+		overrides = {"ALLOWED_HOSTS": [*settings.ALLOWED_HOSTS, "testserver"]}
+		if kwargs["no_cache"]:
+			overrides["VIEW_CACHE_TIMEOUT"] = 0
+
+		results = []
+		with override_settings(**overrides):
+			for name, url in self.pages():
+				result = self.time_page(client, name, url, kwargs["requests"], kwargs["warmup"])
+				results.append(result)
+				self.stdout.write(
+					f"{name:>32}: median {result['p50_ms']:8.2f} ms, 95th percentile {result['p95_ms']:8.2f} ms, "
+					f"{result['queries']:3} queries"
+				)
+
+		report = {
+			"created_at": timezone.now().isoformat(),
+			"environment": {
+				"python": platform.python_version(),
+				"django": django.get_version(),
+				"database": connection.vendor,
+				"cache": settings.CACHES["default"]["BACKEND"],
+			},
+			"options": {
+				"requests": kwargs["requests"],
+				"warmup": kwargs["warmup"],
+				"logged_in": bool(kwargs["user"]),
+				"view_cache": not kwargs["no_cache"] and bool(settings.VIEW_CACHE_TIMEOUT),
+			},
+			"data": {
+				"users": User.objects.count(),
+				"contests": Contest.objects.count(),
+				"submissions": Submission.objects.count(),
+				"likes": Submission.likers.through.objects.count(),
+			},
+			"pages": results,
+		}
+		if kwargs["output"]:
+			with open(kwargs["output"], "w", encoding="utf-8") as f:
+				json.dump(report, f, indent=2)
+			self.stdout.write(f"Wrote results to {kwargs['output']}")
+		if kwargs["compare"]:
+			self.compare(kwargs["compare"], results)
+
+	def pages(self):
+		""" The (name, URL) of each page to time, skipping any there's no data for """
+		yield "index", reverse("cryptics:index")
+
+		for status, label in Contest.STATUS_CHOICES:
+			contest = Contest.objects.with_effective_status(status).annotate(
+				submission_count=Count("submissions")
+			).order_by("-submission_count", "-created_at").first()
+			if contest is None:
+				self.stderr.write(f"No contests in {label}, so that page is skipped")
+				continue
+			yield f"show_contest_full ({label})", contest.get_absolute_url()
+
+		busiest = UserStats.objects.order_by("-total_submissions").values_list("user_id", flat=True).first()
+		if busiest is not None:
+			yield "show_user", reverse("cryptics:show_user", kwargs={"user_id": busiest})
+
+		yield "all_users", reverse("cryptics:all_users")
+		yield "all_closed_contests", reverse("cryptics:all_closed_contests")
+
+		# Search for a whole contest word, as check_for_repeats.js does once a setter has typed it out
+		word = Contest.objects.order_by("-created_at").values_list("search_word", flat=True).first()
+		if word:
+			yield "contest_search_json", f"{reverse('cryptics:contest_search')}?search={word}"
+
+	@staticmethod
+	def time_page(client, name, url, n_requests, n_warmup):
+		for _ in range(n_warmup):
+			client.get(url)
+
+		times = []
+		queries = []
+		for _ in range(n_requests):
+			with CaptureQueriesContext(connection) as captured:
+				start = time.perf_counter()
+				response = client.get(url)
+				times.append((time.perf_counter() - start) * 1000)
+			queries.append(len(captured))
+
+		return {
+			"name": name,
+			"url": url,
+			"status": response.status_code,
+			"p50_ms": statistics.median(times),
+			"p95_ms": statistics.quantiles(times, n=20)[-1] if len(times) > 1 else times[0],
+			"mean_ms": statistics.fmean(times),
+			"queries": max(queries),
+		}
+
+	def compare(self, path, results):
+		""" Print how each page's median time and queries changed since the run saved in path """
+		with open(path, encoding="utf-8") as f:
+			before = {page["name"]: page for page in json.load(f)["pages"]}
+
+		self.stdout.write(f"Compared with {path}:")
+		for result in results:
+			old = before.get(result["name"])
+			if old is None:
+				continue
+			ratio = result["p50_ms"] / old["p50_ms"] if old["p50_ms"] else 1
+			line = (
+				f"{result['name']:>32}: median {old['p50_ms']:8.2f} -> {result['p50_ms']:8.2f} ms ({ratio:.2f}x), "
+				f"queries {old['queries']} -> {result['queries']}"
+			)
+			if ratio > REGRESSION_THRESHOLD or result["queries"] > old["queries"]:
+				self.stdout.write(self.style.WARNING(line))
+			else:
+				self.stdout.write(line)
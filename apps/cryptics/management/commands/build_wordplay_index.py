@@ -0,0 +1,20 @@
+""" Build the index used by the anagram and letter-pattern helper """
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from apps.cryptics.wordplay import rebuild_wordplay_index
+
+
+class Command(BaseCommand):
+	help = (
+		"Build the anagram and letter-pattern index from a word list (one word or phrase per line) plus every "
+		"contest's word, and write it to WORDPLAY_INDEX_PATH.  Running web workers pick up the new file on their "
+		"next lookup."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument("--word-list", help="Word list to use instead of WORDPLAY_WORD_LIST")
+
+	def handle(self, *args, **kwargs):
+		words = rebuild_wordplay_index(kwargs["word_list"])
+		self.stdout.write(self.style.SUCCESS(f"Indexed {words} words in {settings.WORDPLAY_INDEX_PATH}"))
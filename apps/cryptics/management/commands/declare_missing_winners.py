@@ -0,0 +1,19 @@
+""" Declare winners for closed contests that don't have one """
+from django.core.management.base import BaseCommand
+
+from apps.cryptics.models import Contest
+
+
+class Command(BaseCommand):
+	help = "Declare winners for every closed contest that has submissions but no winner (e.g. after a data repair)"
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--announce", action="store_true", help="Post the winners to Discord (off by default for backfills)"
+		)
+
+	def handle(self, *args, **kwargs):
+		declared = Contest.objects.filter(status=Contest.CLOSED).declare_winners(announce=kwargs["announce"])
+		for contest in declared:
+			self.stdout.write(f"{contest.word}: {contest.winning_entry.clue}")
+		self.stdout.write(self.style.SUCCESS(f"Declared winners for {len(declared)} contests"))
@@ -0,0 +1,186 @@
+""" Fill the database with a realistic synthetic archive of users, contests, clues, and likes, for profiling """
+import datetime
+import random
+import string
+
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.utils import timezone
+
+from apps.cryptics import caching
+from apps.cryptics.models import (
+	SUBMISSIONS_LENGTH, VOTING_LENGTH, Contest, ContestTrigram, Submission, SubmissionTerm, UserStats,
+)
+from apps.cryptics.utils import normalize_word
+from apps.cryptics.word_index import contest_word_index
+
+Like = Submission.likers.through
+
+# How often a contest is started; with the phase lengths, this keeps a few contests open and a few
+# in voting at any time, as on the real site
+CONTEST_INTERVAL = SUBMISSIONS_LENGTH / 3
+
+
+class Command(BaseCommand):
+	help = (
+		"Create synthetic users, contests, clues, and likes with bulk_create, for profiling the site at a given "
+		"scale.  Setters and likes follow Zipf-like distributions (a few prolific users, a few popular clues), "
+		"contests are spread back in time so that every phase is represented, and winners, like counts, search "
+		"indexes, and user stats are filled in as if everything had been created through the site."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument("--users", type=int, default=200, help="Number of users to create")
+		parser.add_argument("--contests", type=int, default=500, help="Number of contests to create")
+		parser.add_argument("--clues-per-contest", type=int, default=20, help="Average number of clues per contest")
+		parser.add_argument("--likes-per-clue", type=float, default=2.0, help="Average number of likes per clue")
+		parser.add_argument(
+			"--skew", type=float, default=1.0,
+			help="Zipf exponent for how activity is spread over users and likes over clues (0 for uniform)",
+		)
+		parser.add_argument("--seed", type=int, default=0, help="Random seed, so runs are repeatable")
+		parser.add_argument("--prefix", default="sample", help="Prefix for the created users' names")
+
+	def handle(self, *args, **kwargs):
+		rng = random.Random(kwargs["seed"])
+		with transaction.atomic():
+			users = self.create_users(kwargs["users"], kwargs["prefix"])
+			setter_weights = _zipf_weights(len(users), kwargs["skew"])
+			rng.shuffle(users)
+
+			contests = self.create_contests(rng, kwargs["contests"], users, setter_weights)
+			submissions, likes = self.create_submissions(
+				rng, contests, users, setter_weights,
+				kwargs["clues_per_contest"], kwargs["likes_per_clue"], kwargs["skew"],
+			)
+
+			self.stdout.write("Indexing and declaring winners...")
+			for start in range(0, len(contests), 1000):
+				ContestTrigram.objects.index(contests[start:start + 1000])
+			for start in range(0, len(submissions), 1000):
+				SubmissionTerm.objects.index(submissions[start:start + 1000])
+			declared = Contest.objects.filter(
+				id__in=[contest.id for contest in contests], status=Contest.CLOSED
+			).declare_winners(announce=False)
+			UserStats.objects.rebuild([user.id for user in users])
+
+			# bulk_create doesn't send the signals that normally keep these up to date
+			transaction.on_commit(contest_word_index.invalidate)
+			transaction.on_commit(lambda: caching.bump_versions(
+				caching.version_key(caching.LEADERBOARD), caching.version_key(caching.CONTEST_LISTS)
+			))
+
+		self.stdout.write(self.style.SUCCESS(
+			f"Created {len(users)} users, {len(contests)} contests ({len(declared)} with winners), "
+			f"{len(submissions)} clues, and {likes} likes"
+		))
+
+	def create_users(self, n_users, prefix):
+		self.stdout.write(f"Creating {n_users} users...")
+		start = User.objects.filter(username__startswith=f"{prefix}_").count()
+		password = make_password(None)
+		users = User.objects.bulk_create(
+			[User(username=f"{prefix}_{start + i}", password=password) for i in range(n_users)], batch_size=1000
+		)
+		# SQLite and PostgreSQL set the new ids on the objects; other databases need them looked up
+		if users and users[0].id is None:
+			users = list(User.objects.filter(username__in=[user.username for user in users]))
+		return users
+
+	def create_contests(self, rng, n_contests, users, setter_weights):
+		self.stdout.write(f"Creating {n_contests} contests...")
+		now = timezone.now()
+		contests = []
+		for i in range(n_contests):
+			created_at = now - CONTEST_INTERVAL * (n_contests - i - 1) - CONTEST_INTERVAL / 2
+			age = now - created_at
+			if age > SUBMISSIONS_LENGTH + VOTING_LENGTH:
+				status = Contest.CLOSED
+			elif age > SUBMISSIONS_LENGTH:
+				status = Contest.VOTING
+			else:
+				status = Contest.SUBMISSIONS
+			word = _random_phrase(rng)
+			contests.append(Contest(
+				word=word,
+				search_word=normalize_word(word),
+				started_by=rng.choices(users, setter_weights)[0],
+				status=status,
+				created_at=created_at,
+			))
+
+		return self._bulk_create_backdated(Contest, contests)
+
+	def create_submissions(self, rng, contests, users, setter_weights, clues_per_contest, likes_per_clue, skew):
+		self.stdout.write(f"Creating about {len(contests) * clues_per_contest} clues...")
+		now = timezone.now()
+		submissions = []
+		likers = []
+		for contest in contests:
+			n_clues = max(0, round(rng.gauss(clues_per_contest, clues_per_contest / 3)))
+			setters = rng.choices(users, setter_weights, k=n_clues)
+			# Contests still taking submissions only have clues from so far
+			window = min(SUBMISSIONS_LENGTH, now - contest.created_at).total_seconds()
+			times = sorted(rng.uniform(0, window) for _ in range(n_clues))
+
+			# Likes go mostly to a few clues; which ones is random, not the order they were submitted in
+			popularity = _zipf_weights(n_clues, skew)
+			rng.shuffle(popularity)
+			liked = [set() for _ in range(n_clues)]
+			if n_clues and contest.status != Contest.SUBMISSIONS:
+				for clue_index in rng.choices(range(n_clues), popularity, k=round(n_clues * likes_per_clue)):
+					liker = rng.choices(users, setter_weights)[0]
+					if liker != setters[clue_index]:
+						liked[clue_index].add(liker.id)
+
+			for setter, seconds, clue_likers in zip(setters, times, liked):
+				submissions.append(Submission(
+					clue=f"{_random_phrase(rng, enumeration=False).capitalize()} {contest.word[contest.word.index('('):]}",
+					explanation=_random_phrase(rng, enumeration=False),
+					contest=contest,
+					submitted_by=setter,
+					like_count=len(clue_likers),
+					created_at=contest.created_at + datetime.timedelta(seconds=seconds),
+				))
+				likers.append(clue_likers)
+
+		submissions = self._bulk_create_backdated(Submission, submissions)
+
+		self.stdout.write("Creating likes...")
+		likes = [
+			Like(submission_id=submission.id, user_id=user_id)
+			for submission, clue_likers in zip(submissions, likers)
+			for user_id in clue_likers
+		]
+		Like.objects.bulk_create(likes, batch_size=5000)
+		return submissions, len(likes)
+
+	@staticmethod
+	def _bulk_create_backdated(model, objects):
+		""" bulk_create objects, then put back the created_at they had (which auto_now_add overwrites) """
+		created_at = [obj.created_at for obj in objects]
+		objects = model.objects.bulk_create(objects, batch_size=1000)
+		for obj, when in zip(objects, created_at):
+			obj.created_at = when
+		model.objects.bulk_update(objects, ["created_at"], batch_size=1000)
+		return objects
+
+
+def _zipf_weights(n, skew):
+	""" Weights for n choices where the k-th is picked in proportion to 1 / k ** skew """
+	return [1 / (k + 1) ** skew for k in range(n)]
+
+
+def _random_phrase(rng, enumeration=True):
+	""" A phrase of one to three made-up words, like "BANTOR KEL (6,3)" (or "bantor kel" without the enumeration) """
+	words = []
+	for _ in range(rng.choices([1, 2, 3], [6, 3, 1])[0]):
+		length = rng.randint(3, 9)
+		words.append("".join(
+			rng.choice("BCDFGHKLMNPRSTVW") if i % 2 == 0 else rng.choice("AEIOU") for i in range(length - 1)
+		) + rng.choice(string.ascii_uppercase))
+	if not enumeration:
+		return " ".join(words).lower()
+	return f"{' '.join(words)} ({','.join(str(len(word)) for word in words)})"
@@ -0,0 +1,45 @@
+""" Add up the request profiles written by ProfilingMiddleware and list the slowest functions """
+import os
+import pstats
+from io import StringIO
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.cryptics.profiling import profile_files
+
+
+class Command(BaseCommand):
+	help = (
+		"Combine the .pstats files in PROFILE_DIR (written by ProfilingMiddleware when PROFILE_SAMPLE_RATE or "
+		"PROFILE_HEADER is set) and print the functions that took the most time across all of them."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument("--dir", help="Directory to read the profiles from (default: PROFILE_DIR)")
+		parser.add_argument("--top", type=int, default=25, help="Number of functions to list")
+		parser.add_argument(
+			"--sort", choices=["cumulative", "tottime", "ncalls"], default="cumulative",
+			help="Sort by time including (cumulative) or excluding (tottime) the functions each one calls",
+		)
+		parser.add_argument("--view", help="Only include requests to this view (e.g. cryptics:show_user)")
+		parser.add_argument("--full-paths", action="store_true", help="Don't shorten file names")
+
+	def handle(self, *args, **kwargs):
+		files = profile_files(kwargs["dir"])
+		if kwargs["view"]:
+			view = kwargs["view"].replace(":", ".")
+			files = [path for path in files if os.path.basename(path).split("-")[1] == view]
+		if not files:
+			raise CommandError(f"No profiles found in {kwargs['dir'] or settings.PROFILE_DIR}")
+
+		# pstats prints a piece at a time, which self.stdout would put on separate lines
+		report = StringIO()
+		stats = pstats.Stats(*files, stream=report)
+		stats.files = []  # Otherwise every file's name is listed first
+		if not kwargs["full_paths"]:
+			stats.strip_dirs()
+		stats.sort_stats(kwargs["sort"]).print_stats(kwargs["top"])
+
+		self.stdout.write(f"{len(files)} requests, {stats.total_tt * 1000:.1f} ms in total")  # pylint: disable=no-member
+		self.stdout.write(report.getvalue())
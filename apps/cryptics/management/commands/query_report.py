@@ -0,0 +1,70 @@
+""" Add up the query logs written by each process and list the queries that took the most time """
+import os
+import shutil
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from apps.cryptics.query_log import collect
+
+
+class Command(BaseCommand):
+	help = (
+		"Combine the query logs in QUERY_LOG_DIR (written by every process when it's set) and print the queries "
+		"that took the most time, by fingerprint, with the views, tasks, and lines of code that ran them."
+	)
+
+	def add_arguments(self, parser):
+		parser.add_argument("--dir", help="Directory to read the logs from (default: QUERY_LOG_DIR)")
+		parser.add_argument("--top", type=int, default=20, help="Number of queries to list")
+		parser.add_argument(
+			"--sort", choices=["total", "count", "mean", "max"], default="total",
+			help="Sort by total time, number of calls, mean time, or longest time",
+		)
+		parser.add_argument("--sources", type=int, default=3, help="Number of callers to list for each query")
+		parser.add_argument("--view", help="Only include queries run by this view or task (e.g. cryptics:show_user)")
+		parser.add_argument("--full-sql", action="store_true", help="Don't shorten long queries")
+		parser.add_argument("--clear", action="store_true", help="Delete the logs (after reporting on them)")
+
+	def handle(self, *args, **kwargs):
+		directory = kwargs["dir"] or settings.QUERY_LOG_DIR
+		if not directory or not os.path.isdir(directory):
+			raise CommandError(f"No query logs found in {directory}")
+		fingerprints = collect(directory)
+		if not fingerprints:
+			raise CommandError(f"No query logs found in {directory}")
+
+		if kwargs["view"]:
+			fingerprints = {
+				sql: stats for sql, stats in fingerprints.items()
+				if any(source.split(" ")[0] in (kwargs["view"], f"task:{kwargs['view']}") for source in stats["sources"])
+			}
+
+		def sort_key(stats):
+			if kwargs["sort"] == "mean":
+				return stats["total"] / stats["count"]
+			return stats[kwargs["sort"]]
+
+		worst = sorted(fingerprints.items(), key=lambda item: sort_key(item[1]), reverse=True)[:kwargs["top"]]
+		total_time = sum(stats["total"] for stats in fingerprints.values())
+		total_count = sum(stats["count"] for stats in fingerprints.values())
+		self.stdout.write(
+			f"{total_count} queries ({len(fingerprints)} distinct), {total_time * 1000:.1f} ms in total"
+		)
+
+		for sql, stats in worst:
+			if not kwargs["full_sql"] and len(sql) > 200:
+				sql = sql[:200] + "..."
+			self.stdout.write("")
+			self.stdout.write(
+				f"{stats['count']} calls, {stats['total'] * 1000:.1f} ms total, "
+				f"{stats['total'] / stats['count'] * 1000:.2f} ms mean, {stats['max'] * 1000:.1f} ms max"
+			)
+			self.stdout.write(f"  {sql}")
+			sources = sorted(stats["sources"].items(), key=lambda item: item[1], reverse=True)
+			for source, count in sources[:kwargs["sources"]]:
+				self.stdout.write(f"    {count:>8}  {source}")
+
+		if kwargs["clear"]:
+			# Running processes will write their files again, with everything they've counted since they started
+			shutil.rmtree(directory)
@@ -0,0 +1,13 @@
+""" Recompute the contest word and clue search indexes from scratch """
+from django.core.management.base import BaseCommand
+
+from apps.cryptics.models import ContestTrigram, SubmissionTerm
+
+
+class Command(BaseCommand):
+	help = "Rebuild the indexes used to search contest words and clues (e.g. after changing how text is normalized)"
+
+	def handle(self, *args, **kwargs):
+		contests = ContestTrigram.objects.rebuild()
+		submissions = SubmissionTerm.objects.rebuild()
+		self.stdout.write(self.style.SUCCESS(f"Indexed {contests} contests and {submissions} submissions"))
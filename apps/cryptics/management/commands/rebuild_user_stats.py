@@ -0,0 +1,17 @@
+""" Recompute the denormalized UserStats table from scratch """
+from django.core.management.base import BaseCommand
+
+from apps.cryptics.models import UserStats
+
+
+class Command(BaseCommand):
+	help = "Rebuild the per-user stats used by the leaderboard"
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"user_ids", nargs="*", type=int, help="Only rebuild stats for these users (default: everyone)"
+		)
+
+	def handle(self, *args, **kwargs):
+		count = UserStats.objects.rebuild(kwargs["user_ids"] or None)
+		self.stdout.write(self.style.SUCCESS(f"Rebuilt stats for {count} users"))
@@ -0,0 +1,48 @@
+""" Find and fix submissions whose stored like_count doesn't match their likers """
+from functools import partial
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Count, F
+
+from apps.cryptics import caching
+from apps.cryptics.models import Submission
+
+
+class Command(BaseCommand):
+	help = "Compare Submission.like_count against the likers table and fix any drift"
+
+	def add_arguments(self, parser):
+		parser.add_argument(
+			"--dry-run", action="store_true", help="Report drifted submissions without changing them"
+		)
+
+	def handle(self, *args, **kwargs):
+		drifted = list(
+			Submission.objects.annotate(
+				actual_like_count=Count("likers")
+			).exclude(
+				like_count=F("actual_like_count")
+			).only("id", "like_count", "contest_id", "submitted_by_id")
+		)
+
+		for submission in drifted:
+			self.stdout.write(
+				f"Submission {submission.id}: stored {submission.like_count}, "
+				f"actual {submission.actual_like_count}"
+			)
+			submission.like_count = submission.actual_like_count
+
+		if drifted and not kwargs["dry_run"]:
+			with transaction.atomic():
+				Submission.objects.bulk_update(drifted, ["like_count"], batch_size=500)
+				# bulk_update doesn't send post_save, so the cached pages showing the counts are expired here
+				transaction.on_commit(partial(
+					caching.bump_versions,
+					caching.version_key(caching.LEADERBOARD),
+					*{caching.version_key(caching.CONTEST, submission.contest_id) for submission in drifted},
+					*{caching.version_key(caching.USER, submission.submitted_by_id) for submission in drifted},
+				))
+
+		verb = "Found" if kwargs["dry_run"] else "Fixed"
+		self.stdout.write(self.style.SUCCESS(f"{verb} {len(drifted)} submissions with drifted like counts"))
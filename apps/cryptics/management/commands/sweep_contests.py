@@ -0,0 +1,16 @@
+""" Move any contests that are past a phase boundary on to their next phase """
+from django.core.management.base import BaseCommand
+
+from apps.cryptics.models import Contest
+
+
+class Command(BaseCommand):
+	help = "Switch contests to voting or close them if enough time has passed (normally done by Celery beat)"
+
+	def handle(self, *args, **kwargs):
+		switched, closed = Contest.objects.sweep()
+		for contest in switched:
+			self.stdout.write(f"Switched {contest.word} to voting")
+		for contest in closed:
+			self.stdout.write(f"Closed {contest.word}")
+		self.stdout.write(self.style.SUCCESS("Finished!"))
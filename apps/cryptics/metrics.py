@@ -0,0 +1,271 @@
+""" Request, query, cache, Discord, and Celery task metrics, served in Prometheus' text format at /metrics
+
+Every process (each gunicorn worker and Celery worker) counts into its own in-memory registry and
+every few seconds writes it to a file of its own in METRICS_DIR, so nothing is shared between
+processes while counting.  The metrics view adds all of the files up.  When a process has exited
+(a worker was restarted, say), its file is folded into a single archive file the next time the
+metrics are read, so the totals never go backwards and the directory doesn't fill up with them.
+
+Everything is off (and the middleware unloaded) if METRICS_DIR isn't set.
+"""
+import contextlib
+import fcntl
+import json
+import os
+import socket
+import tempfile
+import threading
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+SECONDS_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 8, 13, 20, 50, 100)
+TASK_SECONDS_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300)
+
+# Every metric, as name: (type, help, histogram buckets)
+METRICS = {
+	"cryptics_request_duration_seconds": ("histogram", "Time taken to respond to requests, by view", SECONDS_BUCKETS),
+	"cryptics_request_queries": ("histogram", "Number of SQL queries run per request, by view", QUERY_COUNT_BUCKETS),
+	"cryptics_request_query_seconds": ("histogram", "Time spent in SQL per request, by view", SECONDS_BUCKETS),
+	"cryptics_cache_requests_total": ("counter", "Lookups in the page and queryset cache, by what's cached and result", None),
+	"cryptics_discord_post_seconds": ("histogram", "Time taken to post to a Discord webhook", SECONDS_BUCKETS),
+	"cryptics_discord_post_failures_total": ("counter", "Failed posts to Discord webhooks, by reason", None),
+	"cryptics_task_duration_seconds": ("histogram", "Time taken to run Celery tasks, by task", TASK_SECONDS_BUCKETS),
+	"cryptics_task_failures_total": ("counter", "Celery tasks that raised an exception, by task", None),
+}
+
+ARCHIVE_FILE = "archive.json"
+LOCK_FILE = ".lock"
+
+
+class Registry:
+	""" The metrics counted by this process since it last wrote them out """
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._reset()
+
+	def _reset(self):
+		self._pid = os.getpid()
+		self._directory = None
+		self._path = None
+		self._counters = {}
+		self._histograms = {}
+		self._last_flush = time.monotonic()
+
+	def clear(self):
+		""" Forget everything counted so far (for tests) """
+		with self._lock:
+			self._reset()
+
+	def _check_fork(self):
+		# A forked worker starts counting from scratch (and in its own file), rather than adding
+		# to whatever its parent had counted
+		if os.getpid() != self._pid:
+			self._reset()
+
+	def inc(self, name, amount=1, **labels):
+		if not settings.METRICS_DIR:
+			return
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			self._check_fork()
+			self._counters[key] = self._counters.get(key, 0) + amount
+
+	def observe(self, name, value, **labels):
+		if not settings.METRICS_DIR:
+			return
+		buckets = METRICS[name][2]
+		key = (name, tuple(sorted(labels.items())))
+		with self._lock:
+			self._check_fork()
+			histogram = self._histograms.setdefault(key, {"buckets": [0] * len(buckets), "sum": 0, "count": 0})
+			for i, bound in enumerate(buckets):
+				if value <= bound:
+					histogram["buckets"][i] += 1
+			histogram["sum"] += value
+			histogram["count"] += 1
+
+	def flush(self, force=False):
+		""" Write this process's metrics to its file in METRICS_DIR, if it's been METRICS_FLUSH_INTERVAL since it last did (or force) """
+		if not settings.METRICS_DIR:
+			return
+		with self._lock:
+			self._check_fork()
+			if not force and time.monotonic() - self._last_flush < settings.METRICS_FLUSH_INTERVAL:
+				return
+			self._last_flush = time.monotonic()
+			if self._directory != settings.METRICS_DIR:
+				os.makedirs(settings.METRICS_DIR, exist_ok=True)
+				self._directory = settings.METRICS_DIR
+				self._path = os.path.join(settings.METRICS_DIR, f"{socket.gethostname()}-{os.getpid()}-{time.time_ns()}.json")
+			data = _dump(self._counters, self._histograms)
+
+		write_atomically(self._path, data)
+
+
+registry = Registry()
+
+
+def _dump(counters, histograms):
+	return {
+		"counters": [[name, labels, value] for (name, labels), value in counters.items()],
+		"histograms": [[name, labels, histogram] for (name, labels), histogram in histograms.items()],
+	}
+
+
+def write_atomically(path, data):
+	""" Write data to path as JSON, replacing any old file in a single rename so readers never see half of it """
+	with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(path), suffix=".tmp", delete=False) as f:
+		json.dump(data, f)
+	os.replace(f.name, path)
+
+
+def _merge(files):
+	""" Add up the counters and histograms in the given metrics files """
+	counters = {}
+	histograms = {}
+	for path in files:
+		try:
+			with open(path, encoding="utf-8") as f:
+				data = json.load(f)
+		except (FileNotFoundError, ValueError):
+			continue  # Archived by another request, or (very unlikely) half-written
+		for name, labels, value in data["counters"]:
+			key = (name, tuple(tuple(label) for label in labels))
+			counters[key] = counters.get(key, 0) + value
+		for name, labels, histogram in data["histograms"]:
+			key = (name, tuple(tuple(label) for label in labels))
+			total = histograms.setdefault(key, {"buckets": [0] * len(histogram["buckets"]), "sum": 0, "count": 0})
+			total["buckets"] = [a + b for a, b in zip(total["buckets"], histogram["buckets"])]
+			total["sum"] += histogram["sum"]
+			total["count"] += histogram["count"]
+	return counters, histograms
+
+
+def _is_running(path):
+	""" Whether the process that wrote path (on this machine) is still running """
+	host, pid, _ = os.path.basename(path).rsplit("-", 2)
+	if host != socket.gethostname():
+		return True
+	try:
+		os.kill(int(pid), 0)
+	except ProcessLookupError:
+		return False
+	except PermissionError:
+		pass  # Running, as another user
+	return True
+
+
+def collect_process_files(directory, merge, dump):
+	""" Add up the "{host}-{pid}-{time}.json" files each process writes to directory
+
+	merge adds up a list of files, and dump turns what it returns back into something to write.
+	The files of processes that have exited are folded into a single archive file first (under a
+	lock, so two readers can't both fold the same file in), so the directory doesn't keep growing.
+	"""
+	os.makedirs(directory, exist_ok=True)
+	with open(os.path.join(directory, LOCK_FILE), "a", encoding="utf-8") as lock:
+		fcntl.flock(lock, fcntl.LOCK_EX)
+		archive = os.path.join(directory, ARCHIVE_FILE)
+		files = [
+			os.path.join(directory, name)
+			for name in os.listdir(directory)
+			if name.endswith(".json") and name != ARCHIVE_FILE
+		]
+		finished = [path for path in files if not _is_running(path)]
+		if finished:
+			write_atomically(archive, dump(merge([archive, *finished])))
+			for path in finished:
+				with contextlib.suppress(FileNotFoundError):
+					os.remove(path)
+			files = [path for path in files if path not in finished]
+		return merge([archive, *files])
+
+
+def collect():
+	""" Add up every process's metrics """
+	registry.flush(force=True)
+	return collect_process_files(settings.METRICS_DIR, _merge, lambda merged: _dump(*merged))
+
+
+def render(counters, histograms):
+	""" The metrics in Prometheus' text exposition format """
+	lines = []
+	for name, (metric_type, help_text, buckets) in METRICS.items():
+		lines.append(f"# HELP {name} {help_text}")
+		lines.append(f"# TYPE {name} {metric_type}")
+		if metric_type == "counter":
+			for (metric, labels), value in sorted(counters.items()):
+				if metric == name:
+					lines.append(f"{name}{_labels(labels)} {value}")
+		else:
+			for (metric, labels), histogram in sorted(histograms.items()):
+				if metric != name:
+					continue
+				for bound, count in zip(buckets, histogram["buckets"]):
+					lines.append(f"{name}_bucket{_labels(labels, le=bound)} {count}")
+				lines.append(f"{name}_bucket{_labels(labels, le='+Inf')} {histogram['count']}")
+				lines.append(f"{name}_sum{_labels(labels)} {histogram['sum']}")
+				lines.append(f"{name}_count{_labels(labels)} {histogram['count']}")
+	return "\n".join(lines) + "\n"
+
+
+def _labels(labels, **extra):
+	labels = [*labels, *extra.items()]
+	if not labels:
+		return ""
+	return "{" + ",".join(f'{key}="{_escape(value)}"' for key, value in labels) + "}"
+
+
+def _escape(value):
+	return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+@contextlib.contextmanager
+def timed(name, **labels):
+	""" Observe how long the with block takes in the histogram called name """
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		registry.observe(name, time.perf_counter() - start, **labels)
+
+
+def count_cache_lookup(cache_name, hit):
+	registry.inc("cryptics_cache_requests_total", cache=cache_name, result="hit" if hit else "miss")
+
+
+class MetricsMiddleware:
+	""" Record each request's time, and the number of queries it ran and the time they took, by view """
+	def __init__(self, get_response):
+		if not settings.METRICS_DIR:
+			raise MiddlewareNotUsed
+		self.get_response = get_response
+
+	def __call__(self, request):
+		queries = 0
+		query_time = 0
+
+		def time_queries(execute, sql, params, many, context):
+			nonlocal queries, query_time
+			start = time.perf_counter()
+			try:
+				return execute(sql, params, many, context)
+			finally:
+				query_time += time.perf_counter() - start
+				queries += 1
+
+		start = time.perf_counter()
+		with connection.execute_wrapper(time_queries):
+			response = self.get_response(request)
+		duration = time.perf_counter() - start
+
+		view = request.resolver_match.view_name if request.resolver_match else "unresolved"
+		registry.observe("cryptics_request_duration_seconds", duration, view=view, method=request.method)
+		registry.observe("cryptics_request_queries", queries, view=view)
+		registry.observe("cryptics_request_query_seconds", query_time, view=view)
+		registry.flush()
+		return response
@@ -0,0 +1,64 @@
+# Generated by Django 5.0.6 on 2026-10-17 03:54
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def populate_user_stats(apps, schema_editor):
+    User = apps.get_model(*settings.AUTH_USER_MODEL.split('.'))
+    Contest = apps.get_model('cryptics', 'Contest')
+    Submission = apps.get_model('cryptics', 'Submission')
+    UserStats = apps.get_model('cryptics', 'UserStats')
+    Like = Submission.likers.through
+
+    def grouped_count(queryset, field):
+        return dict(queryset.values(field).annotate(n=Count('*')).values_list(field, 'n'))
+
+    won = grouped_count(Contest.objects.exclude(winning_user=None), 'winning_user_id')
+    submitted = grouped_count(Submission.objects.all(), 'submitted_by_id')
+    received = grouped_count(Like.objects.all(), 'submission__submitted_by_id')
+    given = grouped_count(Like.objects.all(), 'user_id')
+
+    stats = []
+    for user_id in User.objects.values_list('id', flat=True):
+        total_submissions = submitted.get(user_id, 0)
+        total_likes = received.get(user_id, 0)
+        stats.append(UserStats(
+            user_id=user_id,
+            contests_won=won.get(user_id, 0),
+            total_submissions=total_submissions,
+            total_likes=total_likes,
+            clues_liked=given.get(user_id, 0),
+            average_likes=total_likes / total_submissions if total_submissions else 0,
+        ))
+    UserStats.objects.bulk_create(stats, batch_size=500)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cryptics', '0009_alter_contest_options_alter_submission_options'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='UserStats',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('contests_won', models.IntegerField(default=0)),
+                ('total_submissions', models.IntegerField(default=0)),
+                ('total_likes', models.IntegerField(default=0)),
+                ('clues_liked', models.IntegerField(default=0)),
+                ('average_likes', models.FloatField(default=0)),
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, related_name='stats', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'verbose_name_plural': 'user stats',
+                'indexes': [models.Index(fields=['-contests_won', '-average_likes'], name='userstats_leaderboard_idx')],
+            },
+        ),
+        migrations.RunPython(populate_user_stats, migrations.RunPython.noop),
+    ]
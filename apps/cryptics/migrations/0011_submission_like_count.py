@@ -0,0 +1,36 @@
+# Generated by Django 5.0.6 on 2026-10-17 03:59
+
+from django.conf import settings
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def populate_like_counts(apps, schema_editor):
+    Submission = apps.get_model('cryptics', 'Submission')
+    Like = Submission.likers.through
+    counts = Like.objects.filter(
+        submission_id=OuterRef('pk')
+    ).order_by().values('submission_id').annotate(n=Count('*')).values('n')
+    Submission.objects.update(like_count=Coalesce(Subquery(counts), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cryptics', '0010_userstats'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='submission',
+            name='like_count',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.RunPython(populate_like_counts, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='submission',
+            index=models.Index(fields=['contest', '-like_count', 'created_at'], name='submission_contest_likes_idx'),
+        ),
+    ]
@@ -0,0 +1,31 @@
+# Generated by Django 5.0.6 on 2026-10-17 04:06
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cryptics', '0011_submission_like_count'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DiscordMessage',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('content', models.TextField()),
+                ('status', models.CharField(choices=[('P', 'pending'), ('S', 'sent'), ('F', 'failed')], default='P', max_length=1)),
+                ('attempts', models.PositiveIntegerField(default=0)),
+                ('next_attempt_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('last_error', models.TextField(blank=True)),
+                ('sent_at', models.DateTimeField(blank=True, null=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+            options={
+                'ordering': ['id'],
+                'indexes': [models.Index(fields=['status', 'next_attempt_at'], name='discordmessage_due_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-17 04:09
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cryptics', '0012_discordmessage'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='discordmessage',
+            name='digest_key',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.0.6 on 2026-10-17 04:12
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cryptics', '0013_discordmessage_digest_key'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='discordmessage',
+            name='target',
+            field=models.CharField(blank=True, max_length=100),
+        ),
+    ]
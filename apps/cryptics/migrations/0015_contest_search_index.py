@@ -0,0 +1,60 @@
+# Generated by Django 5.0.6 on 2026-10-17 04:14
+
+import re
+import unicodedata
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# Copies of apps.cryptics.utils.normalize_word and trigrams as they were when this migration was
+# written, so that later changes to those can't change what it does
+def normalize_word(word):
+    word = re.sub(r"\s*\(.*\)\s*$", "", word)
+    word = "".join(char for char in unicodedata.normalize("NFKD", word) if not unicodedata.combining(char))
+    return " ".join(word.upper().split())
+
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def build_search_index(apps, schema_editor):
+    Contest = apps.get_model('cryptics', 'Contest')
+    ContestTrigram = apps.get_model('cryptics', 'ContestTrigram')
+    contests = list(Contest.objects.only('id', 'word'))
+    for contest in contests:
+        contest.search_word = normalize_word(contest.word)
+    Contest.objects.bulk_update(contests, ['search_word'], batch_size=1000)
+    ContestTrigram.objects.bulk_create(
+        [ContestTrigram(contest=contest, trigram=gram) for contest in contests for gram in trigrams(contest.search_word)],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cryptics', '0014_discordmessage_target'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contest',
+            name='search_word',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=150),
+        ),
+        migrations.CreateModel(
+            name='ContestTrigram',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('trigram', models.CharField(max_length=3)),
+                ('contest', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='trigrams', to='cryptics.contest')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='contesttrigram',
+            constraint=models.UniqueConstraint(fields=('trigram', 'contest'), name='contesttrigram_unique'),
+        ),
+        migrations.RunPython(build_search_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,52 @@
+# Generated by Django 5.0.6 on 2026-10-17 04:20
+
+import re
+import unicodedata
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+# A copy of apps.cryptics.utils.search_terms as it was when this migration was written, so that later
+# changes to it can't change what this does
+def search_terms(text):
+    text = "".join(char for char in unicodedata.normalize("NFKD", text) if not unicodedata.combining(char))
+    return {term for term in re.findall(r"\w+", text.lower()) if 1 < len(term) <= 50}
+
+
+def build_search_index(apps, schema_editor):
+    Submission = apps.get_model('cryptics', 'Submission')
+    SubmissionTerm = apps.get_model('cryptics', 'SubmissionTerm')
+    SubmissionTerm.objects.bulk_create(
+        [
+            SubmissionTerm(submission_id=submission_id, field=field, term=term)
+            for submission_id, clue, explanation in Submission.objects.values_list('id', 'clue', 'explanation')
+            for field, text in (('C', clue), ('E', explanation))
+            for term in search_terms(text)
+        ],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cryptics', '0015_contest_search_index'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SubmissionTerm',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('term', models.CharField(max_length=50)),
+                ('field', models.CharField(choices=[('C', 'clue'), ('E', 'explanation')], max_length=1)),
+                ('submission', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='terms', to='cryptics.submission')),
+            ],
+        ),
+        migrations.AddConstraint(
+            model_name='submissionterm',
+            constraint=models.UniqueConstraint(fields=('term', 'submission', 'field'), name='submissionterm_unique'),
+        ),
+        migrations.RunPython(build_search_index, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.6 on 2026-10-17 04:55
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cryptics', '0016_submission_search_index'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='contest',
+            index=models.Index(fields=['created_at', 'id'], name='contest_created_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.0.6 on 2026-10-17 04:58
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('cryptics', '0017_contest_created_idx'),
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='submission',
+            index=models.Index(fields=['submitted_by', '-like_count', 'created_at', 'id'], name='submission_user_likes_idx'),
+        ),
+    ]
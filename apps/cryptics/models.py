@@ -1,15 +1,19 @@
 import datetime
 import logging
+from collections import Counter, defaultdict
+from functools import partial
 
+from django.conf import settings
 from django.db import models, transaction
-from django.db.models import Count
+from django.db.models import Count, Exists, F, FloatField, Max, Min, OuterRef, Sum, Value
+from django.db.models.functions import Cast, Coalesce, NullIf, RowNumber
 from django.contrib.auth.models import User
 from django.urls import reverse
 from django.utils import timezone
 from django.utils.text import slugify
 
-from . import tasks
-from .utils import get_discord_pingable_role, get_site_url, to_discord
+from . import caching, delivery
+from .utils import get_discord_pingable_role, get_site_url, normalize_word, search_terms, to_discord, trigrams
 
 logger = logging.getLogger(__name__)
 
@@ -18,33 +22,267 @@ VOTING_LENGTH = datetime.timedelta(days=2, minutes=2)
 RECENT_LENGTH = datetime.timedelta(days=7)
 
 
+def effective_status_expression(prefix=""):
+	""" The SQL equivalent of Contest.effective_status, for annotating or filtering querysets
+
+	Use prefix to build the expression from a related model, e.g. prefix="contest__" on Submission.
+	"""
+	now = timezone.now()
+	return models.Case(
+		models.When(**{f"{prefix}status": Contest.CLOSED}, then=Value(Contest.CLOSED)),
+		models.When(
+			**{f"{prefix}created_at__lt": now - SUBMISSIONS_LENGTH - VOTING_LENGTH}, then=Value(Contest.CLOSED)
+		),
+		models.When(**{f"{prefix}status": Contest.VOTING}, then=Value(Contest.VOTING)),
+		models.When(**{f"{prefix}created_at__lt": now - SUBMISSIONS_LENGTH}, then=Value(Contest.VOTING)),
+		default=Value(Contest.SUBMISSIONS),
+		output_field=models.CharField(max_length=1),
+	)
+
+
+class ContestQuerySet(models.query.QuerySet):
+	def annotate_effective_status(self):
+		""" Annotate each contest with current_status, the SQL version of Contest.effective_status """
+		return self.annotate(current_status=effective_status_expression())
+
+	def with_effective_status(self, status):
+		""" Filter to contests whose effective status (see Contest.effective_status) is the one given """
+		return self.alias(current_status=effective_status_expression()).filter(current_status=status)
+
+	def next_phase_change(self):
+		""" When the next contest in this queryset will move on to a new phase, or None if they're all closed
+
+		That's the earliest end of submissions for contests still taking them, or end of voting for
+		the rest, worked out from created_at in one query.  Caches use this as their expiry time,
+		since phases change without anything being saved.
+		"""
+		now = timezone.now()
+		first_created = self.exclude(status=Contest.CLOSED).aggregate(
+			submissions=Min("created_at", filter=models.Q(
+				status=Contest.SUBMISSIONS, created_at__gte=now - SUBMISSIONS_LENGTH
+			)),
+			voting=Min("created_at", filter=models.Q(created_at__gte=now - SUBMISSIONS_LENGTH - VOTING_LENGTH)),
+		)
+		changes = []
+		if first_created["submissions"] is not None:
+			changes.append(first_created["submissions"] + SUBMISSIONS_LENGTH)
+		if first_created["voting"] is not None:
+			changes.append(first_created["voting"] + SUBMISSIONS_LENGTH + VOTING_LENGTH)
+		return min(changes, default=None)
+
+	def last_phase_change(self):
+		""" When the last contest in this queryset moved on to a new phase, or None if none of them have yet
+
+		This is the counterpart of next_phase_change, for validators like ETags that need to change
+		whenever a phase does.
+		"""
+		now = timezone.now()
+		last_created = self.aggregate(
+			voting=Max("created_at", filter=models.Q(created_at__lt=now - SUBMISSIONS_LENGTH)),
+			closed=Max("created_at", filter=models.Q(created_at__lt=now - SUBMISSIONS_LENGTH - VOTING_LENGTH)),
+		)
+		changes = []
+		if last_created["voting"] is not None:
+			changes.append(last_created["voting"] + SUBMISSIONS_LENGTH)
+		if last_created["closed"] is not None:
+			changes.append(last_created["closed"] + SUBMISSIONS_LENGTH + VOTING_LENGTH)
+		return max(changes, default=None)
+
+	def declare_winners(self, *, announce=True):
+		""" Pick and save the winning submission for every contest in this queryset without a winner
+
+		The winners for all of the contests (most likes, ties going to the earliest submission) come
+		from a single ROW_NUMBER() OVER (PARTITION BY contest_id ...) query and are saved with one
+		bulk_update.  That update only touches contests that still don't have a winner, and stamps
+		them with this call's own updated_at, so if two calls race each contest is only declared (and
+		announced) once.  Contests without any submissions are skipped.
+
+		Returns the list of contests that this call declared winners for.
+		"""
+		winners = Submission.objects.filter(
+			contest__in=self.filter(winning_entry=None).values("pk")
+		).annotate(
+			rank=models.Window(
+				RowNumber(),
+				partition_by=F("contest_id"),
+				order_by=[F("like_count").desc(), F("created_at").asc(), F("id").asc()],
+			)
+		).filter(rank=1).values_list("contest_id", "id", "submitted_by_id")
+
+		stamp = timezone.now()
+		contests = [
+			Contest(id=contest_id, winning_entry_id=submission_id, winning_user_id=user_id, updated_at=stamp)
+			for contest_id, submission_id, user_id in winners
+		]
+		if not contests:
+			return []
+
+		with transaction.atomic():
+			Contest.objects.filter(winning_entry=None).bulk_update(
+				contests, ["winning_entry", "winning_user", "updated_at"], batch_size=500
+			)
+			declared = list(
+				Contest.objects.filter(
+					updated_at=stamp, winning_entry__isnull=False
+				).select_related("winning_entry__submitted_by")
+			)
+			for user_id, wins in Counter(contest.winning_user_id for contest in declared).items():
+				UserStats.objects.adjust(user_id, contests_won=wins)
+
+			# bulk_update doesn't send post_save, so the cached pages are expired here
+			transaction.on_commit(partial(
+				caching.bump_versions,
+				caching.version_key(caching.LEADERBOARD),
+				caching.version_key(caching.CONTEST_LISTS),
+				*(caching.version_key(caching.CONTEST, contest.id) for contest in declared),
+				*(caching.version_key(caching.USER, contest.winning_user_id) for contest in declared),
+			))
+
+			# In the same transaction, so a winner can't be saved without its announcement being queued
+			if announce:
+				for contest in declared:
+					contest.announce_winner()
+
+		return declared
+
+	def page_after(self, after=None, size=50):
+		""" One page of contests in (created_at, id) order, starting after the key given by after
+
+		This is keyset pagination: rather than OFFSET, which has to count past every earlier row,
+		it seeks straight to the position on the contest_created_idx index, so any page costs the
+		same.  Returns the page and the (created_at, id) key to pass as after for the next page,
+		or None if this is the last one.
+		"""
+		contests = self.order_by("created_at", "id")
+		if after is not None:
+			created_at, pk = after
+			# The created_at__gte is implied by the rest, but spelling it out lets the database seek
+			contests = contests.filter(created_at__gte=created_at).filter(
+				models.Q(created_at__gt=created_at) | models.Q(id__gt=pk)
+			)
+		page = list(contests[:size + 1])
+		if len(page) <= size:
+			return page, None
+		page = page[:size]
+		return page, (page[-1].created_at, page[-1].id)
+
+	def search(self, text):
+		""" Contests whose word contains text, ignoring case, accents, spacing, and enumerations
+
+		Matches are found through the ContestTrigram index (only contests that have every trigram of
+		the search are checked against search_word) and ranked with exact matches first, then by
+		age.  Each contest is annotated with total, the number of matches before any slicing, so a
+		page of results and the count come from the same query.  Searches shorter than a trigram
+		fall back to scanning search_word.
+		"""
+		query = normalize_word(text)
+		if not query:
+			return self.none()
+
+		matches = self.filter(search_word__contains=query)
+		if grams := trigrams(query):
+			candidates = ContestTrigram.objects.filter(
+				trigram__in=grams
+			).values("contest_id").annotate(n=Count("*")).filter(n=len(grams)).values("contest_id")
+			matches = matches.filter(id__in=candidates)
+
+		return matches.annotate(
+			exact=models.Case(models.When(search_word=query, then=Value(True)), default=Value(False)),
+			total=models.Window(Count("*")),
+		).order_by("-exact", "created_at")
+
+
 class ContestManager(models.Manager):
 	""" Custom manager for the Contest model """
+	def get_queryset(self):
+		return ContestQuerySet(self.model, using=self._db)
+
+	def annotate_effective_status(self):
+		return self.get_queryset().annotate_effective_status()
+
+	def declare_winners(self, *, announce=True):
+		return self.get_queryset().declare_winners(announce=announce)
+
+	def with_effective_status(self, status):
+		return self.get_queryset().with_effective_status(status)
+
+	def search(self, text):
+		return self.get_queryset().search(text)
+
 	def add(self, word, started_by):
-		""" Create a new contest, post Discord message, and queue Celery tasks """
-		new_contest = self.create(word=word.upper(), started_by=started_by)
+		""" Create a new contest and post Discord message
 
-		msg = (
-			f"{get_discord_pingable_role()}{new_contest.started_by} started a new contest: "
-			f"{new_contest.word} -- {get_site_url()}{new_contest.get_absolute_url()}"
-		)
-		to_discord(msg)
+		Moving the contest on to voting and closing it is handled by the periodic sweep_contests task.
+		The contest and its message are saved in one transaction, so neither is kept without the other.
+		"""
+		with transaction.atomic():
+			new_contest = self.create(word=word.upper(), started_by=started_by)
 
-		tasks.update_contest_status.apply_async(
-			args=(new_contest.id,),
-			eta=new_contest.submissions_end_time+datetime.timedelta(seconds=1)
-		)
-		tasks.update_contest_status.apply_async(
-			args=(new_contest.id,),
-			eta=new_contest.voting_end_time+datetime.timedelta(seconds=1)
-		)
+			msg = (
+				f"{get_discord_pingable_role()}{new_contest.started_by} started a new contest: "
+				f"{new_contest.word} -- {get_site_url()}{new_contest.get_absolute_url()}"
+			)
+			to_discord(msg)
 
 		return new_contest
 
+	def sweep(self, now=None):
+		""" Persist the status of every contest that's crossed a phase boundary, and announce the changes
+
+		Each transition is one bulk UPDATE guarded by the old status, so a contest can only be moved
+		once no matter how many sweeps run (including at the same time in different workers).  Rows
+		are stamped with this sweep's own updated_at, which is how it knows which contests it moved
+		and therefore which ones it should announce.  Each transition is its own transaction, with
+		the announcements queued in it, so a contest can't be moved without them.
+
+		Returns a tuple of (contests switched to voting, contests closed).
+		"""
+		now = now or timezone.now()
+		stamp = timezone.now()
+
+		with transaction.atomic():
+			closed_count = self.filter(
+				status__in=[Contest.SUBMISSIONS, Contest.VOTING],
+				created_at__lt=now - SUBMISSIONS_LENGTH - VOTING_LENGTH,
+			).update(status=Contest.CLOSED, updated_at=stamp)
+			closed = list(self.filter(status=Contest.CLOSED, updated_at=stamp)) if closed_count else []
+
+		with transaction.atomic():
+			voting_count = self.filter(
+				status=Contest.SUBMISSIONS,
+				created_at__lt=now - SUBMISSIONS_LENGTH,
+			).update(status=Contest.VOTING, updated_at=stamp)
+			switched = list(self.filter(status=Contest.VOTING, updated_at=stamp)) if voting_count else []
+
+			for contest in switched:
+				contest.announce_voting()
+
+		# This also picks up contests closed by an earlier sweep that died before declaring a winner
+		self.filter(status=Contest.CLOSED).declare_winners()
+
+		return switched, closed
+
+	def next_phase_change(self):
+		return self.get_queryset().next_phase_change()
+
+	def next_recent_change(self):
+		""" When the next contest will close or drop off the recently ended list, or None if nothing will
+
+		Together with ended_recently, this is what lets the main page cache its contest lists for
+		exactly as long as they're right.
+		"""
+		now = timezone.now()
+		oldest_recent = self.with_effective_status(Contest.CLOSED).filter(
+			created_at__gt=now - (SUBMISSIONS_LENGTH + VOTING_LENGTH + RECENT_LENGTH)
+		).aggregate(created_at=Min("created_at"))["created_at"]
+		changes = [self.next_phase_change()]
+		if oldest_recent is not None:
+			changes.append(oldest_recent + SUBMISSIONS_LENGTH + VOTING_LENGTH + RECENT_LENGTH)
+		return min((change for change in changes if change is not None), default=None)
+
 	def ended_recently(self):
 		""" Return contests that closed recently """
-		return self.filter(
-			status=Contest.CLOSED,
+		return self.with_effective_status(Contest.CLOSED).filter(
 			created_at__gt=timezone.now()-(SUBMISSIONS_LENGTH+VOTING_LENGTH+RECENT_LENGTH)
 		).order_by("-created_at")
 
@@ -52,6 +290,8 @@ class ContestManager(models.Manager):
 class Contest(models.Model):
 	""" A contest (a word for which cryptic clues should be written) """
 	word = models.CharField(max_length=150)
+	# The word as it's searched (see utils.normalize_word), set on save and indexed by ContestTrigram
+	search_word = models.CharField(max_length=150, blank=True, db_index=True, editable=False)
 	started_by = models.ForeignKey(User, on_delete=models.CASCADE, related_name="contests_started")
 
 	winning_entry = models.OneToOneField(
@@ -84,6 +324,18 @@ class Contest(models.Model):
 
 	class Meta:
 		ordering = ["created_at"]
+		indexes = [
+			models.Index(fields=["created_at", "id"], name="contest_created_idx"),
+		]
+
+	def save(self, *args, **kwargs):
+		# search_word still holds the saved word's form, so this tells the post_save handlers in
+		# signals.py whether the search indexes need updating
+		self._word_changed = self.search_word != normalize_word(self.word)
+		self.search_word = normalize_word(self.word)
+		if (update_fields := kwargs.get("update_fields")) is not None and "word" in update_fields:
+			kwargs["update_fields"] = {*update_fields, "search_word"}
+		super().save(*args, **kwargs)
 
 	@property
 	def submissions_end_time(self):
@@ -93,19 +345,47 @@ class Contest(models.Model):
 	def voting_end_time(self):
 		return self.created_at + SUBMISSIONS_LENGTH + VOTING_LENGTH
 
+	@property
+	def next_phase_change(self):
+		""" When this contest will move on to its next phase, or None if it's closed """
+		status = self.effective_status
+		if status == self.SUBMISSIONS:
+			return self.submissions_end_time
+		if status == self.VOTING:
+			return self.voting_end_time
+		return None
+
+	@property
+	def effective_status(self):
+		""" The status this contest should have right now, based purely on when it was created
+
+		The stored status is only moved forward by the background task, which may lag slightly
+		behind the actual phase boundaries; this lets pages show the right phase without writing to
+		the database.  A stored status that is further along (e.g. a contest closed early in the
+		admin) wins.
+		"""
+		if self.status == self.CLOSED or self.created_at is None:
+			return self.status
+		now = timezone.now()
+		if now > self.voting_end_time:
+			return self.CLOSED
+		if self.status == self.VOTING or now > self.submissions_end_time:
+			return self.VOTING
+		return self.SUBMISSIONS
+
 	# These properties are so that I can check status on templates without hardcoding in
 	# `contest.status == "S"` (or whatever)
 	@property
 	def is_submissions(self):
-		return self.status == self.SUBMISSIONS
+		return self.effective_status == self.SUBMISSIONS
 
 	@property
 	def is_voting(self):
-		return self.status == self.VOTING
+		return self.effective_status == self.VOTING
 
 	@property
 	def is_closed(self):
-		return self.status == self.CLOSED
+		return self.effective_status == self.CLOSED
 
 	@property
 	def slugified(self):
@@ -121,43 +401,34 @@ class Contest(models.Model):
 		}
 		return reverse("cryptics:show_contest_full", kwargs=url_kwargs)
 
-	def submissions_sorted(self):
-		""" Return submissions sorted by like count if a contest is closed, creation date otherwise """
-		submissions = self.submissions.select_related("submitted_by")
-		if self.is_closed:
-			return submissions.prefetch_related(
-				"likers"
-			).annotate(
-				like_count=Count("likers")
-			).order_by(
-				"-like_count", "created_at"
-			)
-		return submissions.order_by("created_at")
+	def submissions_sorted(self, viewer=None):
+		""" Return submissions sorted by like count if a contest is closed, creation date otherwise
+
+		Each submission is annotated with viewer_liked (whether the given user liked it), so the
+		template doesn't need to touch the likers relation per row.  For closed
+		contests, each submission also gets a liker_names list of usernames, loaded with a single
+		extra query over the join table rather than by prefetching every liking User.
+		"""
+		submissions = self.submissions.select_related("submitted_by").annotate_viewer_liked(viewer)
+
+		if not self.is_closed:
+			return list(submissions.order_by("created_at"))
+
+		return attach_liker_names(list(submissions.order_by("-like_count", "created_at")))
 
 	def declare_winner(self):
 		""" Mark the submission with the most votes as the contest's winner and notify Discord """
-		send_message = False
-		if self.submissions.exists():
-			with transaction.atomic():
-				self.refresh_from_db()
-				if self.winning_entry is None:
-					winning_entry = self.submissions.annotate(
-						likes=models.Count("likers")
-					).order_by(
-						"-likes", "created_at"
-					).first()
-					self.winning_entry = winning_entry
-					self.winning_user = winning_entry.submitted_by
-					self.save()
-					send_message = True
+		Contest.objects.filter(pk=self.pk).declare_winners()
+		self.refresh_from_db(fields=["winning_entry", "winning_user", "updated_at"])
 
-		if send_message:
-			msg = (
-				f"Voting is closed for {self.word}!  The winning clue is:\n"
-				f"**{self.winning_entry.clue}**\nSubmitted by {self.winning_entry.submitted_by}.  "
-				f"Congratulations!  {get_site_url()}{self.get_absolute_url()}"
-			)
-			to_discord(msg)
+	def announce_winner(self):
+		""" Tell Discord which clue won """
+		msg = (
+			f"Voting is closed for {self.word}!  The winning clue is:\n"
+			f"**{self.winning_entry.clue}**\nSubmitted by {self.winning_entry.submitted_by}.  "
+			f"Congratulations!  {get_site_url()}{self.get_absolute_url()}"
+		)
+		to_discord(msg)
 
 	def deactivate(self):
 		""" Declare a winner and close the contest """
@@ -177,20 +448,28 @@ class Contest(models.Model):
 				send_message = True
 
 		if send_message:
-			msg = (
-				f"{get_discord_pingable_role()}Voting is now open for {self.word}! "
-				f"{get_site_url()}{self.get_absolute_url()}"
-			)
-			to_discord(msg)
+			self.announce_voting()
+
+	def announce_voting(self):
+		""" Tell Discord that voting is open """
+		msg = (
+			f"{get_discord_pingable_role()}Voting is now open for {self.word}! "
+			f"{get_site_url()}{self.get_absolute_url()}"
+		)
+		to_discord(msg)
 
 	def check_if_too_old(self):
-		""" Move contest to the next phase if enough time has passed """
-		if self.is_closed:
+		""" Move contest to the next phase if enough time has passed
+
+		This writes the new status (and declares the winner), so it should only be called from the
+		background task; request handlers should read effective_status instead.
+		"""
+		if self.status == self.CLOSED:
 			return None
 		if timezone.now() > self.voting_end_time:
 			logger.info("Closing contest %s", self.word)
 			self.deactivate()
-		elif self.is_submissions and timezone.now() > self.submissions_end_time:
+		elif self.status == self.SUBMISSIONS and timezone.now() > self.submissions_end_time:
 			logger.info("Switching contest %s to voting", self.word)
 			self.switch_to_voting()
 
@@ -199,15 +478,132 @@ class SubmissionQuerySet(models.query.QuerySet):
 	def order_by_like_count(self, *, reverse=False):
 		""" Order submissions by number of likes (default descending).
 
-		This will also annotate the queryset with like count and select/prefetch related fields. """
-		submissions = self.select_related("contest").prefetch_related("likers")
+		This will also select the contest.  Likers aren't prefetched, since like_count is stored on
+		each submission; use annotate_viewer_liked for whether the viewer liked each one. """
+		submissions = self.select_related("contest")
 
 		if reverse:
 			sort_fields = ("like_count", "created_at")
 		else:
 			sort_fields = ("-like_count", "created_at")
 
-		return submissions.annotate(like_count=models.Count("likers")).order_by(*sort_fields)
+		return submissions.order_by(*sort_fields)
+
+	def annotate_viewer_liked(self, viewer=None):
+		""" Annotate each submission with viewer_liked, whether the given user liked it """
+		if viewer is None or not viewer.is_authenticated:
+			return self.annotate(viewer_liked=Value(False))
+		likes = Submission.likers.through.objects.filter(submission=OuterRef("pk"), user=viewer)
+		return self.annotate(viewer_liked=Exists(likes))
+
+	def visible_on_profile(self, owner, viewer=None):
+		""" The owner's submissions that viewer can see on the owner's page
+
+		That's all of them for the owner, and otherwise only those for closed contests, since clues
+		are anonymous until the winner is revealed.
+		"""
+		submissions = self.filter(submitted_by=owner)
+		if viewer is None or viewer.id != owner.id:
+			submissions = submissions.alias(
+				contest_status=effective_status_expression("contest__")
+			).filter(contest_status=Contest.CLOSED)
+		return submissions
+
+	def page_by_likes(self, after=None, size=50):
+		""" One page of submissions, most liked first (then oldest first), starting after the key given by after
+
+		Like ContestQuerySet.page_after, this is keyset pagination on (-like_count, created_at, id),
+		so deep pages cost the same as the first.  Returns the page and the key for the next one, or
+		None if this is the last page.
+		"""
+		submissions = self.order_by("-like_count", "created_at", "id")
+		if after is not None:
+			like_count, created_at, pk = after
+			submissions = submissions.filter(like_count__lte=like_count).filter(
+				models.Q(like_count__lt=like_count)
+				| models.Q(created_at__gt=created_at)
+				| models.Q(created_at=created_at, id__gt=pk)
+			)
+		page = list(submissions[:size + 1])
+		if len(page) <= size:
+			return page, None
+		page = page[:size]
+		return page, (page[-1].like_count, page[-1].created_at, page[-1].id)
+
+	def in_search_order(self, rows):
+		""" Load the submissions for a page of SubmissionTerm.objects.search rows, in the same order
+
+		Each submission gets the score from its row.
+		"""
+		rows = list(rows)
+		submissions = self.in_bulk([row["submission_id"] for row in rows])
+		for row in rows:
+			submissions[row["submission_id"]].score = row["score"]
+		return [submissions[row["submission_id"]] for row in rows]
+
+
+def attach_liker_names(submissions):
+	""" Give each of a list of submissions a liker_names list of usernames, with one query over the join table
+
+	This is much cheaper than prefetching every liking User.  Returns the list.
+	"""
+	liker_names = defaultdict(list)
+	liker_rows = Submission.likers.through.objects.filter(
+		submission_id__in=[submission.id for submission in submissions]
+	).order_by("user__username")
+	for submission_id, username in liker_rows.values_list("submission_id", "user__username"):
+		liker_names[submission_id].append(username)
+	for submission in submissions:
+		submission.liker_names = liker_names[submission.id]
+	return submissions
+
+
+class ContestTrigramManager(models.Manager):
+	""" Custom manager for the ContestTrigram model """
+	def index(self, contests):
+		""" (Re)build the trigrams for the given contests from their search_word """
+		contests = list(contests)
+		self.filter(contest__in=contests).delete()
+		self.bulk_create(
+			[ContestTrigram(contest=contest, trigram=gram) for contest in contests for gram in trigrams(contest.search_word)],
+			batch_size=1000,
+		)
+
+	def rebuild(self, batch_size=1000):
+		""" Recompute every contest's search_word and trigrams, returning the number of contests indexed """
+		count = 0
+		contests = Contest.objects.only("id", "word").order_by("id")
+		for start in range(0, contests.count(), batch_size):
+			with transaction.atomic():
+				batch = list(contests[start:start + batch_size])
+				for contest in batch:
+					contest.search_word = normalize_word(contest.word)
+				Contest.objects.bulk_update(batch, ["search_word"])
+				self.index(batch)
+			count += len(batch)
+		return count
+
+
+class ContestTrigram(models.Model):
+	""" One three-character substring of a contest's search_word, for finding contests by part of their word
+
+	A LIKE '%...%' search can't use an ordinary index, but looking up each trigram of the search
+	can, and only the contests that have all of them need their search_word checked.  These rows are
+	kept up to date by the post_save handler in signals.py (and rebuilt with the rebuild_search_index
+	command).
+	"""
+	contest = models.ForeignKey(Contest, related_name="trigrams", on_delete=models.CASCADE)
+	trigram = models.CharField(max_length=3)
+
+	objects = ContestTrigramManager()
+
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=["trigram", "contest"], name="contesttrigram_unique"),
+		]
+
+	def __str__(self):
+		return f"{self.trigram} in {self.contest_id}"
 
 
 class SubmissionManager(models.Manager):
@@ -215,15 +611,22 @@ class SubmissionManager(models.Manager):
 	def get_queryset(self):
 		return SubmissionQuerySet(self.model, using=self._db)
 
+	def in_search_order(self, rows):
+		return self.get_queryset().in_search_order(rows)
+
+	def visible_on_profile(self, owner, viewer=None):
+		return self.get_queryset().visible_on_profile(owner, viewer)
+
 	def add(self, clue: str, explanation: str, contest: Contest, submitted_by: User):
-		""" Validate a clue submission and create it if there are no errors """
-		new_sub = self.create(clue=clue, explanation=explanation, contest=contest, submitted_by=submitted_by)
+		""" Validate a clue submission and create it (with its Discord message) if there are no errors """
+		with transaction.atomic():
+			new_sub = self.create(clue=clue, explanation=explanation, contest=contest, submitted_by=submitted_by)
 
-		msg = (
-			f"New submission for {new_sub.contest.word}: {new_sub.clue} -- "
-			f"<{get_site_url()}{new_sub.get_absolute_url()}>"
-		)
-		to_discord(msg)
+			msg = (
+				f"New submission for {new_sub.contest.word}: {new_sub.clue} -- "
+				f"<{get_site_url()}{new_sub.get_absolute_url()}>"
+			)
+			to_discord(msg, digest_key=f"submissions-{contest.id}")
 
 		return new_sub
 
@@ -237,6 +640,9 @@ class Submission(models.Model):
 	# listed as "deleted user" or somesuch
 	submitted_by = models.ForeignKey(User, related_name="submissions", on_delete=models.CASCADE)
 	likers = models.ManyToManyField(User, related_name="clues_liked", blank=True)
+	# Denormalized count of likers, kept in sync by the m2m_changed handler in signals.py (and
+	# fixable with the reconcile_like_counts command), so ranking never has to GROUP BY the join table
+	like_count = models.IntegerField(default=0)
 
 	created_at = models.DateTimeField(auto_now_add=True)
 	updated_at = models.DateTimeField(auto_now=True)
@@ -245,15 +651,29 @@ class Submission(models.Model):
 
 	class Meta:
 		ordering = ["created_at"]
+		indexes = [
+			models.Index(fields=["contest", "-like_count", "created_at"], name="submission_contest_likes_idx"),
+			models.Index(fields=["submitted_by", "-like_count", "created_at", "id"], name="submission_user_likes_idx"),
+		]
 
 	@property
 	def sort_order(self):
 		""" This is used to sort submissions on the contest show page. """
-		return (-self.likers.count(), self.created_at)
+		return (-self.like_count, self.created_at)
 
 	def __str__(self):
 		return f"Submission: {self.clue}, by {self.submitted_by}"
 
+	def add_like(self, user):
+		""" Like this submission; like_count is updated in the same transaction """
+		with transaction.atomic():
+			self.likers.add(user)
+
+	def remove_like(self, user):
+		""" Unlike this submission; like_count is updated in the same transaction """
+		with transaction.atomic():
+			self.likers.remove(user)
+
 	def get_absolute_url(self):
 		url_kwargs = {
 			"contest_id": self.contest.id,
@@ -266,48 +686,262 @@ class Submission(models.Model):
 		return url
 
 
-def sort_users():
-	""" Sort users based on the number of contests won and average number of likes
+class SubmissionTermManager(models.Manager):
+	""" Custom manager for the SubmissionTerm model """
+	def index(self, submissions):
+		""" (Re)build the search terms for the given submissions from their clues and explanations """
+		submissions = list(submissions)
+		self.filter(submission__in=submissions).delete()
+		self.bulk_create(
+			[
+				SubmissionTerm(submission=submission, field=field, term=term)
+				for submission in submissions
+				for field, text in ((SubmissionTerm.CLUE, submission.clue), (SubmissionTerm.EXPLANATION, submission.explanation))
+				for term in search_terms(text)
+			],
+			batch_size=1000,
+		)
+
+	def rebuild(self, batch_size=1000):
+		""" Reindex every submission, returning the number of submissions indexed """
+		count = 0
+		submissions = Submission.objects.only("id", "clue", "explanation").order_by("id")
+		for start in range(0, submissions.count(), batch_size):
+			with transaction.atomic():
+				batch = list(submissions[start:start + batch_size])
+				self.index(batch)
+			count += len(batch)
+		return count
+
+	def search(self, text, *, author=None, status=None, viewer=None):
+		""" Find the submissions containing every word of text in their clue or explanation
+
+		Returns {"submission_id": ..., "score": ...} rows, best match first: a search word in the
+		clue is worth two points and one in the explanation is worth one, and ties go to the newest
+		submission.  Use Submission.objects.in_search_order to load a page of them.
+
+		All of the work is done on this table, grouped by submission, so that the cost depends on
+		how many clues contain the rarest search word rather than on the size of the archive.
+		Everything else (explanations that are still hidden, and the filters) is applied as
+		submission_id IN (...) checks against once-evaluated subqueries.
+
+		Explanations of clues in contests that are still taking submissions aren't searched, and as
+		clues are anonymous until their contest closes, filtering by author (a username) only finds
+		clues from closed contests, unless the author is the viewer.  status filters by the
+		contest's effective status.
+		"""
+		terms = search_terms(text)
+		if not terms:
+			return self.none().values("submission_id")
+
+		def submission_ids(current_status):
+			# Starting from the (much smaller) contests table lets this use the contest_id index
+			contests = Contest.objects.with_effective_status(current_status).values("id")
+			return Submission.objects.filter(contest_id__in=contests).values("id")
+
+		hits = self.filter(term__in=terms)
+		if len(terms) > 1:
+			# Only clues with the rarest of the search words can match, so there's no need to group
+			# every clue that contains a common word like "anagram"
+			frequencies = dict(self.filter(term__in=terms).values_list("term").annotate(n=Count("*")))
+			if len(frequencies) < len(terms):
+				return self.none().values("submission_id")
+			rarest = min(frequencies, key=frequencies.get)
+			hits = hits.filter(submission_id__in=self.filter(term=rarest).values("submission_id"))
+
+		hits = hits.exclude(
+			field=SubmissionTerm.EXPLANATION, submission_id__in=submission_ids(Contest.SUBMISSIONS)
+		)
+		if author:
+			hits = hits.filter(submission_id__in=Submission.objects.filter(submitted_by__username=author).values("id"))
+			if not (viewer and viewer.username == author):
+				hits = hits.filter(submission_id__in=submission_ids(Contest.CLOSED))
+		if status:
+			hits = hits.filter(submission_id__in=submission_ids(status))
+
+		return hits.values("submission_id").annotate(
+			matched=Count("term", distinct=True),
+			score=Sum(models.Case(models.When(field=SubmissionTerm.CLUE, then=Value(2)), default=Value(1))),
+		).filter(matched=len(terms)).order_by("-score", "-submission_id").values("submission_id", "score")
+
+
+class SubmissionTerm(models.Model):
+	""" A word that appears in a submission's clue or explanation: an inverted index for searching clues
+
+	Kept up to date by the post_save handler in signals.py (rows for deleted submissions go with
+	them by cascade), and rebuilt with the rebuild_search_index command.  This is plain tables and
+	indexes rather than FTS5 or tsvector so that it works the same on every database backend.
+	"""
+	submission = models.ForeignKey(Submission, related_name="terms", on_delete=models.CASCADE)
+	term = models.CharField(max_length=50)
+
+	CLUE = "C"
+	EXPLANATION = "E"
+
+	FIELD_CHOICES = (
+		(CLUE, "clue"),
+		(EXPLANATION, "explanation"),
+	)
+
+	field = models.CharField(max_length=1, choices=FIELD_CHOICES)
 
-	This function is monkey patched into the User manager, because it's a built-in I don't have
-	direct access to.  (The correct way to do this would have been a proxy model, but this works
-	so it's not a pressing concern.)
+	objects = SubmissionTermManager()
 
-	For people (such as me in the future) who wonder why this only annotates the total number of
-	likes rather all of the fields: It turns out there's a longstanding Django issue about
-	multiple annotations that causes them to report the wrong values--effectively,
-	Model.objects.annotate(a_count=Count("a"), b_count=Count("b")) ends up reporting both a_count
-	and b_count as a*b.  The simplest workaround is to use distinct=True inside the count, but
-	that doesn't work for counting total number of likes received--it results in the total number
-	of users who have liked _any_ clue from this user, not a total of likes they've received
-	across every clue.  There are more complicated workarounds using subqueries, but I didn't have
-	luck with them and what's below already gives a 20x speed-up over what I had before, so I
-	don't think it's pressing.
+	class Meta:
+		constraints = [
+			models.UniqueConstraint(fields=["term", "submission", "field"], name="submissionterm_unique"),
+		]
 
-	Django ticket here: https://code.djangoproject.com/ticket/10060
+	def __str__(self):
+		return f"{self.term} in {self.get_field_display()} of {self.submission_id}"
+
+
+class UserStatsManager(models.Manager):
+	""" Custom manager for the UserStats model """
+	def leaderboard(self):
+		""" Return every user's stats, sorted by contests won and then average likes
+
+		This is the same order as sort_users, but it's a single indexed query rather than a pass
+		over every user, submission, and like in Python.
+		"""
+		return self.select_related("user").order_by("-contests_won", "-average_likes", "user_id")
+
+	def adjust(self, user_id, **deltas):
+		""" Add the given deltas to a user's counters and recompute their average likes
+
+		This is a single UPDATE using F() expressions, so concurrent likes don't overwrite each
+		other.  Users without a stats row are silently skipped (the rebuild_user_stats command
+		will create it).
+		"""
+		deltas = {field: delta for field, delta in deltas.items() if delta}
+		if user_id is None or not deltas:
+			return
+
+		updates = {field: F(field) + delta for field, delta in deltas.items()}
+		total_likes = F("total_likes") + deltas.get("total_likes", 0)
+		total_submissions = F("total_submissions") + deltas.get("total_submissions", 0)
+		updates["average_likes"] = Coalesce(
+			Cast(total_likes, FloatField()) / NullIf(total_submissions, 0), 0.0, output_field=FloatField()
+		)
+		self.filter(user_id=user_id).update(**updates)
+
+	def rebuild(self, user_ids=None):
+		""" Recompute stats from scratch for the given users (or for everyone if user_ids is None)
+
+		The numbers come from the single-statement leaderboard_values query, streamed and upserted
+		in batches, so this never holds more than one batch of rows in memory.
+		"""
+		from .leaderboard import leaderboard_values  # Imported here to avoid a circular import
+		users = User.objects.all() if user_ids is None else User.objects.filter(id__in=user_ids)
+		fields = ["contests_won", "total_submissions", "total_likes", "clues_liked", "average_likes"]
+
+		count = 0
+		batch = []
+		for row in leaderboard_values(users).iterator(chunk_size=500):
+			batch.append(self.model(
+				user_id=row["id"],
+				contests_won=row["wins"],
+				total_submissions=row["total_submissions"],
+				total_likes=row["total_likes"],
+				clues_liked=row["likes_given"],
+				average_likes=row["average_likes"],
+			))
+			if len(batch) == 500:
+				self.bulk_create(batch, update_conflicts=True, unique_fields=["user"], update_fields=fields)
+				count += len(batch)
+				batch = []
+		if batch:
+			self.bulk_create(batch, update_conflicts=True, unique_fields=["user"], update_fields=fields)
+			count += len(batch)
+
+		return count
+
+
+class UserStats(models.Model):
+	""" Denormalized per-user statistics used for the leaderboard
+
+	These are kept up to date incrementally by the signal handlers in signals.py and by
+	Contest.declare_winner; rebuild_user_stats recomputes them from scratch if they ever drift.
 	"""
-	users = User.objects.annotate(
-		total_likes=Count("submissions__likers")
-	).prefetch_related("contests_won", "submissions", "clues_liked")
-	users_list = []
-	for user in users:
-		contests_won = user.contests_won.all().count()
-		total_submissions = user.submissions.all().count()
-		total_likes = user.total_likes
-		average_likes = total_likes/total_submissions if total_submissions else 0
-		clues_liked = user.clues_liked.count()
-		users_list.append({
-			"user": user,
-			"contests_won": contests_won,
-			"total_submissions": total_submissions,
-			"total_likes": total_likes,
-			"average_likes": average_likes,
-			"clues_liked": clues_liked,
-		})
-
-	users_list.sort(key=lambda x: (-x["contests_won"], -x["average_likes"]))
-
-	return users_list
-
-
-User.objects.sort_users = sort_users
+	user = models.OneToOneField(User, on_delete=models.CASCADE, related_name="stats")
+	contests_won = models.IntegerField(default=0)
+	total_submissions = models.IntegerField(default=0)
+	total_likes = models.IntegerField(default=0)
+	clues_liked = models.IntegerField(default=0)
+	average_likes = models.FloatField(default=0)
+
+	objects = UserStatsManager()
+
+	class Meta:
+		verbose_name_plural = "user stats"
+		indexes = [
+			models.Index(fields=["-contests_won", "-average_likes"], name="userstats_leaderboard_idx"),
+		]
+
+	def __str__(self):
+		return f"Stats for {self.user}"
+
+
+class DiscordMessageManager(models.Manager):
+	""" Custom manager for the DiscordMessage model """
+	def queue(self, content, digest_key=None, target=""):
+		""" Add a message for one webhook to the outbox (see utils.to_discord)
+
+		A message with a digest_key is held for DISCORD_DIGEST_WINDOW seconds, or joins the digest
+		that's already waiting under the same key, so that they all come due (and are combined by
+		deliver_due) together.
+		"""
+		now = timezone.now()
+		if not digest_key:
+			return self.create(content=content, target=target, next_attempt_at=now)
+
+		window_end = now + datetime.timedelta(seconds=settings.DISCORD_DIGEST_WINDOW)
+		waiting_until = self.filter(
+			status=DiscordMessage.PENDING, target=target, digest_key=digest_key, attempts=0,
+			next_attempt_at__gt=now, next_attempt_at__lte=window_end,
+		).aggregate(due=Min("next_attempt_at"))["due"]
+		return self.create(
+			content=content, target=target, digest_key=digest_key, next_attempt_at=waiting_until or window_end
+		)
+
+	def deliver_due(self, batch_size=50):
+		""" Post the pending messages that are due, returning the number sent (see delivery.deliver_due) """
+		return delivery.deliver_due(self, batch_size)
+
+
+class DiscordMessage(models.Model):
+	""" A message in the outbox of things to post to Discord (see utils.to_discord) """
+	content = models.TextField()
+	# The ID of the webhook (see utils.get_discord_targets) this copy of the message is for
+	target = models.CharField(max_length=100, blank=True)
+	# Pending messages with the same digest_key are posted together as one combined message
+	digest_key = models.CharField(max_length=100, blank=True)
+
+	PENDING = "P"
+	SENT = "S"
+	FAILED = "F"
+
+	STATUS_CHOICES = (
+		(PENDING, "pending"),
+		(SENT, "sent"),
+		(FAILED, "failed"),
+	)
+
+	status = models.CharField(max_length=1, choices=STATUS_CHOICES, default=PENDING)
+	attempts = models.PositiveIntegerField(default=0)
+	next_attempt_at = models.DateTimeField(default=timezone.now)
+	last_error = models.TextField(blank=True)
+	sent_at = models.DateTimeField(null=True, blank=True)
+
+	created_at = models.DateTimeField(auto_now_add=True)
+
+	objects = DiscordMessageManager()
+
+	class Meta:
+		ordering = ["id"]
+		indexes = [
+			models.Index(fields=["status", "next_attempt_at"], name="discordmessage_due_idx"),
+		]
+
+	def __str__(self):
+		return f"Discord message ({self.get_status_display()}): {self.content[:50]}"
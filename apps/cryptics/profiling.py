@@ -0,0 +1,106 @@
+""" Opt-in cProfile sampling of requests, to see where the time goes inside the views and templates
+
+ProfilingMiddleware profiles a random PROFILE_SAMPLE_RATE of requests, plus any request from a staff
+user that carries the PROFILE_HEADER header, and writes each profile to PROFILE_DIR as a .pstats
+file (keeping the newest PROFILE_KEEP of them).  It also logs a summary line with the view, the
+total time, the time spent in SQL (timed separately with an execute_wrapper, since most of it is
+spent in the database rather than in Python), the number of queries, and the time spent rendering
+templates.  The profile_report command adds the dumps up into a list of the slowest functions.
+"""
+import cProfile
+import logging
+import os
+import pstats
+import random
+import time
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+from django.template.base import Template
+from django.utils import timezone
+
+logger = logging.getLogger(__name__)
+
+# Template.render is called once per page (and once more for each {% include %}, which cProfile's
+# cumulative time already accounts for), so its cumulative time is the time spent rendering templates
+TEMPLATE_RENDER = (Template.render.__code__.co_filename, Template.render.__code__.co_firstlineno, "render")
+
+
+def profile_files(directory=None):
+	""" The .pstats files in directory (PROFILE_DIR by default), oldest first """
+	directory = directory or settings.PROFILE_DIR
+	try:
+		names = os.listdir(directory)
+	except FileNotFoundError:
+		return []
+	return [os.path.join(directory, name) for name in sorted(names) if name.endswith(".pstats")]
+
+
+class ProfilingMiddleware:
+	""" Profile sampled (or requested) requests with cProfile and dump them to PROFILE_DIR """
+	def __init__(self, get_response):
+		if not settings.PROFILE_SAMPLE_RATE and not settings.PROFILE_HEADER:
+			raise MiddlewareNotUsed
+		self.get_response = get_response
+
+	def __call__(self, request):
+		if not self.should_profile(request):
+			return self.get_response(request)
+
+		profiler = cProfile.Profile()
+		try:
+			profiler.enable()
+		except ValueError:
+			# Only one profiler can run at a time (from Python 3.12), so another thread already has it
+			return self.get_response(request)
+
+		sql_time = 0
+		queries = 0
+
+		def time_queries(execute, sql, params, many, context):
+			nonlocal sql_time, queries
+			start = time.perf_counter()
+			try:
+				return execute(sql, params, many, context)
+			finally:
+				sql_time += time.perf_counter() - start
+				queries += 1
+
+		start = time.perf_counter()
+		try:
+			with connection.execute_wrapper(time_queries):
+				response = self.get_response(request)
+		finally:
+			profiler.disable()
+		total_time = time.perf_counter() - start
+
+		view_name = request.resolver_match.view_name if request.resolver_match else "unresolved"
+		stats = pstats.Stats(profiler)
+		template_time = stats.stats.get(TEMPLATE_RENDER, (0, 0, 0, 0))[3]  # pylint: disable=no-member
+		self.dump(stats, view_name)
+		logger.info(
+			"Profiled %s %s (%s): %.1f ms total, %.1f ms in %d queries, %.1f ms rendering templates",
+			request.method, request.path, view_name,
+			total_time * 1000, sql_time * 1000, queries, template_time * 1000,
+		)
+		return response
+
+	@staticmethod
+	def should_profile(request):
+		if settings.PROFILE_HEADER and request.headers.get(settings.PROFILE_HEADER):
+			return request.user.is_staff
+		return random.random() < settings.PROFILE_SAMPLE_RATE
+
+	@staticmethod
+	def dump(stats, view_name):
+		""" Write stats to PROFILE_DIR, named so that they sort oldest first, and delete the oldest beyond PROFILE_KEEP """
+		os.makedirs(settings.PROFILE_DIR, exist_ok=True)
+		name = f"{timezone.now():%Y%m%dT%H%M%S.%f}-{view_name.replace(':', '.')}-{os.getpid()}.pstats"
+		stats.dump_stats(os.path.join(settings.PROFILE_DIR, name))
+
+		for path in profile_files()[:-settings.PROFILE_KEEP]:
+			try:
+				os.remove(path)
+			except FileNotFoundError:
+				pass  # Another worker got to it first
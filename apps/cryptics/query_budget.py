@@ -0,0 +1,74 @@
+""" Per-view limits on the number of SQL queries a request may run, so N+1 queries can't creep back in unnoticed
+
+Views declare their limit with the query_budget decorator, and QueryBudgetMiddleware counts the
+queries each request actually runs (including loading the session and the logged-in user, since
+those happen lazily inside the view, but not statements like BEGIN and SAVEPOINT, which depend on
+the database backend rather than the view).  What happens when a view goes over depends on
+settings.QUERY_BUDGET_MODE: "raise" (used in tests) raises QueryBudgetExceeded, "log" (the
+default with DEBUG on) logs a warning, and "off" removes the middleware entirely.
+"""
+import logging
+
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connection
+
+logger = logging.getLogger(__name__)
+
+TRANSACTION_STATEMENTS = ("BEGIN", "COMMIT", "ROLLBACK", "SAVEPOINT", "RELEASE SAVEPOINT", "ROLLBACK TO SAVEPOINT")
+
+
+class QueryBudgetExceeded(Exception):
+	""" Raised (when QUERY_BUDGET_MODE is "raise") by a request that ran more queries than its view allows """
+
+
+def query_budget(max_queries, *, post=None):
+	""" Declare the most queries a request to the decorated view may run
+
+	post is a separate budget for POST requests, for views whose form handling costs more than
+	showing the page, so that the page's own budget can stay tight.  This only sets attributes, so
+	it has to be the outermost decorator for the middleware to see them.
+	"""
+	def decorator(view):
+		view.query_budget = max_queries
+		view.post_query_budget = post
+		return view
+	return decorator
+
+
+def get_query_budget(view, method="GET"):
+	""" The budget declared for requests to view with the given method, or None if it doesn't have one """
+	if method == "POST" and getattr(view, "post_query_budget", None) is not None:
+		return view.post_query_budget
+	return getattr(view, "query_budget", None)
+
+
+class QueryBudgetMiddleware:
+	""" Count each request's queries and complain about any that go over their view's budget """
+	def __init__(self, get_response):
+		if settings.QUERY_BUDGET_MODE == "off":
+			raise MiddlewareNotUsed
+		self.get_response = get_response
+
+	def __call__(self, request):
+		count = 0
+
+		def count_queries(execute, sql, params, many, context):
+			nonlocal count
+			if not sql.lstrip().upper().startswith(TRANSACTION_STATEMENTS):
+				count += 1
+			return execute(sql, params, many, context)
+
+		with connection.execute_wrapper(count_queries):
+			response = self.get_response(request)
+
+		budget = getattr(request, "_query_budget", None)
+		if budget is not None and count > budget:
+			message = f"{request.method} {request.path} ran {count} queries, over its budget of {budget}"
+			if settings.QUERY_BUDGET_MODE == "raise":
+				raise QueryBudgetExceeded(message)
+			logger.warning(message)
+		return response
+
+	def process_view(self, request, view_func, view_args, view_kwargs):
+		request._query_budget = get_query_budget(view_func, request.method)  # pylint: disable=protected-access
@@ -0,0 +1,216 @@
+""" A log of every SQL query, grouped by fingerprint, to find the ones worth optimizing
+
+When QUERY_LOG_DIR is set, record_query is added to every database connection as an execute
+wrapper.  It reduces each statement to a fingerprint (with literals, placeholders, and lists of
+them replaced, so that the same query with different values is counted together), and keeps a
+count, the total time, and the longest time for each, broken down by where it came from: the view
+or Celery task running it and the innermost line of this app's code on the stack.  Each process
+writes its counts to a file of its own in QUERY_LOG_DIR every FLUSH_INTERVAL seconds, and the
+query_report command adds them up, folding the files of processes that have exited into an
+archive as the metrics do (see metrics.collect_process_files).
+
+SELECTs that take longer than QUERY_LOG_SLOW_MS are also logged, with their EXPLAIN output.
+"""
+import atexit
+import contextvars
+import json
+import logging
+import os
+import re
+import socket
+import sys
+import threading
+import time
+
+from celery.signals import task_postrun, task_prerun
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import DatabaseError
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+from .metrics import collect_process_files, write_atomically
+
+logger = logging.getLogger(__name__)
+
+# How often (in seconds) each process writes out its counts
+FLUSH_INTERVAL = 10
+
+APP_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r"(?<![\w\"])-?\d+(?:\.\d+)?\b")
+PLACEHOLDER = re.compile(r"%s|\?")
+PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+REPEATED_LIST = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+WHITESPACE = re.compile(r"\s+")
+
+# The view or task running the current query, set by QueryLogMiddleware and the Celery signal handlers below
+current_source = contextvars.ContextVar("current_source", default="other")
+
+
+def fingerprint(sql):
+	""" sql with every literal and placeholder replaced by ?, and every list of them by (...) """
+	sql = STRING_LITERAL.sub("?", sql)
+	sql = NUMBER.sub("?", sql)
+	sql = PLACEHOLDER.sub("?", sql)
+	sql = PLACEHOLDER_LIST.sub("(...)", sql)
+	sql = REPEATED_LIST.sub("(...)", sql)  # The rows of a bulk INSERT
+	return WHITESPACE.sub(" ", sql).strip()
+
+
+def call_site():
+	""" The innermost line of this app's code (outside this module) on the stack, as "path:line (function)" """
+	frame = sys._getframe(1)  # pylint: disable=protected-access
+	while frame is not None:
+		filename = frame.f_code.co_filename
+		if filename.startswith(APP_DIR) and filename != __file__:
+			return f"{os.path.relpath(filename, settings.BASE_DIR)}:{frame.f_lineno} ({frame.f_code.co_name})"
+		frame = frame.f_back
+	return "-"
+
+
+class QueryLog:
+	""" The queries run by this process since it started, by fingerprint """
+	def __init__(self):
+		self._lock = threading.Lock()
+		self._reset()
+
+	def _reset(self):
+		self._pid = os.getpid()
+		self._directory = None
+		self._path = None
+		self._fingerprints = {}
+		self._last_flush = time.monotonic()
+
+	def clear(self):
+		""" Forget everything logged so far (for tests) """
+		with self._lock:
+			self._reset()
+
+	def add(self, sql, duration, source):
+		key = fingerprint(sql)
+		with self._lock:
+			if os.getpid() != self._pid:
+				self._reset()  # A forked worker starts from scratch, in its own file
+			stats = self._fingerprints.setdefault(key, {"count": 0, "total": 0, "max": 0, "sources": {}})
+			stats["count"] += 1
+			stats["total"] += duration
+			stats["max"] = max(stats["max"], duration)
+			stats["sources"][source] = stats["sources"].get(source, 0) + 1
+
+	def flush(self, force=False):
+		""" Write this process's counts to its file in QUERY_LOG_DIR, if it's been FLUSH_INTERVAL since it last did (or force) """
+		if not settings.QUERY_LOG_DIR:
+			return
+		with self._lock:
+			if not force and time.monotonic() - self._last_flush < FLUSH_INTERVAL:
+				return
+			self._last_flush = time.monotonic()
+			os.makedirs(settings.QUERY_LOG_DIR, exist_ok=True)  # query_report --clear deletes it
+			if self._directory != settings.QUERY_LOG_DIR:
+				self._directory = settings.QUERY_LOG_DIR
+				self._path = os.path.join(settings.QUERY_LOG_DIR, f"{socket.gethostname()}-{os.getpid()}-{time.time_ns()}.json")
+			data = {key: {**stats, "sources": dict(stats["sources"])} for key, stats in self._fingerprints.items()}
+
+		write_atomically(self._path, data)
+
+
+query_log = QueryLog()
+# Otherwise short-lived processes (management commands, say) would never get to write anything out
+atexit.register(query_log.flush, force=True)
+
+
+def collect(directory=None):
+	""" Add up the query logs of every process that's written to directory (QUERY_LOG_DIR by default) """
+	return collect_process_files(directory or settings.QUERY_LOG_DIR, merge, lambda fingerprints: fingerprints)
+
+
+def merge(files):
+	""" Add up the fingerprints in the given files """
+	fingerprints = {}
+	for path in files:
+		try:
+			with open(path, encoding="utf-8") as f:
+				data = json.load(f)
+		except (FileNotFoundError, ValueError):
+			continue
+		for key, stats in data.items():
+			total = fingerprints.setdefault(key, {"count": 0, "total": 0, "max": 0, "sources": {}})
+			total["count"] += stats["count"]
+			total["total"] += stats["total"]
+			total["max"] = max(total["max"], stats["max"])
+			for source, count in stats["sources"].items():
+				total["sources"][source] = total["sources"].get(source, 0) + count
+	return fingerprints
+
+
+def record_query(execute, sql, params, many, context):
+	""" Execute wrapper that adds each query to the log, and logs slow SELECTs with their plans """
+	if not settings.QUERY_LOG_DIR:
+		return execute(sql, params, many, context)
+
+	start = time.perf_counter()
+	result = execute(sql, params, many, context)
+	duration = time.perf_counter() - start
+
+	source = f"{current_source.get()} {call_site()}"
+	query_log.add(sql, duration, source)
+	if duration * 1000 >= settings.QUERY_LOG_SLOW_MS and not many and sql.lstrip().upper().startswith(("SELECT", "WITH")):
+		logger.warning(
+			"Slow query (%.1f ms) from %s: %s\n%s",
+			duration * 1000, source, sql, explain(context["connection"], sql, params),
+		)
+	query_log.flush()
+	return result
+
+
+def explain(connection, sql, params):
+	""" The database's query plan for sql
+
+	This uses a cursor straight from the backend, so the EXPLAIN doesn't go through the execute
+	wrappers (which would log it, and count it against the view's query budget).
+	"""
+	cursor = connection.create_cursor()
+	try:
+		cursor.execute(f"{connection.ops.explain_query_prefix()} {sql}", params)
+		return "\n".join(str(row[-1]) for row in cursor.fetchall())
+	except DatabaseError as e:
+		return f"(EXPLAIN failed: {e})"
+	finally:
+		cursor.close()
+
+
+@receiver(connection_created, dispatch_uid="cryptics_query_log")
+def install_query_log(sender, connection, **kwargs):
+	if settings.QUERY_LOG_DIR:
+		connection.execute_wrappers.append(record_query)
+
+
+@task_prerun.connect(dispatch_uid="cryptics_task_prerun_query_log")
+def set_task_source(task=None, **kwargs):
+	current_source.set(f"task:{task.name}")
+
+
+@task_postrun.connect(dispatch_uid="cryptics_task_postrun_query_log")
+def reset_task_source(**kwargs):
+	current_source.set("other")
+	query_log.flush(force=True)
+
+
+class QueryLogMiddleware:
+	""" Attribute the queries run by each request to its view """
+	def __init__(self, get_response):
+		if not settings.QUERY_LOG_DIR:
+			raise MiddlewareNotUsed
+		self.get_response = get_response
+
+	def __call__(self, request):
+		token = current_source.set("unresolved")
+		try:
+			return self.get_response(request)
+		finally:
+			current_source.reset(token)
+
+	def process_view(self, request, view_func, view_args, view_kwargs):
+		current_source.set(request.resolver_match.view_name)
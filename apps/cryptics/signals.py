@@ -0,0 +1,266 @@
+""" Signal handlers that keep denormalized data (UserStats, Submission.like_count, search indexes) in sync
+with the source tables, and expire the cached pages (see caching.py) that show them
+"""
+from collections import Counter
+from functools import partial
+
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.db.models import F, Q
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+
+from . import caching
+from .models import Contest, ContestTrigram, Submission, SubmissionTerm, UserStats
+from .word_index import contest_word_index
+
+Like = Submission.likers.through
+
+
+@receiver(post_save, sender=User, dispatch_uid="cryptics_create_user_stats")
+def create_user_stats(sender, instance, created, raw=False, **kwargs):
+	""" Every user gets a (zeroed) stats row as soon as they're created """
+	if created and not raw:
+		UserStats.objects.get_or_create(user=instance)
+
+
+@receiver(pre_save, sender=User, dispatch_uid="cryptics_user_pre_save")
+def remember_username(sender, instance, raw=False, update_fields=None, **kwargs):
+	""" Record the saved username, to tell whether this save renames the user """
+	instance._previous_username = _saved_value(instance, "username", raw, update_fields)
+
+
+@receiver(post_save, sender=User, dispatch_uid="cryptics_user_post_save_cache")
+def expire_user_pages(sender, instance, raw=False, update_fields=None, **kwargs):
+	""" Usernames are shown all over the place, but logging in (which saves last_login) changes nothing
+
+	A rename also expires every contest the user started, won, submitted to, or liked a clue in
+	(closed contests' clues are cached until their contest changes), and the pages of the people
+	whose clues they liked, which list the likers' names.
+	"""
+	if raw or set(update_fields or ()) == {"last_login"}:
+		return
+	contest_ids, user_ids = set(), {instance.pk}
+	if getattr(instance, "_previous_username", instance.username) != instance.username:
+		contest_ids.update(
+			Contest.objects.filter(Q(started_by=instance) | Q(winning_user=instance)).values_list("id", flat=True)
+		)
+		contest_ids.update(instance.submissions.values_list("contest_id", flat=True))
+		for contest_id, submitted_by_id in Like.objects.filter(user=instance).values_list(
+			"submission__contest_id", "submission__submitted_by_id"
+		):
+			contest_ids.add(contest_id)
+			user_ids.add(submitted_by_id)
+	_expire_cached_pages(contest_ids=contest_ids, user_ids=user_ids, contest_lists=bool(contest_ids))
+
+
+@receiver(pre_delete, sender=User, dispatch_uid="cryptics_user_likes_pre_delete")
+def remove_deleted_users_likes(sender, instance, **kwargs):
+	""" Take a deleted user's likes away from the people they liked
+
+	The likers join table rows are removed by a cascade, which doesn't send m2m_changed.
+	"""
+	likes = Like.objects.filter(user=instance).values_list("submission_id", "user_id")
+	_apply_like_changes(list(likes), -1, count_given=False)
+
+
+@receiver(pre_save, sender=Submission, dispatch_uid="cryptics_submission_pre_save")
+def remember_submission_setter(sender, instance, raw=False, update_fields=None, **kwargs):
+	""" Record who the submission was by, in case this save (an admin edit) gives it to someone else """
+	instance._previous_submitted_by_id = _saved_value(instance, "submitted_by", raw, update_fields)
+
+
+@receiver(post_save, sender=Submission, dispatch_uid="cryptics_submission_post_save")
+def count_new_submission(sender, instance, created, raw=False, **kwargs):
+	if raw:
+		return
+	if created:
+		UserStats.objects.adjust(instance.submitted_by_id, total_submissions=1)
+		return
+
+	previous = getattr(instance, "_previous_submitted_by_id", instance.submitted_by_id)
+	if previous != instance.submitted_by_id:
+		likes = Like.objects.filter(submission_id=instance.id).count()
+		UserStats.objects.adjust(previous, total_submissions=-1, total_likes=-likes)
+		UserStats.objects.adjust(instance.submitted_by_id, total_submissions=1, total_likes=likes)
+
+
+@receiver(post_save, sender=Submission, dispatch_uid="cryptics_submission_post_save_cache")
+@receiver(post_delete, sender=Submission, dispatch_uid="cryptics_submission_post_delete_cache")
+def expire_submission_pages(sender, instance, raw=False, **kwargs):
+	if not raw:
+		user_ids = [instance.submitted_by_id, getattr(instance, "_previous_submitted_by_id", None)]
+		_expire_cached_pages(contest_ids=[instance.contest_id], user_ids=user_ids)
+
+
+@receiver(post_save, sender=Submission, dispatch_uid="cryptics_submission_index")
+def index_submission_text(sender, instance, created, raw=False, update_fields=None, **kwargs):
+	""" Keep the submission's search terms in step with its clue and explanation """
+	if not raw and (created or update_fields is None or {"clue", "explanation"} & set(update_fields)):
+		SubmissionTerm.objects.index([instance])
+
+
+@receiver(pre_delete, sender=Submission, dispatch_uid="cryptics_submission_pre_delete")
+def remember_submission_likers(sender, instance, **kwargs):
+	""" Record who liked a submission before the cascade removes the likes """
+	instance._liker_ids = list(Like.objects.filter(submission_id=instance.id).values_list("user_id", flat=True))
+
+
+@receiver(post_delete, sender=Submission, dispatch_uid="cryptics_submission_post_delete")
+def uncount_deleted_submission(sender, instance, **kwargs):
+	liker_ids = getattr(instance, "_liker_ids", [])
+	UserStats.objects.adjust(instance.submitted_by_id, total_submissions=-1, total_likes=-len(liker_ids))
+	for user_id in liker_ids:
+		UserStats.objects.adjust(user_id, clues_liked=-1)
+
+
+@receiver(post_save, sender=Contest, dispatch_uid="cryptics_contest_post_save")
+def index_contest_word(sender, instance, created, raw=False, **kwargs):
+	""" Keep the contest's search trigrams and the autocomplete index in step with its word
+
+	A new contest is added to this worker's autocomplete index directly; any other change makes
+	every worker rebuild theirs.  Either way that waits until the contest is committed.
+	"""
+	if raw or not getattr(instance, "_word_changed", True):
+		return
+	ContestTrigram.objects.index([instance])
+	if created:
+		transaction.on_commit(partial(contest_word_index.add, instance))
+	else:
+		transaction.on_commit(contest_word_index.invalidate)
+
+
+@receiver(pre_save, sender=Contest, dispatch_uid="cryptics_contest_pre_save")
+def remember_contest_winner(sender, instance, raw=False, update_fields=None, **kwargs):
+	""" Record who won the contest, in case this save (an admin edit) makes someone else the winner """
+	instance._previous_winning_user_id = _saved_value(instance, "winning_user", raw, update_fields)
+
+
+@receiver(post_save, sender=Contest, dispatch_uid="cryptics_contest_post_save_wins")
+def count_changed_contest_win(sender, instance, created, raw=False, **kwargs):
+	""" Winners are declared with bulk_update (see ContestQuerySet.declare_winners), so this only sees edits """
+	if raw or created:
+		return
+	previous = getattr(instance, "_previous_winning_user_id", instance.winning_user_id)
+	if previous != instance.winning_user_id:
+		UserStats.objects.adjust(previous, contests_won=-1)
+		UserStats.objects.adjust(instance.winning_user_id, contests_won=1)
+
+
+@receiver(post_save, sender=Contest, dispatch_uid="cryptics_contest_post_save_cache")
+@receiver(post_delete, sender=Contest, dispatch_uid="cryptics_contest_post_delete_cache")
+def expire_contest_pages(sender, instance, raw=False, created=False, **kwargs):
+	""" This includes new contests from ContestManager.add, which need to show up on the main page
+
+	Renaming a contest also changes the pages of everyone who submitted a clue to it, which show its word.
+	"""
+	if raw:
+		return
+	user_ids = [instance.started_by_id, instance.winning_user_id, getattr(instance, "_previous_winning_user_id", None)]
+	if not created and getattr(instance, "_word_changed", False):
+		user_ids.extend(instance.submissions.values_list("submitted_by_id", flat=True).distinct())
+	_expire_cached_pages(contest_ids=[instance.id], user_ids=user_ids, contest_lists=True)
+
+
+@receiver(post_delete, sender=Contest, dispatch_uid="cryptics_contest_post_delete")
+def uncount_deleted_contest_win(sender, instance, **kwargs):
+	UserStats.objects.adjust(instance.winning_user_id, contests_won=-1)
+
+
+@receiver(post_delete, sender=Contest, dispatch_uid="cryptics_contest_word_index_delete")
+def unindex_deleted_contest(sender, instance, **kwargs):
+	transaction.on_commit(contest_word_index.invalidate)
+
+
+@receiver(m2m_changed, sender=Like, dispatch_uid="cryptics_likers_changed")
+def count_like_changes(sender, instance, action, reverse, pk_set, **kwargs):
+	""" Update like counts whenever submission.likers (or user.clues_liked) changes
+
+	Django only reports the rows that were actually inserted for post_add, but pre_remove and
+	pre_clear report whatever was asked for, so for those the rows that really exist are looked up
+	before they're deleted.
+	"""
+	if action in ("pre_remove", "pre_clear"):
+		likes = Like.objects.filter(**{"user_id" if reverse else "submission_id": instance.pk})
+		if action == "pre_remove":
+			likes = likes.filter(**{"submission_id__in" if reverse else "user_id__in": pk_set})
+		instance._removed_likes = list(likes.values_list("submission_id", "user_id"))
+	elif action == "post_add" and pk_set:
+		if reverse:
+			pairs = [(submission_id, instance.pk) for submission_id in pk_set]
+		else:
+			pairs = [(instance.pk, user_id) for user_id in pk_set]
+		_apply_like_changes(pairs, 1, submissions=_known_submission(instance, reverse))
+	elif action in ("post_remove", "post_clear"):
+		removed_likes = getattr(instance, "_removed_likes", [])
+		_apply_like_changes(removed_likes, -1, submissions=_known_submission(instance, reverse))
+		instance._removed_likes = []
+
+
+def _known_submission(instance, reverse):
+	""" If the m2m change was made from the submission side, we already know who submitted it and to which contest """
+	if reverse:
+		return None
+	return {instance.pk: (instance.submitted_by_id, instance.contest_id)}
+
+
+def _apply_like_changes(pairs, sign, *, submissions=None, count_given=True):
+	""" Apply a batch of added (sign=1) or removed (sign=-1) likes, given as (submission_id, user_id) pairs
+
+	This updates Submission.like_count as well as the submitters' and likers' UserStats, and expires
+	the cached pages for the submissions' contests and submitters.  m2m_changed is sent inside the
+	same transaction as the join table change, so the counters can't be committed without it (or
+	vice versa).
+	"""
+	if not pairs:
+		return
+
+	if submissions is None:
+		submission_ids = {submission_id for submission_id, _ in pairs}
+		submissions = {
+			submission_id: (submitted_by_id, contest_id)
+			for submission_id, submitted_by_id, contest_id in Submission.objects.filter(
+				id__in=submission_ids
+			).values_list("id", "submitted_by_id", "contest_id")
+		}
+	submitters = {submission_id: submitted_by_id for submission_id, (submitted_by_id, _) in submissions.items()}
+
+	for submission_id, count in Counter(submission_id for submission_id, _ in pairs).items():
+		Submission.objects.filter(id=submission_id).update(like_count=F("like_count") + sign*count)
+
+	received = Counter(submitters.get(submission_id) for submission_id, _ in pairs)
+	for user_id, count in received.items():
+		UserStats.objects.adjust(user_id, total_likes=sign*count)
+
+	if count_given:
+		for user_id, count in Counter(user_id for _, user_id in pairs).items():
+			UserStats.objects.adjust(user_id, clues_liked=sign*count)
+
+	_expire_cached_pages(
+		contest_ids=[contest_id for _, contest_id in submissions.values()], user_ids=submitters.values()
+	)
+
+
+def _saved_value(instance, field, raw, update_fields):
+	""" The value field has in the database (the ID, for a foreign key), before the save that's about to happen
+
+	For new rows, and saves whose update_fields leave the field out, that's just the value being saved.
+	"""
+	attname = instance._meta.get_field(field).attname
+	if raw or instance._state.adding or (update_fields is not None and field not in update_fields):
+		return getattr(instance, attname)
+	return type(instance)._default_manager.filter(pk=instance.pk).values_list(attname, flat=True).first()
+
+
+def _expire_cached_pages(contest_ids=(), user_ids=(), contest_lists=False):
+	""" Once the current transaction commits, bump the version counters of the given contests and users, and the
+	leaderboard's
+
+	Waiting for the commit means no other request can cache the old data under the new versions.
+	"""
+	keys = [caching.version_key(caching.LEADERBOARD)]
+	if contest_lists:
+		keys.append(caching.version_key(caching.CONTEST_LISTS))
+	keys.extend(caching.version_key(caching.CONTEST, contest_id) for contest_id in contest_ids if contest_id)
+	keys.extend(caching.version_key(caching.USER, user_id) for user_id in user_ids if user_id)
+	transaction.on_commit(partial(caching.bump_versions, *keys))
@@ -36,3 +36,32 @@ document.getElementById("repeats_link").addEventListener("click", async function
 	}
 
 })
+
+// As the word is typed, list existing contests that start the same way (answered from an in-memory
+// index on the server, so this is cheap to do on every keystroke)
+let autocomplete_timer = null
+document.getElementById("new_contest_word").addEventListener("input", function(e){
+	clearTimeout(autocomplete_timer)
+	autocomplete_timer = setTimeout(async function(){
+		const repeats_target_element = document.getElementById("repeats_target")
+		const word = e.target.value.toUpperCase().replace(/\s*\(.*$/, "")  // Ignore a (partial) enumeration
+
+		if (word.length < 3) {
+			repeats_target_element.innerText = ""
+			return
+		}
+
+		const url = "/contest/autocomplete?" + new URLSearchParams({"search": word}).toString()
+		let res = await fetch(url)
+		if (!res.ok) { return }
+		let json = await res.json()
+
+		repeats_target_element.classList.remove("warning")
+		if (json.contests.length) {
+			let links = json.contests.map(contest => `<a href="${contest.url}">${contest.word.replace(/</g, "&lt;")}</a>`)
+			repeats_target_element.innerHTML = "Existing contests: " + links.join(", ") + (json.more ? ", ..." : "")
+		} else {
+			repeats_target_element.innerText = ""
+		}
+	}, 150)
+})
@@ -0,0 +1,61 @@
+// Load the next page of the archives from archives.json and add it to the table, rather than
+// following the "More" link to a new page
+const load_more_element = document.getElementById("load_more")
+
+function link_to(url, text) {
+	const link = document.createElement("a")
+	link.href = url
+	link.textContent = text
+	return link
+}
+
+function add_contest_row(contest, row_number) {
+	const row = document.createElement("tr")
+	row.className = row_number % 2 ? "row2" : "row1"
+
+	const cells = [link_to(contest.url, contest.word), link_to(contest.started_by.url, contest.started_by.username), contest.started_at_display]
+	if (contest.winner) {
+		cells.push(link_to(contest.winner.user.url, contest.winner.user.username), contest.winner.clue)
+	}
+	for (const content of cells) {
+		const cell = document.createElement("td")
+		cell.append(content)
+		row.append(cell)
+	}
+
+	if (contest.winner) {
+		const explanation = document.createElement("td")
+		contest.winner.explanation.split("\n").forEach(function(line, i){
+			if (i) { explanation.append(document.createElement("br")) }
+			explanation.append(line)
+		})
+		explanation.className = "explanation"
+		explanation.addEventListener("click", function(){ click_to_reveal(explanation) })
+		row.append(explanation)
+	}
+
+	document.getElementById("archive_rows").append(row)
+}
+
+if (load_more_element) {
+	load_more_element.addEventListener("click", async function(e){
+		e.preventDefault()
+
+		const url = "/archives.json?" + new URLSearchParams({"after": load_more_element.dataset.next}).toString()
+		let res = await fetch(url)
+		if (!res.ok) { return }
+		let json = await res.json()
+
+		let row_number = document.getElementById("archive_rows").rows.length
+		for (const contest of json.contests) {
+			add_contest_row(contest, row_number++)
+		}
+
+		if (json.next) {
+			load_more_element.dataset.next = json.next
+			load_more_element.href = "?after=" + json.next
+		} else {
+			load_more_element.remove()
+		}
+	})
+}
@@ -1,10 +1,35 @@
 """ Celery tasks for the cryptic module """
 import logging
+import time
 
 from celery import shared_task
+from celery.signals import task_failure, task_postrun, task_prerun
+
+from .metrics import registry
 
 logger = logging.getLogger(__name__)
 
+_task_started = {}
+
+
+@task_prerun.connect(dispatch_uid="cryptics_task_prerun_metrics")
+def start_task_timer(task_id=None, **kwargs):
+	_task_started[task_id] = time.perf_counter()
+
+
+@task_postrun.connect(dispatch_uid="cryptics_task_postrun_metrics")
+def record_task_duration(task_id=None, task=None, **kwargs):
+	""" Record how long each task took (see metrics.py); tasks are rare enough to write the metrics out every time """
+	started = _task_started.pop(task_id, None)
+	if started is not None:
+		registry.observe("cryptics_task_duration_seconds", time.perf_counter() - started, task=task.name)
+	registry.flush(force=True)
+
+
+@task_failure.connect(dispatch_uid="cryptics_task_failure_metrics")
+def count_task_failure(sender=None, **kwargs):
+	registry.inc("cryptics_task_failures_total", task=sender.name)
+
 
 @shared_task(name="update_contest_status")
 def update_contest_status(contest_id):
@@ -17,3 +42,35 @@ def update_contest_status(contest_id):
 		pass
 	else:
 		contest.check_if_too_old()
+
+
+@shared_task(name="sweep_contests")
+def sweep_contests():
+	""" Move every contest that's past a phase boundary on to its next phase
+
+	This runs periodically from Celery beat (see CELERY_BEAT_SCHEDULE in settings.py) and replaces
+	the per-contest ETA tasks that used to be queued for update_contest_status.
+	"""
+	from apps.cryptics.models import Contest  # Imported here to avoid a circular import
+	switched, closed = Contest.objects.sweep()
+	logger.info("Swept contests: %d switched to voting, %d closed", len(switched), len(closed))
+
+
+@shared_task(name="deliver_discord_messages")
+def deliver_discord_messages():
+	""" Post any queued Discord messages that are due
+
+	This is started whenever a message is queued, and also runs periodically from Celery beat to
+	pick up retries and anything queued while the broker was unavailable.
+	"""
+	from apps.cryptics.models import DiscordMessage  # Imported here to avoid a circular import
+	sent = DiscordMessage.objects.deliver_due()
+	if sent:
+		logger.info("Delivered %d Discord messages", sent)
+
+
+@shared_task(name="rebuild_wordplay_index")
+def rebuild_wordplay_index():
+	""" Rebuild the anagram and letter-pattern index, to pick up the day's new contest words """
+	from apps.cryptics.wordplay import rebuild_wordplay_index as rebuild  # Imported here to avoid a circular import
+	logger.info("Rebuilt the wordplay index with %d words", rebuild())
@@ -0,0 +1,338 @@
+""" Test the version-keyed page and queryset cache, and the signal handlers that expire it """
+import datetime
+from http import HTTPStatus
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+from django.utils import timezone
+from parameterized import parameterized
+
+from .. import caching
+from ..models import Contest, Submission, RECENT_LENGTH, SUBMISSIONS_LENGTH, VOTING_LENGTH
+
+
+@override_settings(VIEW_CACHE_TIMEOUT=300)
+@mock.patch("apps.cryptics.models.to_discord")
+class ViewCacheTestCase(TestCase):
+	""" Test caching pages and querysets under version counters """
+	def setUp(self):
+		cache.clear()
+		self.setter = User.objects.create_user(username="setter")
+		self.solver = User.objects.create_user(username="solver", password="password")
+		self.contest = Contest.objects.create(word="EXAMPLE (7)", started_by=self.setter)
+		self.submission = Submission.objects.create(
+			clue="Clue", explanation="Explanation", contest=self.contest, submitted_by=self.setter
+		)
+
+	def vote(self):
+		""" Move the contest into its voting phase """
+		Contest.objects.filter(id=self.contest.id).update(
+			created_at=timezone.now() - SUBMISSIONS_LENGTH - datetime.timedelta(minutes=1)
+		)
+		self.contest.refresh_from_db()
+
+	def test_anonymous_pages_are_cached_until_something_changes(self, _):
+		url = reverse("cryptics:all_users")
+		self.client.get(url)
+		with self.assertNumQueries(0):
+			res = self.client.get(url)
+		self.assertEqual(res.status_code, HTTPStatus.OK)
+
+		with self.captureOnCommitCallbacks(execute=True):
+			Submission.objects.create(
+				clue="Another clue", explanation="Explanation", contest=self.contest, submitted_by=self.solver
+			)
+		res = self.client.get(url)
+		self.assertContains(res, "solver")
+
+	def test_logged_in_pages_are_not_cached(self, _):
+		""" Logged-in users see their own version of the page, but the querysets behind it are still cached """
+		self.client.login(username="solver", password="password")
+		url = reverse("cryptics:all_users")
+		self.client.get(url)
+		with self.assertNumQueries(2):  # The session and the user
+			res = self.client.get(url)
+		self.assertContains(res, "setter")
+
+	def test_user_page_only_expires_for_that_user(self, _):
+		setter_url = reverse("cryptics:show_user", kwargs={"user_id": self.setter.id})
+		solver_url = reverse("cryptics:show_user", kwargs={"user_id": self.solver.id})
+		self.client.get(setter_url)
+		self.client.get(solver_url)
+
+		with self.captureOnCommitCallbacks(execute=True):
+			Contest.objects.create(word="ANOTHER (7)", started_by=self.solver)
+
+		with self.assertNumQueries(0):
+			self.client.get(setter_url)
+		self.assertContains(self.client.get(solver_url), "ANOTHER (7)")
+
+	def test_renaming_a_contest_expires_its_clue_setters_pages(self, _):
+		""" User pages show the words of the contests their clues were for """
+		Contest.objects.filter(id=self.contest.id).update(status=Contest.CLOSED)
+		self.contest.refresh_from_db()
+		self.contest.submissions.create(clue="Solver's clue", explanation="", submitted_by=self.solver)
+		url = reverse("cryptics:show_user", kwargs={"user_id": self.solver.id})
+		self.assertContains(self.client.get(url), "EXAMPLE (7)")
+
+		with self.captureOnCommitCallbacks(execute=True):
+			self.contest.word = "RENAMED (7)"
+			self.contest.save()
+		self.assertContains(self.client.get(url), "RENAMED (7)")
+
+	def test_likes_expire_the_contest(self, _):
+		""" The submissions shown to logged-out visitors are cached per contest, and expired by likes """
+		self.vote()
+		url = self.contest.get_absolute_url()
+		self.client.get(url)
+		with self.assertNumQueries(1):  # Just the contest
+			self.client.get(url)
+
+		with self.captureOnCommitCallbacks(execute=True):
+			self.submission.add_like(self.solver)
+		Contest.objects.filter(id=self.contest.id).update(status=Contest.CLOSED)
+
+		res = self.client.get(url)
+		self.assertContains(res, "solver")
+
+	def test_declaring_winners_expires_pages(self, _):
+		""" Winners are saved with bulk_update, which doesn't send post_save """
+		contest_key = caching.version_key(caching.CONTEST, self.contest.id)
+		before = caching.get_versions(contest_key, caching.version_key(caching.USER, self.setter.id))
+
+		with self.captureOnCommitCallbacks(execute=True):
+			Contest.objects.declare_winners(announce=False)
+
+		after = caching.get_versions(contest_key, caching.version_key(caching.USER, self.setter.id))
+		self.assertEqual(after, [version + 1 for version in before])
+
+	def test_logging_in_does_not_expire_pages(self, _):
+		key = caching.version_key(caching.USER, self.solver.id)
+		before = caching.get_version(key)
+		with self.captureOnCommitCallbacks(execute=True):
+			self.client.login(username="solver", password="password")
+		self.assertEqual(caching.get_version(key), before)
+
+	def test_cached_until_next_phase_change(self, _):
+		""" Pages that show contests' phases expire when the next contest changes phase """
+		self.assertEqual(Contest.objects.next_phase_change(), self.contest.submissions_end_time)
+		self.vote()
+		self.assertEqual(Contest.objects.next_phase_change(), self.contest.voting_end_time)
+		self.assertEqual(self.contest.next_phase_change, self.contest.voting_end_time)
+
+		Contest.objects.filter(id=self.contest.id).update(
+			created_at=timezone.now() - SUBMISSIONS_LENGTH - VOTING_LENGTH - datetime.timedelta(minutes=1)
+		)
+		self.assertIsNone(Contest.objects.next_phase_change())
+
+		soon = timezone.now() + datetime.timedelta(seconds=30)
+		self.assertLessEqual(caching.timeout_until(soon), 30)
+		self.assertEqual(caching.timeout_until(None), 300)
+
+
+@override_settings(VIEW_CACHE_TIMEOUT=300)
+class ClosedContestCacheTestCase(TestCase):
+	""" Test the pre-rendered clues on closed contest pages """
+	def setUp(self):
+		cache.clear()
+		self.users = [User.objects.create_user(username=f"user_{i}", password="password") for i in range(3)]
+		self.contest = Contest.objects.create(word="EXAMPLE (7)", started_by=self.users[0], status=Contest.CLOSED)
+		self.clues = [
+			self.contest.submissions.create(clue=f"Clue {i}", explanation=f"Explanation {i}", submitted_by=self.users[0])
+			for i in range(3)
+		]
+		self.clues[1].likers.add(self.users[1], self.users[2])
+		self.url = self.contest.get_absolute_url()
+		self.client.get(self.url)
+
+	def test_closed_contest_is_rendered_once(self):
+		""" After the first view, the clues, likes, and likers come from the cache """
+		with self.assertNumQueries(1):  # Just the contest
+			res = self.client.get(self.url)
+		self.assertContains(res, '<td title="user_1, user_2">2</td>')
+		content = res.content.decode("utf-8")
+		self.assertLess(content.index("Clue 1"), content.index("Clue 0"))
+
+	def test_viewer_overlay(self):
+		""" Logged-in viewers get their own stars and see their own explanations, for one more small query """
+		self.client.login(username="user_1", password="password")
+		with self.assertNumQueries(4):  # The session, the user, the contest, and which clues they liked
+			res = self.client.get(self.url)
+		self.assertContains(res, "You liked this clue", count=1)
+		self.assertContains(res, "You didn't like this clue", count=2)
+
+		self.client.login(username="user_0", password="password")
+		res = self.client.get(self.url)
+		self.assertNotContains(res, 'class="explanation"')
+		self.assertNotContains(res, "like this clue")
+
+	def test_admin_edits_expire_the_page(self):
+		with self.captureOnCommitCallbacks(execute=True):
+			self.clues[0].clue = "Corrected clue"
+			self.clues[0].save()
+		self.assertContains(self.client.get(self.url), "Corrected clue")
+
+		User.objects.filter(id=self.users[2].id).update(username="renamed")
+		admin = User.objects.create_superuser(username="admin", password="password")
+		self.client.force_login(admin)
+		self.client.post(
+			reverse("admin:cryptics_contest_changelist"),
+			{"action": "expire_cached_pages", "_selected_action": [self.contest.id]},
+		)
+		self.client.logout()
+		self.assertContains(self.client.get(self.url), '<td title="renamed, user_1">2</td>')
+
+	@override_settings(VIEW_CACHE_TIMEOUT=300)
+	def test_renaming_a_user_expires_the_page(self):
+		""" The rows show the names of the clues' setters and likers, and so does the setter's page """
+		setter_url = reverse("cryptics:show_user", kwargs={"user_id": self.users[0].id})
+		self.client.get(setter_url)
+		with self.captureOnCommitCallbacks(execute=True):
+			for user, username in ((self.users[0], "setter"), (self.users[2], "liker")):
+				user.username = username
+				user.save()
+
+		res = self.client.get(self.url)
+		self.assertContains(res, '<td title="liker, user_1">2</td>')
+		self.assertNotContains(res, "user_0")
+		self.assertContains(self.client.get(setter_url), 'title="liker, user_1"')
+
+
+@override_settings(VIEW_CACHE_TIMEOUT=300)
+@mock.patch("apps.cryptics.models.to_discord")
+class IndexCacheTestCase(TestCase):
+	""" Test caching the main page's contest lists until the next phase change """
+	def setUp(self):
+		cache.clear()
+		self.user = User.objects.create_user(username="user")
+		self.contest = Contest.objects.create(word="EXAMPLE (7)", started_by=self.user)
+		self.url = reverse("cryptics:index")
+
+	def test_index_is_served_from_the_cache(self, _):
+		self.client.get(self.url)
+		with self.assertNumQueries(0):
+			res = self.client.get(self.url)
+		self.assertEqual(res.context["open_contests"], [self.contest])
+
+	def test_logged_in_index_looks_up_likes_once(self, _):
+		""" However many recent clues there are, whether the viewer liked them is a single query """
+		viewer = User.objects.create_user(username="viewer")
+		Contest.objects.filter(id=self.contest.id).update(status=Contest.VOTING)
+		clues = [
+			self.contest.submissions.create(clue=f"Clue {i}", explanation="", submitted_by=self.user) for i in range(3)
+		]
+		clues[1].likers.add(viewer)
+		self.client.force_login(viewer)
+		self.client.get(self.url)
+
+		with self.assertNumQueries(3):  # The session, the user, and which clues they liked
+			res = self.client.get(self.url)
+		self.assertEqual(res.context["liked_ids"], {clues[1].id})
+		self.assertContains(res, 'title="Un-like this clue?"', count=1)
+		self.assertContains(res, 'title="Like this clue?"', count=2)
+
+	def test_contest_lists_expire_exactly_at_the_phase_change(self, _):
+		self.client.get(self.url)
+		end = self.contest.submissions_end_time
+
+		with mock.patch("django.utils.timezone.now", return_value=end - datetime.timedelta(milliseconds=1)):
+			res = self.client.get(self.url)
+		self.assertEqual(res.context["open_contests"], [self.contest])
+
+		with mock.patch("django.utils.timezone.now", return_value=end + datetime.timedelta(milliseconds=1)):
+			res = self.client.get(self.url)
+		self.assertEqual(res.context["open_contests"], [])
+		self.assertEqual(res.context["voting_contests"], [self.contest])
+
+	def test_new_contests_expire_the_contest_lists(self, _):
+		self.client.get(self.url)
+		with self.captureOnCommitCallbacks(execute=True):
+			contest = Contest.objects.add(word="another", started_by=self.user)
+		res = self.client.get(self.url)
+		self.assertEqual(res.context["open_contests"], [self.contest, contest])
+
+	def test_likes_do_not_expire_the_contest_lists(self, _):
+		""" Clues and likes only expire the champion and recent clues """
+		self.client.get(self.url)
+		with self.captureOnCommitCallbacks(execute=True):
+			Submission.objects.create(clue="New clue", explanation="", contest=self.contest, submitted_by=self.user)
+		with self.assertNumQueries(2):  # The champion and the recent clues
+			res = self.client.get(self.url)
+		self.assertContains(res, "New clue")
+
+	def test_next_recent_change(self, _):
+		""" Closed contests drop off the main page a week after they close """
+		Contest.objects.filter(id=self.contest.id).update(status=Contest.CLOSED)
+		self.assertEqual(
+			Contest.objects.next_recent_change(),
+			self.contest.created_at + SUBMISSIONS_LENGTH + VOTING_LENGTH + RECENT_LENGTH,
+		)
+
+
+@override_settings(VIEW_CACHE_TIMEOUT=300)
+class ConditionalGetTestCase(TestCase):
+	""" Test answering repeat visits with 304 Not Modified """
+	def setUp(self):
+		cache.clear()
+		self.users = [User.objects.create_user(username=f"user_{i}", password="password") for i in range(2)]
+		self.contest = Contest.objects.create(word="EXAMPLE (7)", started_by=self.users[0], status=Contest.VOTING)
+		self.submission = self.contest.submissions.create(clue="Clue", explanation="", submitted_by=self.users[0])
+		self.url = self.contest.get_absolute_url()
+
+	def revisit(self, url, res):
+		return self.client.get(url, HTTP_IF_NONE_MATCH=res["ETag"])
+
+	def test_unchanged_page_is_not_rendered(self):
+		res = self.client.get(self.url)
+		self.assertEqual(res.status_code, HTTPStatus.OK)
+		self.assertIn("ETag", res)
+
+		with self.assertNumQueries(0):
+			second = self.revisit(self.url, res)
+		self.assertEqual(second.status_code, HTTPStatus.NOT_MODIFIED)
+		self.assertEqual(second.templates, [])
+		self.assertEqual(second.content, b"")
+
+	def test_changes_give_a_new_etag(self):
+		res = self.client.get(self.url)
+		with self.captureOnCommitCallbacks(execute=True):
+			self.submission.add_like(self.users[1])
+		self.assertEqual(self.revisit(self.url, res).status_code, HTTPStatus.OK)
+
+	def test_each_viewer_gets_their_own_etag(self):
+		res = self.client.get(self.url)
+		self.client.login(username="user_1", password="password")
+		second = self.revisit(self.url, res)
+		self.assertEqual(second.status_code, HTTPStatus.OK)
+		self.assertEqual(self.revisit(self.url, second).status_code, HTTPStatus.NOT_MODIFIED)
+
+	def test_phase_changes_give_a_new_etag(self):
+		res = self.client.get(self.url)
+		after_voting = self.contest.voting_end_time + datetime.timedelta(seconds=1)
+		with mock.patch("django.utils.timezone.now", return_value=after_voting):
+			self.assertEqual(self.revisit(self.url, res).status_code, HTTPStatus.OK)
+
+	@parameterized.expand([("all_users", False), ("all_closed_contests", False), ("show_user", True)])
+	def test_if_modified_since(self, view, takes_user):
+		url = reverse(f"cryptics:{view}", kwargs={"user_id": self.users[0].id} if takes_user else None)
+		res = self.client.get(url)
+		self.assertIn("Last-Modified", res)
+
+		second = self.client.get(url, HTTP_IF_MODIFIED_SINCE=res["Last-Modified"])
+		self.assertEqual(second.status_code, HTTPStatus.NOT_MODIFIED)
+		self.assertEqual(second.templates, [])
+
+	def test_if_modified_since_is_not_used_for_logged_in_viewers(self):
+		""" Last-Modified doesn't say who a page was for, so logging in can't get a 304 for the anonymous page """
+		url = reverse("cryptics:all_users")
+		res = self.client.get(url)
+		self.assertIn("Cookie", res["Vary"])
+
+		self.client.login(username="user_1", password="password")
+		second = self.client.get(url, HTTP_IF_MODIFIED_SINCE=res["Last-Modified"])
+		self.assertEqual(second.status_code, HTTPStatus.OK)
+		self.assertNotIn("Last-Modified", second)
+		self.assertIn("Cookie", second["Vary"])
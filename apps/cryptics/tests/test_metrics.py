@@ -0,0 +1,124 @@
+""" Test the Prometheus metrics: counting them, adding them up across processes, and serving them """
+import json
+import os
+import socket
+import tempfile
+from http import HTTPStatus
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from .. import caching
+from ..metrics import ARCHIVE_FILE, collect, registry, render
+from ..tasks import sweep_contests
+from ..utils import get_webhook_client, post_to_discord
+from .webhook_stub import StubWebhookServer
+
+
+class MetricsTestCase(TestCase):
+	""" Base class that turns metrics on, in a directory of their own, starting from zero """
+	def setUp(self):
+		self.directory = self.enterContext(tempfile.TemporaryDirectory())
+		self.enterContext(override_settings(METRICS_DIR=self.directory, METRICS_TOKEN="token"))
+		registry.clear()
+		self.addCleanup(registry.clear)
+
+	def scrape(self):
+		response = self.client.get(reverse("cryptics:metrics"), headers={"Authorization": "Bearer token"})
+		self.assertEqual(response.status_code, HTTPStatus.OK)
+		return response.content.decode()
+
+
+class RegistryTestCase(MetricsTestCase):
+	""" Test counting metrics and adding them up """
+	def test_render(self):
+		""" Histogram buckets are cumulative, and label values are escaped """
+		registry.observe("cryptics_request_queries", 2, view="cryptics:index")
+		registry.observe("cryptics_request_queries", 4, view="cryptics:index")
+		registry.inc("cryptics_cache_requests_total", cache='say "hi"', result="hit")
+		output = render(*collect())
+
+		self.assertIn("# TYPE cryptics_request_queries histogram\n", output)
+		self.assertIn('cryptics_request_queries_bucket{view="cryptics:index",le="1"} 0\n', output)
+		self.assertIn('cryptics_request_queries_bucket{view="cryptics:index",le="2"} 1\n', output)
+		self.assertIn('cryptics_request_queries_bucket{view="cryptics:index",le="5"} 2\n', output)
+		self.assertIn('cryptics_request_queries_bucket{view="cryptics:index",le="+Inf"} 2\n', output)
+		self.assertIn('cryptics_request_queries_sum{view="cryptics:index"} 6\n', output)
+		self.assertIn('cryptics_request_queries_count{view="cryptics:index"} 2\n', output)
+		self.assertIn('cryptics_cache_requests_total{cache="say \\"hi\\"",result="hit"} 1\n', output)
+
+	def test_processes_are_added_up(self):
+		""" Every process's file counts, and those of processes that have exited are folded into the archive """
+		other = {"counters": [["cryptics_task_failures_total", [["task", "sweep_contests"]], 2]], "histograms": []}
+		running = os.path.join(self.directory, f"{socket.gethostname()}-{os.getpid()}-1.json")
+		exited = os.path.join(self.directory, f"{socket.gethostname()}-999999999-1.json")
+		for path in (running, exited):
+			with open(path, "w", encoding="utf-8") as f:
+				json.dump(other, f)
+		registry.inc("cryptics_task_failures_total", task="sweep_contests")
+
+		for _ in range(2):  # The totals stay the same once the exited process has been archived
+			output = render(*collect())
+			self.assertIn('cryptics_task_failures_total{task="sweep_contests"} 5\n', output)
+		self.assertFalse(os.path.exists(exited))
+		self.assertTrue(os.path.exists(running))
+		self.assertTrue(os.path.exists(os.path.join(self.directory, ARCHIVE_FILE)))
+
+
+class MetricsViewTestCase(MetricsTestCase):
+	""" Test who can see the metrics, and what's recorded in them """
+	def test_access(self):
+		url = reverse("cryptics:metrics")
+		self.assertEqual(self.client.get(url).status_code, HTTPStatus.FORBIDDEN)
+		self.assertEqual(self.client.get(url, headers={"Authorization": "Bearer wrong"}).status_code, HTTPStatus.FORBIDDEN)
+		self.assertEqual(self.client.get(url, headers={"Authorization": "Bearer token"}).status_code, HTTPStatus.OK)
+
+		user = User.objects.create_user(username="user")
+		self.client.force_login(user)
+		self.assertEqual(self.client.get(url).status_code, HTTPStatus.FORBIDDEN)
+		user.is_staff = True
+		user.save()
+		response = self.client.get(url)
+		self.assertEqual(response.status_code, HTTPStatus.OK)
+		self.assertEqual(response["Content-Type"], "text/plain; version=0.0.4; charset=utf-8")
+
+		with override_settings(METRICS_DIR=""):
+			self.assertEqual(self.client.get(url).status_code, HTTPStatus.NOT_FOUND)
+
+	def test_requests_are_recorded(self):
+		self.client.get(reverse("cryptics:index"))
+		self.client.get(reverse("cryptics:about"))
+		self.client.get(reverse("cryptics:about"))
+		output = self.scrape()
+		self.assertIn('cryptics_request_duration_seconds_count{method="GET",view="cryptics:about"} 2\n', output)
+		self.assertIn('cryptics_request_queries_count{view="cryptics:index"} 1\n', output)
+		self.assertIn('cryptics_request_query_seconds_count{view="cryptics:index"} 1\n', output)
+
+	@override_settings(VIEW_CACHE_TIMEOUT=300)
+	def test_cache_lookups_are_counted(self):
+		cache.clear()
+		self.addCleanup(cache.clear)
+		for _ in range(3):
+			caching.cached("test:value", [], lambda: 1)
+		output = self.scrape()
+		self.assertIn('cryptics_cache_requests_total{cache="test",result="hit"} 2\n', output)
+		self.assertIn('cryptics_cache_requests_total{cache="test",result="miss"} 1\n', output)
+
+	def test_discord_posts_are_recorded(self):
+		server = self.enterContext(StubWebhookServer(status=HTTPStatus.INTERNAL_SERVER_ERROR))
+		self.enterContext(override_settings(DISCORD_API_URL=server.url, DISCORD_URLS=["1/one"]))
+		get_webhook_client.cache_clear()
+		self.addCleanup(get_webhook_client.cache_clear)
+		post_to_discord("Hello")
+		output = self.scrape()
+		self.assertIn("cryptics_discord_post_seconds_count 1\n", output)
+		self.assertIn('cryptics_discord_post_failures_total{reason="500"} 1\n', output)
+
+	@mock.patch("apps.cryptics.models.to_discord")
+	def test_tasks_are_timed(self, mock_to_discord):
+		sweep_contests.apply()
+		output = self.scrape()
+		self.assertIn('cryptics_task_duration_seconds_count{task="sweep_contests"} 1\n', output)
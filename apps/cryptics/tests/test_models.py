@@ -1,8 +1,24 @@
 """ Test the models in the cryptics app """
+import datetime
+import json
+import os
+import random
+import tempfile
+from io import StringIO
+from unittest import mock
+
 from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.db import connection
+from django.db.models import Count, F, Sum
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from parameterized import parameterized
 
-from ..models import Contest, Submission
+from .. import caching
+from ..models import SUBMISSIONS_LENGTH, VOTING_LENGTH, Contest, ContestTrigram, Submission, SubmissionTerm, UserStats
+from ..utils import normalize_word, search_terms
 
 
 class UsersTestCase(TestCase):
@@ -74,3 +90,468 @@ class UsersTestCase(TestCase):
         expected_order = [self.user3, self.user2, self.user1]
         actual_order = [user["user"] for user in User.objects.sort_users()]
         self.assertEqual(actual_order, expected_order)
+
+
+class UserStatsTestCase(TestCase):
+    """ Test that UserStats is kept in sync with contests, submissions, and likes """
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f"user_{i}") for i in range(4)]
+        self.contest = Contest.objects.create(word="EXAMPLE (7)", started_by=self.users[0])
+        self.subs = [
+            Submission.objects.create(clue=f"Clue {i}", contest=self.contest, submitted_by=self.users[i % 2])
+            for i in range(4)
+        ]
+        self.subs[0].likers.add(self.users[1], self.users[2], self.users[3])
+        self.subs[1].likers.add(self.users[0])
+        self.users[2].clues_liked.add(self.subs[2], self.subs[3])
+
+    def assert_stats_match_sort_users(self):
+        """ The incrementally maintained stats should agree with the from-scratch calculation """
+        expected = {row["user"].id: row for row in User.objects.sort_users()}
+        stats = UserStats.objects.all()
+        self.assertEqual(len(stats), len(expected))
+        for user_stats in stats:
+            row = expected[user_stats.user_id]
+            for field in ("contests_won", "total_submissions", "total_likes", "clues_liked", "average_likes"):
+                with self.subTest(user=user_stats.user_id, field=field):
+                    self.assertAlmostEqual(getattr(user_stats, field), row[field])
+
+    def test_stats_are_updated_when_likes_are_added(self):
+        """ Adding likes from either side of the relationship updates the stats """
+        self.assert_stats_match_sort_users()
+        self.assertEqual(UserStats.objects.get(user=self.users[0]).total_likes, 4)
+
+    def test_stats_are_updated_when_likes_are_removed(self):
+        """ Removing likes (including ones that didn't exist) updates the stats """
+        self.subs[0].likers.remove(self.users[1], self.users[0])
+        self.users[2].clues_liked.clear()
+        self.assert_stats_match_sort_users()
+
+    def test_stats_are_updated_when_submissions_are_deleted(self):
+        """ Deleting a submission removes it and its likes from the stats """
+        self.subs[0].delete()
+        self.assert_stats_match_sort_users()
+
+    def test_stats_are_updated_when_winner_is_declared(self):
+        """ Contest.declare_winner counts the win for the winning user """
+        with mock.patch("apps.cryptics.models.to_discord"):
+            self.contest.declare_winner()
+        self.assertEqual(UserStats.objects.get(user=self.users[0]).contests_won, 1)
+        self.assert_stats_match_sort_users()
+
+    def test_stats_are_updated_when_submissions_change_hands(self):
+        """ An admin edit that gives a submission (and its likes) to someone else moves it between their stats """
+        self.subs[0].submitted_by = self.users[3]
+        self.subs[0].save()
+        self.assertEqual(UserStats.objects.get(user=self.users[3]).total_likes, 3)
+        self.assert_stats_match_sort_users()
+
+        self.subs[1].clue = "Edited clue"
+        self.subs[1].save(update_fields=["clue"])
+        self.assert_stats_match_sort_users()
+
+    def test_stats_are_updated_when_the_winner_is_changed(self):
+        """ An admin edit that changes a contest's winner moves the win between their stats """
+        with mock.patch("apps.cryptics.models.to_discord"):
+            self.contest.declare_winner()
+        self.contest.refresh_from_db()
+        self.contest.winning_entry = self.subs[1]
+        self.contest.winning_user = self.users[1]
+        self.contest.save()
+        self.assertEqual(UserStats.objects.get(user=self.users[0]).contests_won, 0)
+        self.assertEqual(UserStats.objects.get(user=self.users[1]).contests_won, 1)
+        self.assert_stats_match_sort_users()
+
+        self.contest.word = "RENAMED (7)"
+        self.contest.save(update_fields=["word"])
+        self.assert_stats_match_sort_users()
+
+    def test_rebuild_fixes_drift(self):
+        """ UserStats.objects.rebuild recomputes everything from the source tables """
+        UserStats.objects.update(total_likes=100, average_likes=50)
+        UserStats.objects.filter(user=self.users[3]).delete()
+        UserStats.objects.rebuild()
+        self.assert_stats_match_sort_users()
+
+    def test_leaderboard_order_matches_sort_users(self):
+        """ The leaderboard query returns users in the same order as sort_users """
+        expected_order = [row["user"] for row in User.objects.sort_users()]
+        actual_order = [user_stats.user for user_stats in UserStats.objects.leaderboard()]
+        self.assertEqual(actual_order, expected_order)
+
+
+class LeaderboardValuesTestCase(TestCase):
+    """ Test the single-statement User.objects.leaderboard_values query """
+    def setUp(self):
+        rng = random.Random(10060)
+        users = [User.objects.create_user(username=f"user_{i}") for i in range(15)]
+        for i in range(8):
+            contest = Contest.objects.create(word=f"CONTEST {i} (7 1)", started_by=rng.choice(users))
+            subs = [
+                Submission.objects.create(clue=f"Clue {i}-{j}", contest=contest, submitted_by=rng.choice(users))
+                for j in range(rng.randint(0, 6))
+            ]
+            for sub in subs:
+                sub.likers.add(*rng.sample(users, rng.randint(0, 6)))
+            if subs:
+                winner = rng.choice(subs)
+                contest.winning_entry = winner
+                contest.winning_user = winner.submitted_by
+                contest.save()
+
+    def test_leaderboard_values_matches_sort_users(self):
+        """ leaderboard_values returns the same stats, in the same order, as sort_users """
+        expected = User.objects.sort_users()
+        with self.assertNumQueries(1):
+            actual = list(User.objects.leaderboard_values().iterator())
+
+        fields = {
+            "wins": "contests_won",
+            "total_submissions": "total_submissions",
+            "total_likes": "total_likes",
+            "likes_given": "clues_liked",
+            "average_likes": "average_likes",
+        }
+        expected_by_id = {row["user"].id: row for row in expected}
+        self.assertEqual(len(actual), len(expected))
+        for row in actual:
+            for field, expected_field in fields.items():
+                with self.subTest(user=row["username"], field=field):
+                    self.assertAlmostEqual(row[field], expected_by_id[row["id"]][expected_field])
+
+        # sort_users doesn't specify an order for ties, so compare the sort keys rather than the users
+        actual_keys = [(row["wins"], round(row["average_likes"], 6)) for row in actual]
+        expected_keys = [(row["contests_won"], round(row["average_likes"], 6)) for row in expected]
+        self.assertEqual(actual_keys, expected_keys)
+
+
+class SubmissionLikeCountTestCase(TestCase):
+    """ Test that Submission.like_count stays in sync with the likers relation """
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f"user_{i}") for i in range(3)]
+        contest = Contest.objects.create(word="EXAMPLE (7)", started_by=self.users[0], status=Contest.VOTING)
+        self.sub = Submission.objects.create(clue="Clue (7)", contest=contest, submitted_by=self.users[0])
+
+    def test_like_count_follows_add_like_and_remove_like(self):
+        """ add_like and remove_like update the stored count, ignoring likes that don't exist """
+        self.sub.add_like(self.users[1])
+        self.sub.add_like(self.users[1])
+        self.sub.add_like(self.users[2])
+        self.sub.refresh_from_db()
+        self.assertEqual(self.sub.like_count, 2)
+
+        self.sub.remove_like(self.users[1])
+        self.sub.remove_like(self.users[1])
+        self.sub.refresh_from_db()
+        self.assertEqual(self.sub.like_count, 1)
+
+    def test_like_count_follows_changes_from_the_user_side(self):
+        """ Changing user.clues_liked updates the stored count too """
+        self.users[1].clues_liked.add(self.sub)
+        self.users[2].clues_liked.add(self.sub)
+        self.users[1].clues_liked.clear()
+        self.sub.refresh_from_db()
+        self.assertEqual(self.sub.like_count, 1)
+
+    def test_reconcile_like_counts_fixes_drift(self):
+        """ The reconcile_like_counts command resets drifted counts to the real number of likers """
+        self.sub.likers.add(self.users[1], self.users[2])
+        Submission.objects.update(like_count=7)
+
+        keys = [
+            caching.version_key(caching.CONTEST, self.sub.contest_id),
+            caching.version_key(caching.USER, self.sub.submitted_by_id),
+            caching.version_key(caching.LEADERBOARD),
+        ]
+        versions = caching.get_versions(*keys)
+
+        out = StringIO()
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("reconcile_like_counts", "--dry-run", stdout=out)
+        self.assertIn("stored 7, actual 2", out.getvalue())
+        self.sub.refresh_from_db()
+        self.assertEqual(self.sub.like_count, 7)
+        self.assertEqual(caching.get_versions(*keys), versions)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command("reconcile_like_counts", stdout=StringIO())
+        self.sub.refresh_from_db()
+        self.assertEqual(self.sub.like_count, 2)
+        # The pages showing the counts are expired, as the signals would have done
+        for old, new in zip(versions, caching.get_versions(*keys)):
+            self.assertGreater(new, old)
+
+
+class ContestEffectiveStatusTestCase(TestCase):
+    """ Test Contest.effective_status and its SQL equivalent """
+    def setUp(self):
+        self.user = User.objects.create_user(username="user")
+
+    def make_contest(self, age, status):
+        contest = Contest.objects.create(word="EXAMPLE (7)", started_by=self.user, status=status)
+        Contest.objects.filter(id=contest.id).update(created_at=timezone.now() - age)
+        contest.refresh_from_db()
+        return contest
+
+    @parameterized.expand([
+        ("new", datetime.timedelta(hours=1), Contest.SUBMISSIONS, Contest.SUBMISSIONS),
+        ("past_submissions", SUBMISSIONS_LENGTH + datetime.timedelta(hours=1), Contest.SUBMISSIONS, Contest.VOTING),
+        ("voting", SUBMISSIONS_LENGTH + datetime.timedelta(hours=1), Contest.VOTING, Contest.VOTING),
+        ("past_voting", SUBMISSIONS_LENGTH + VOTING_LENGTH + datetime.timedelta(hours=1), Contest.SUBMISSIONS,
+            Contest.CLOSED),
+        ("closed_early", datetime.timedelta(hours=1), Contest.CLOSED, Contest.CLOSED),
+        ("voting_early", datetime.timedelta(hours=1), Contest.VOTING, Contest.VOTING),
+    ])
+    def test_effective_status(self, _name, age, stored_status, expected_status):
+        """ The property and the queryset annotation agree, and neither changes the stored status """
+        contest = self.make_contest(age, stored_status)
+        self.assertEqual(contest.effective_status, expected_status)
+
+        annotated = Contest.objects.annotate_effective_status().get(id=contest.id)
+        self.assertEqual(annotated.current_status, expected_status)
+        self.assertTrue(Contest.objects.with_effective_status(expected_status).filter(id=contest.id).exists())
+
+        contest.refresh_from_db()
+        self.assertEqual(contest.status, stored_status)
+
+    @mock.patch("apps.cryptics.models.to_discord")
+    def test_check_if_too_old_persists_status_and_winner(self, mock_discord):
+        """ The background task path (check_if_too_old) writes the status and declares a winner """
+        contest = self.make_contest(SUBMISSIONS_LENGTH + VOTING_LENGTH + datetime.timedelta(hours=1), Contest.VOTING)
+        submission = contest.submissions.create(clue="Clue (7)", submitted_by=self.user)
+
+        contest.check_if_too_old()
+
+        contest.refresh_from_db()
+        self.assertEqual(contest.status, Contest.CLOSED)
+        self.assertEqual(contest.winning_entry, submission)
+        mock_discord.assert_called_once()
+
+
+class DeclareWinnersTestCase(TestCase):
+    """ Test the bulk ContestQuerySet.declare_winners method """
+    def setUp(self):
+        self.users = [User.objects.create_user(username=f"user_{i}") for i in range(3)]
+        self.contests = Contest.objects.bulk_create(
+            [Contest(word=f"CONTEST {i} (7 1)", started_by=self.users[0], status=Contest.CLOSED) for i in range(200)]
+        )
+        self.expected_winners = {}
+        for i, contest in enumerate(self.contests):
+            subs = Submission.objects.bulk_create([
+                Submission(clue=f"Clue {i}-{j}", contest=contest, submitted_by=self.users[j], like_count=like_count)
+                for j, like_count in enumerate([i % 3, 1, 2])
+            ])
+            # Ties go to the earliest submission
+            self.expected_winners[contest.id] = subs[0] if i % 3 == 2 else subs[2]
+
+    @mock.patch("apps.cryptics.models.to_discord")
+    def test_declare_winners_picks_the_top_submission_for_every_contest(self, mock_discord):
+        """ Every contest gets its most-liked submission (earliest on ties) as the winner """
+        declared = Contest.objects.declare_winners()
+
+        self.assertEqual(len(declared), len(self.contests))
+        self.assertEqual(mock_discord.call_count, len(self.contests))
+        for contest in Contest.objects.all():
+            with self.subTest(contest=contest.word):
+                self.assertEqual(contest.winning_entry_id, self.expected_winners[contest.id].id)
+                self.assertEqual(contest.winning_user_id, self.expected_winners[contest.id].submitted_by_id)
+
+        wins = {stats.user_id: stats.contests_won for stats in UserStats.objects.all()}
+        self.assertEqual(wins[self.users[0].id], len(self.contests) // 3)
+        self.assertEqual(wins[self.users[2].id], len(self.contests) - len(self.contests) // 3)
+
+    @mock.patch("apps.cryptics.models.to_discord")
+    def test_declare_winners_uses_a_handful_of_queries(self, mock_discord):
+        """ The number of queries depends on the number of distinct winners, not the number of contests
+
+        That's one query to find every winner, the bulk update (which SQLite splits into a couple of batches), one
+        query to fetch the declared contests, one UserStats update per winning user, and the savepoint around it all.
+        """
+        with CaptureQueriesContext(connection) as queries:
+            Contest.objects.declare_winners(announce=False)
+        self.assertLess(len(queries), 10)
+        mock_discord.assert_not_called()
+
+    @mock.patch("apps.cryptics.models.to_discord")
+    def test_declare_winners_skips_contests_that_already_have_one(self, mock_discord):
+        """ Running declare_winners twice doesn't change or re-announce any winners """
+        Contest.objects.declare_winners()
+        mock_discord.reset_mock()
+
+        self.assertEqual(Contest.objects.declare_winners(), [])
+        mock_discord.assert_not_called()
+
+
+class ContestSearchTestCase(TestCase):
+    """ Test Contest.objects.search and the trigram index behind it """
+    def setUp(self):
+        self.user = User.objects.create_user(username="user")
+
+    @parameterized.expand([
+        ("Café  au lait (4,2,4)", "CAFE AU LAIT"),
+        ("  lower case\tword (5,4)", "LOWER CASE WORD"),
+        ("NO ENUMERATION", "NO ENUMERATION"),
+        ("(5)", ""),
+    ])
+    def test_normalize_word(self, word, expected):
+        self.assertEqual(normalize_word(word), expected)
+
+    def test_trigrams_follow_word_changes(self):
+        """ Saving a contest with a new word replaces its trigrams """
+        contest = Contest.objects.create(word="ABCD (4)", started_by=self.user)
+        self.assertEqual(set(contest.trigrams.values_list("trigram", flat=True)), {"ABC", "BCD"})
+
+        contest.word = "WXYZ (4)"
+        contest.save(update_fields=["word"])
+
+        contest.refresh_from_db()
+        self.assertEqual(contest.search_word, "WXYZ")
+        self.assertEqual(set(contest.trigrams.values_list("trigram", flat=True)), {"WXY", "XYZ"})
+        self.assertEqual(list(Contest.objects.search("ABC")), [])
+        self.assertEqual(list(Contest.objects.search("xyz")), [contest])
+
+    def test_search_needs_every_trigram_in_order(self):
+        """ A contest with all the trigrams of the search, but not as one substring, isn't a match """
+        Contest.objects.create(word="ABCX BCD (4,3)", started_by=self.user)
+        match = Contest.objects.create(word="XABCDX (6)", started_by=self.user)
+
+        self.assertEqual(list(Contest.objects.search("ABCD")), [match])
+
+    def test_short_searches(self):
+        """ Searches shorter than a trigram still work """
+        contest = Contest.objects.create(word="AB CD (2,2)", started_by=self.user)
+        self.assertEqual(list(Contest.objects.search("b")), [contest])
+        self.assertEqual(list(Contest.objects.search("b c")), [contest])
+        self.assertEqual(list(Contest.objects.search("(2)")), [])
+
+    def test_search_ranks_exact_matches_first_and_counts_all_matches(self):
+        """ Exact matches come before older partial ones, and total counts matches beyond the slice """
+        for i in range(5):
+            Contest.objects.create(word=f"TESTING {i} (7,1)", started_by=self.user)
+        exact = Contest.objects.create(word="Testing (7)", started_by=self.user)
+
+        results = list(Contest.objects.search("TESTING")[:3])
+
+        self.assertEqual(results[0], exact)
+        self.assertEqual([result.total for result in results], [6, 6, 6])
+
+    def test_rebuild_search_index(self):
+        """ The rebuild command recreates missing index rows """
+        contest = Contest.objects.create(word="REBUILD (7)", started_by=self.user)
+        ContestTrigram.objects.all().delete()
+        Contest.objects.update(search_word="")
+
+        call_command("rebuild_search_index", stdout=StringIO())
+
+        self.assertEqual(list(Contest.objects.search("build")), [contest])
+
+
+class SubmissionSearchTestCase(TestCase):
+    """ Test SubmissionTerm.objects.search and the index behind it """
+    def setUp(self):
+        self.user = User.objects.create_user(username="user")
+        self.contest = Contest.objects.create(word="WORD (4)", started_by=self.user, status=Contest.CLOSED)
+
+    def search(self, text):
+        return Submission.objects.in_search_order(SubmissionTerm.objects.search(text))
+
+    def test_search_terms(self):
+        self.assertEqual(search_terms("Café's déjà-vu, a (4)!"), {"cafe", "deja", "vu"})
+
+    def test_search_needs_every_word(self):
+        """ Only submissions with all of the search words (in either field) match """
+        both = Submission.objects.create(
+            clue="Quick brown fox", explanation="Jumps", contest=self.contest, submitted_by=self.user
+        )
+        Submission.objects.create(clue="Quick red fox", explanation="Naps", contest=self.contest, submitted_by=self.user)
+
+        self.assertEqual(self.search("fox JUMPS"), [both])
+
+    def test_index_follows_edits_and_deletes(self):
+        """ Terms are replaced when a submission's text changes and removed when it's deleted """
+        submission = Submission.objects.create(
+            clue="Before", explanation="Text", contest=self.contest, submitted_by=self.user
+        )
+        submission.clue = "After"
+        submission.save(update_fields=["clue"])
+
+        self.assertEqual(self.search("before"), [])
+        self.assertEqual(self.search("after"), [submission])
+
+        submission.delete()
+        self.assertFalse(SubmissionTerm.objects.exists())
+
+    def test_rebuild_search_index_includes_submissions(self):
+        submission = Submission.objects.create(
+            clue="Rebuilt", explanation="Text", contest=self.contest, submitted_by=self.user
+        )
+        SubmissionTerm.objects.all().delete()
+
+        call_command("rebuild_search_index", stdout=StringIO())
+
+        self.assertEqual(self.search("rebuilt"), [submission])
+
+
+class SampleDataTestCase(TestCase):
+    """ Test the generate_sample_data and benchmark_views commands """
+    def setUp(self):
+        call_command(
+            "generate_sample_data", users=10, contests=12, clues_per_contest=5, stdout=StringIO()
+        )
+
+    def test_generate_sample_data_fills_in_derived_data(self):
+        """ The bulk-created data has the like counts, winners, indexes, and stats the signals would have made """
+        self.assertEqual(User.objects.count(), 10)
+        self.assertEqual(
+            {contest.effective_status for contest in Contest.objects.all()},
+            {Contest.SUBMISSIONS, Contest.VOTING, Contest.CLOSED},
+        )
+        self.assertFalse(Submission.objects.annotate(actual=Count("likers")).exclude(like_count=F("actual")).exists())
+        self.assertFalse(
+            Contest.objects.filter(status=Contest.CLOSED, winning_entry=None, submissions__isnull=False).exists()
+        )
+        self.assertEqual(UserStats.objects.count(), 10)
+        self.assertEqual(
+            UserStats.objects.aggregate(total=Sum("total_submissions"))["total"], Submission.objects.count()
+        )
+        self.assertTrue(ContestTrigram.objects.exists())
+        self.assertTrue(SubmissionTerm.objects.exists())
+        self.assertFalse(Submission.objects.filter(created_at__gt=timezone.now()).exists())
+
+    @mock.patch("apps.cryptics.management.commands.generate_sample_data.contest_word_index")
+    def test_autocomplete_index_is_rebuilt_after_commit(self, mock_index):
+        """ Otherwise another worker could rebuild it from the data as it was before the new contests """
+        with self.captureOnCommitCallbacks() as callbacks:
+            call_command("generate_sample_data", users=2, contests=2, clues_per_contest=1, stdout=StringIO())
+        mock_index.invalidate.assert_not_called()
+        for callback in callbacks:
+            callback()
+        mock_index.invalidate.assert_called_once()
+
+    def test_benchmark_views_writes_results(self):
+        """ benchmark_views times every page and writes the results as JSON """
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "results.json")
+            call_command("benchmark_views", requests=2, warmup=0, output=path, stdout=StringIO(), stderr=StringIO())
+            with open(path, encoding="utf-8") as f:
+                results = json.load(f)
+
+            out = StringIO()
+            call_command("benchmark_views", requests=2, warmup=0, compare=path, stdout=out, stderr=StringIO())
+
+        self.assertEqual(
+            [page["name"] for page in results["pages"]],
+            [
+                "index",
+                "show_contest_full (submissions)",
+                "show_contest_full (voting)",
+                "show_contest_full (closed)",
+                "show_user",
+                "all_users",
+                "all_closed_contests",
+                "contest_search_json",
+            ],
+        )
+        self.assertTrue(all(page["status"] == 200 for page in results["pages"]))
+        self.assertEqual(results["data"]["contests"], 12)
+        self.assertIn(f"Compared with {path}", out.getvalue())
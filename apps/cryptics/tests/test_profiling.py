@@ -0,0 +1,82 @@
+""" Test the request profiling middleware and the profile_report command """
+import os
+import tempfile
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.test import TestCase, override_settings
+from django.urls import reverse
+
+from ..profiling import profile_files
+
+
+class ProfilingMiddlewareTestCase(TestCase):
+	""" Test ProfilingMiddleware (which is only loaded when profiling is turned on, so each test turns it on first) """
+	def setUp(self):
+		self.directory = self.enterContext(tempfile.TemporaryDirectory())
+		self.enterContext(override_settings(PROFILE_DIR=self.directory))
+
+	@override_settings(PROFILE_SAMPLE_RATE=1)
+	def test_sampled_requests_are_profiled(self):
+		""" Each profiled request is dumped to PROFILE_DIR, and a summary of it is logged """
+		with self.assertLogs("apps.cryptics.profiling", "INFO") as logs:
+			self.client.get(reverse("cryptics:index"))
+
+		files = profile_files()
+		self.assertEqual(len(files), 1)
+		self.assertEqual(os.path.basename(files[0]).split("-")[1], "cryptics.index")
+		self.assertRegex(
+			logs.output[0],
+			r"Profiled GET / \(cryptics:index\): [\d.]+ ms total, [\d.]+ ms in \d+ queries, [\d.]+ ms rendering templates",
+		)
+
+	@override_settings(PROFILE_SAMPLE_RATE=1, PROFILE_KEEP=2)
+	def test_only_the_newest_profiles_are_kept(self):
+		for _ in range(3):
+			self.client.get(reverse("cryptics:about"))
+		self.assertEqual(len(profile_files()), 2)
+
+	@override_settings(PROFILE_HEADER="X-Profile")
+	def test_staff_can_ask_for_a_request_to_be_profiled(self):
+		""" With sampling off, only requests from staff with the header are profiled """
+		user = User.objects.create_user(username="user")
+		self.client.get(reverse("cryptics:about"))
+		self.client.get(reverse("cryptics:about"), headers={"X-Profile": "1"})
+		self.client.force_login(user)
+		self.client.get(reverse("cryptics:about"), headers={"X-Profile": "1"})
+		self.assertEqual(profile_files(), [])
+
+		user.is_staff = True
+		user.save()
+		self.client.get(reverse("cryptics:about"))
+		self.assertEqual(profile_files(), [])
+		self.client.get(reverse("cryptics:about"), headers={"X-Profile": "1"})
+		self.assertEqual(len(profile_files()), 1)
+
+
+class ProfileReportTestCase(TestCase):
+	""" Test the profile_report command """
+	def setUp(self):
+		self.directory = self.enterContext(tempfile.TemporaryDirectory())
+		self.enterContext(override_settings(PROFILE_DIR=self.directory, PROFILE_SAMPLE_RATE=1))
+
+	def test_profile_report(self):
+		""" The report combines every profile, or just those for one view """
+		self.client.get(reverse("cryptics:index"))
+		self.client.get(reverse("cryptics:about"))
+		self.client.get(reverse("cryptics:about"))
+
+		out = StringIO()
+		call_command("profile_report", top=5, stdout=out)
+		self.assertIn("3 requests", out.getvalue())
+		self.assertIn("function calls", out.getvalue())
+
+		out = StringIO()
+		call_command("profile_report", view="cryptics:about", stdout=out)
+		self.assertIn("2 requests", out.getvalue())
+
+	def test_profile_report_errors_without_profiles(self):
+		with self.assertRaisesMessage(CommandError, "No profiles found"):
+			call_command("profile_report", stdout=StringIO())
@@ -0,0 +1,206 @@
+""" Test the query budget middleware, and that every view stays within its budget however much data there is """
+import datetime
+import os
+import tempfile
+from io import StringIO
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.management import call_command
+from django.db import connection
+from django.test import RequestFactory, TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from parameterized import parameterized
+
+from .. import urls
+from ..models import SUBMISSIONS_LENGTH, Contest, Submission
+from ..query_budget import QueryBudgetExceeded, QueryBudgetMiddleware, get_query_budget, query_budget
+from ..utils import get_site_url
+from ..wordplay import build_index
+
+
+def two_queries(request):
+	list(User.objects.all())
+	list(User.objects.all())
+
+
+class QueryBudgetMiddlewareTestCase(TestCase):
+	""" Test QueryBudgetMiddleware on its own """
+	def get(self, budget, method="get", **kwargs):
+		view = query_budget(budget, **kwargs)(lambda request: two_queries(request))
+		request = getattr(RequestFactory(), method)("/")
+		middleware = QueryBudgetMiddleware(view)
+		middleware.process_view(request, view, (), {})
+		return middleware(request)
+
+	def test_overrun_raises(self):
+		""" The test settings use QUERY_BUDGET_MODE = "raise" """
+		with self.assertRaisesMessage(QueryBudgetExceeded, "GET / ran 2 queries, over its budget of 1"):
+			self.get(1)
+
+	@override_settings(QUERY_BUDGET_MODE="log")
+	def test_overrun_is_logged(self):
+		with self.assertLogs("apps.cryptics.query_budget", "WARNING") as logs:
+			self.get(1)
+		self.assertIn("GET / ran 2 queries, over its budget of 1", logs.output[0])
+
+	def test_requests_within_budget_pass(self):
+		self.get(2)
+
+	def test_posts_can_have_a_budget_of_their_own(self):
+		self.get(1, method="post", post=2)
+		with self.assertRaisesMessage(QueryBudgetExceeded, "POST / ran 2 queries, over its budget of 1"):
+			self.get(2, method="post", post=1)
+		with self.assertRaises(QueryBudgetExceeded):
+			self.get(1, post=2)
+
+
+class ViewQueryBudgetTestCase(TestCase):
+	""" Request every page in urls.py, before and after adding lots more data, and count the queries """
+	def setUp(self):
+		cache.clear()
+		directory = self.enterContext(tempfile.TemporaryDirectory())
+		path = os.path.join(directory, "wordplay.idx")
+		build_index(["LATE", "TALE", "TEAL", "TEA"], path)
+		self.enterContext(override_settings(
+			WORDPLAY_INDEX_PATH=path, METRICS_DIR=os.path.join(directory, "metrics"), METRICS_TOKEN="token"
+		))
+
+		self.viewer = User.objects.create_user(username="viewer")
+		self.setter = User.objects.create_user(username="setter")
+		self.contests = {
+			status: Contest.objects.create(word=f"{label.upper()} (7)", started_by=self.setter, status=status)
+			for status, label in Contest.STATUS_CHOICES
+		}
+		Contest.objects.filter(id=self.contests[Contest.VOTING].id).update(
+			created_at=timezone.now() - SUBMISSIONS_LENGTH - datetime.timedelta(hours=1)
+		)
+		self.own_clue = self.contests[Contest.SUBMISSIONS].submissions.create(
+			clue="The viewer's clue (7)", submitted_by=self.viewer
+		)
+		self.other_clue = self.contests[Contest.VOTING].submissions.create(
+			clue="The setter's clue (7)", submitted_by=self.setter
+		)
+		self.contests[Contest.CLOSED].submissions.create(clue="The setter's old clue (7)", submitted_by=self.setter)
+		self.add_clues(3)
+
+	def add_clues(self, n):
+		""" Add n clues (liked by n users) to each contest, and n more contests, to make every page bigger """
+		users = [User.objects.create_user(username=f"user_{User.objects.count()}") for _ in range(n)]
+		for contest in self.contests.values():
+			for user in users:
+				clue = contest.submissions.create(clue=f"Another clue by {user} (7)", submitted_by=user)
+				clue.likers.add(*(liker for liker in users if liker != user), self.viewer)
+		call_command("generate_sample_data", users=n, contests=n, clues_per_contest=n, stdout=StringIO())
+		# The main page's recent clues are ones the viewer can like (and liked one of)
+		recent = [
+			self.contests[Contest.VOTING].submissions.create(clue=f"A recent clue {i} (7)", submitted_by=self.setter)
+			for i in range(3)
+		]
+		recent[0].likers.add(self.viewer)
+		cache.clear()
+
+	def throwaway_clue(self):
+		""" A clue for delete_submission to delete, old enough not to push the recent clues off the main page """
+		clue = self.contests[Contest.SUBMISSIONS].submissions.create(clue="Delete me (7)", submitted_by=self.viewer)
+		Submission.objects.filter(id=clue.id).update(created_at=timezone.now() - datetime.timedelta(days=1))
+		return clue
+
+	def new_contest_word(self):
+		""" A word for the viewer to start a contest with, after deleting the one they started last time """
+		Contest.objects.filter(started_by=self.viewer).delete()
+		# Count looking up the site (for the Discord announcement), as a fresh worker would
+		Site.objects.clear_cache()
+		get_site_url.cache_clear()
+		return "NEW CONTEST (3,7)"
+
+	def pages(self):
+		""" Every URL in urls.py, as (name, method, url, keyword arguments for the test client) """
+		contests = self.contests
+		return [
+			("index", "get", reverse("cryptics:index"), {}),
+			("index", "post", reverse("cryptics:index"), {"data": {"word": ""}}),
+			("index", "post", reverse("cryptics:index"), {"data": {"word": self.new_contest_word()}}),
+			("about", "get", reverse("cryptics:about"), {}),
+			("show_contest", "get", reverse("cryptics:show_contest", args=[contests[Contest.CLOSED].id]), {}),
+			*(
+				("show_contest_full", "get", contest.get_absolute_url(), {"data": {"highlight": self.own_clue.id}})
+				for contest in contests.values()
+			),
+			(
+				"contest_wordplay", "get",
+				reverse("cryptics:contest_wordplay", args=[contests[Contest.CLOSED].id]), {"data": {"pattern": "?A?E"}},
+			),
+			("contest_search", "get", reverse("cryptics:contest_search"), {"data": {"search": "VOTING"}}),
+			("contest_autocomplete", "get", reverse("cryptics:contest_autocomplete"), {"data": {"search": "VOT"}}),
+			("search_clues", "get", reverse("cryptics:search_clues"), {"data": {"q": "clue"}}),
+			("clue_search", "get", reverse("cryptics:clue_search"), {"data": {"q": "clue"}}),
+			("add_like", "post", reverse("cryptics:add_like", args=[self.other_clue.id]), {}),
+			("remove_like", "post", reverse("cryptics:remove_like", args=[self.other_clue.id]), {}),
+			("all_users", "get", reverse("cryptics:all_users"), {}),
+			("show_user", "get", reverse("cryptics:show_user", args=[self.setter.id]), {}),
+			("delete_submission", "get", reverse("cryptics:delete_submission", args=[self.own_clue.id]), {}),
+			("delete_submission", "post", reverse("cryptics:delete_submission", args=[self.throwaway_clue().id]), {}),
+			("all_closed_contests", "get", reverse("cryptics:all_closed_contests"), {}),
+			("all_closed_contests_json", "get", reverse("cryptics:all_closed_contests_json"), {}),
+			(
+				"metrics", "get", reverse("cryptics:metrics"),
+				{"headers": {"Authorization": f"Bearer {settings.METRICS_TOKEN}"}},
+			),
+		]
+
+	def count_queries(self):
+		counts = []
+		for name, method, url, kwargs in self.pages():
+			with CaptureQueriesContext(connection) as captured:
+				res = getattr(self.client, method)(url, **kwargs)
+			self.assertLess(res.status_code, 400, msg=f"{name}: {res.content}")
+			counts.append((name, len(captured)))
+		return counts
+
+	def test_every_view_has_a_budget(self):
+		""" Every URL's view declares a query budget, and is covered by pages() """
+		covered = {name for name, _, _, _ in self.pages()}
+		for pattern in urls.urlpatterns:
+			self.assertIsNotNone(get_query_budget(pattern.callback), msg=pattern.name)
+			self.assertIn(pattern.name, covered)
+
+	@parameterized.expand([("anonymous", False), ("logged_in", True)])
+	def test_query_counts_do_not_grow_with_data(self, _, logged_in):
+		""" Each page runs the same number of queries with ten times the data (and stays within budget) """
+		if logged_in:
+			self.client.force_login(self.viewer)
+
+		before = self.count_queries()
+		self.add_clues(30)
+		after = self.count_queries()
+
+		self.assertEqual(before, after)
+
+	@parameterized.expand([("anonymous", False), ("logged_in", True)])
+	@override_settings(VIEW_CACHE_TIMEOUT=300)
+	def test_pages_stay_within_budget_with_the_cache_on(self, _, logged_in):
+		""" Filling the cache (and checking the versions and phase changes it's keyed on) costs queries too """
+		if logged_in:
+			self.client.force_login(self.viewer)
+		cache.clear()
+		self.count_queries()  # With nothing cached
+		self.count_queries()  # With everything cached
+
+	@override_settings(VIEW_CACHE_TIMEOUT=300)
+	def test_main_page_lists_come_from_the_cache(self):
+		""" Once it's cached, the main page only looks up the viewer, and which of the recent clues they liked """
+		url = reverse("cryptics:index")
+		self.client.get(url)
+		with self.assertNumQueries(0):
+			self.client.get(url)
+
+		self.client.force_login(self.viewer)
+		self.client.get(url)
+		with self.assertNumQueries(3):  # The session, the user, and their likes
+			res = self.client.get(url)
+		self.assertContains(res, "Un-like this clue?", count=1)
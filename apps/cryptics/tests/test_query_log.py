@@ -0,0 +1,99 @@
+""" Test the SQL query log and the query_report command """
+import json
+import os
+import socket
+import tempfile
+from io import StringIO
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.core.management.base import CommandError
+from django.db import connection
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from ..metrics import ARCHIVE_FILE
+from ..query_log import fingerprint, query_log, record_query
+
+
+class FingerprintTestCase(SimpleTestCase):
+	def test_literals_are_stripped(self):
+		self.assertEqual(
+			fingerprint("SELECT  \"t1\".\"id\" FROM t1\nWHERE name = 'O''Brien' AND id > 12 LIMIT 21"),
+			"SELECT \"t1\".\"id\" FROM t1 WHERE name = ? AND id > ? LIMIT ?",
+		)
+
+	def test_lists_are_collapsed(self):
+		""" Queries that differ only in how many values they pass are counted together """
+		self.assertEqual(
+			fingerprint("SELECT * FROM t WHERE id IN (%s, %s, %s)"), fingerprint("SELECT * FROM t WHERE id IN (%s)")
+		)
+		self.assertEqual(
+			fingerprint("INSERT INTO t (a, b) VALUES (%s, %s), (%s, %s), (%s, %s)"),
+			"INSERT INTO t (a, b) VALUES (...)",
+		)
+
+
+class QueryLogTestCase(TestCase):
+	""" Test logging queries (the log is only added to connections when it's on, so each test adds it itself) """
+	def setUp(self):
+		self.directory = self.enterContext(tempfile.TemporaryDirectory())
+		self.enterContext(override_settings(QUERY_LOG_DIR=self.directory))
+		self.enterContext(connection.execute_wrapper(record_query))
+		query_log.clear()
+		self.addCleanup(query_log.clear)
+
+	def report(self, **kwargs):
+		query_log.flush(force=True)
+		out = StringIO()
+		call_command("query_report", stdout=out, **kwargs)
+		return out.getvalue()
+
+	def test_queries_are_counted_by_fingerprint_and_caller(self):
+		for i in range(3):
+			User.objects.filter(username=f"user{i}").exists()
+		report = self.report()
+		self.assertIn("3 calls", report)
+		self.assertIn('WHERE "auth_user"."username" = ? LIMIT ?', report)
+		self.assertRegex(report, r"\n +3  other apps/cryptics/tests/test_query_log\.py:\d+ \(test_queries_are_counted")
+
+	def test_queries_are_attributed_to_views(self):
+		self.client.get(reverse("cryptics:index"))
+		self.client.get(reverse("cryptics:about"))
+		report = self.report(view="cryptics:index")
+		self.assertRegex(report, r"cryptics:index apps/cryptics/\S+\.py:\d+")
+		self.assertNotIn("cryptics:about", report)
+
+	@override_settings(QUERY_LOG_SLOW_MS=0)
+	def test_slow_queries_are_logged_with_their_plans(self):
+		with self.assertLogs("apps.cryptics.query_log", "WARNING") as logs:
+			list(User.objects.filter(username="user"))
+		self.assertIn("Slow query", logs.output[0])
+		self.assertIn('FROM "auth_user"', logs.output[0])
+		self.assertIn("SEARCH auth_user USING INDEX", logs.output[0])  # SQLite's EXPLAIN QUERY PLAN
+
+	def test_finished_processes_are_archived(self):
+		""" The logs of processes that have exited are folded into one file, rather than piling up """
+		stats = {"SELECT ?": {"count": 2, "total": 0.5, "max": 0.3, "sources": {"other -": 2}}}
+		running = os.path.join(self.directory, f"{socket.gethostname()}-{os.getpid()}-1.json")
+		exited = os.path.join(self.directory, f"{socket.gethostname()}-999999999-1.json")
+		for path in (running, exited):
+			with open(path, "w", encoding="utf-8") as f:
+				json.dump(stats, f)
+
+		for _ in range(2):  # The totals stay the same once the exited process has been archived
+			report = self.report()
+			self.assertIn("4 calls, 1000.0 ms total, 250.00 ms mean, 300.0 ms max\n  SELECT ?\n", report)
+		self.assertFalse(os.path.exists(exited))
+		self.assertTrue(os.path.exists(os.path.join(self.directory, ARCHIVE_FILE)))
+
+	def test_report_can_clear_the_logs(self):
+		User.objects.exists()
+		self.report(clear=True)
+		self.assertFalse(os.path.exists(self.directory))
+		with self.assertRaisesMessage(CommandError, "No query logs found"):
+			call_command("query_report", stdout=StringIO())
+
+		User.objects.exists()
+		# Logging carries on afterwards, and a running process writes out everything it's counted again
+		self.assertIn("2 calls", self.report())
@@ -0,0 +1,307 @@
+""" Test the Celery tasks (and the model methods behind them) in the cryptics app """
+import datetime
+from http import HTTPStatus
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.db import DatabaseError, transaction
+from django.test import TestCase, override_settings
+from django.utils import timezone
+import requests
+
+from ..delivery import MAX_ATTEMPTS
+from ..models import SUBMISSIONS_LENGTH, VOTING_LENGTH, Contest, DiscordMessage, DiscordMessageManager, Submission
+from ..tasks import deliver_discord_messages, sweep_contests
+from ..utils import DISCORD_MAX_LENGTH, get_webhook_client, to_discord
+from .webhook_stub import StubWebhookServer
+
+
+@mock.patch("apps.cryptics.models.to_discord")
+class SweepContestsTestCase(TestCase):
+	""" Test the periodic sweep_contests task """
+	def setUp(self):
+		self.user = User.objects.create_user(username="user")
+		self.liker = User.objects.create_user(username="liker")
+		now = timezone.now()
+		ages = {
+			"fresh": datetime.timedelta(hours=1),
+			"voting": SUBMISSIONS_LENGTH + datetime.timedelta(minutes=1),
+			"closing": SUBMISSIONS_LENGTH + VOTING_LENGTH + datetime.timedelta(minutes=1),
+		}
+		self.contests = {}
+		for group, age in ages.items():
+			contests = Contest.objects.bulk_create(
+				[Contest(word=f"{group.upper()} {i} (5 1)", started_by=self.user) for i in range(150)]
+			)
+			Contest.objects.filter(id__in=[contest.id for contest in contests]).update(created_at=now - age)
+			self.contests[group] = contests
+
+		# Half of the contests that are closing get two clues each, the second of which should win
+		for contest in self.contests["closing"][::2]:
+			contest.submissions.create(clue=f"Loser for {contest.word}", submitted_by=self.user)
+			winner = contest.submissions.create(clue=f"Winner for {contest.word}", submitted_by=self.user)
+			winner.likers.add(self.liker)
+
+	def test_sweep_moves_every_due_contest_at_once(self, mock_discord: mock.MagicMock):
+		""" One sweep switches or closes every contest that's past a boundary and leaves the rest alone """
+		sweep_contests()
+
+		def statuses(group):
+			ids = [contest.id for contest in self.contests[group]]
+			return set(Contest.objects.filter(id__in=ids).values_list("status", flat=True))
+
+		self.assertEqual(statuses("fresh"), {Contest.SUBMISSIONS})
+		self.assertEqual(statuses("voting"), {Contest.VOTING})
+		self.assertEqual(statuses("closing"), {Contest.CLOSED})
+
+		for i, contest in enumerate(self.contests["closing"]):
+			contest.refresh_from_db()
+			if i % 2 == 0:
+				self.assertEqual(contest.winning_entry.clue, f"Winner for {contest.word}")
+			else:
+				self.assertIsNone(contest.winning_entry)
+
+		messages = [call.args[0] for call in mock_discord.call_args_list]
+		self.assertEqual(len([msg for msg in messages if "Voting is now open" in msg]), 150)
+		self.assertEqual(len([msg for msg in messages if "Voting is closed" in msg]), 75)
+
+	def test_sweep_is_idempotent(self, mock_discord: mock.MagicMock):
+		""" Running the sweep again (or in two workers) doesn't move or announce anything twice """
+		Contest.objects.sweep()
+		first_run_messages = mock_discord.call_count
+
+		switched, closed = Contest.objects.sweep()
+
+		self.assertEqual(switched, [])
+		self.assertEqual(closed, [])
+		self.assertEqual(mock_discord.call_count, first_run_messages)
+
+	def test_sweep_only_announces_contests_it_moved(self, mock_discord: mock.MagicMock):
+		""" If another worker has already moved some contests, this sweep only announces the rest """
+		already_moved = self.contests["voting"][:100]
+		Contest.objects.filter(id__in=[contest.id for contest in already_moved]).update(status=Contest.VOTING)
+
+		switched, _ = Contest.objects.sweep()
+
+		self.assertEqual(
+			{contest.id for contest in switched}, {contest.id for contest in self.contests["voting"][100:]}
+		)
+		messages = [call.args[0] for call in mock_discord.call_args_list]
+		self.assertEqual(len([msg for msg in messages if "Voting is now open" in msg]), 50)
+
+	def test_sweep_declares_missing_winners_for_already_closed_contests(self, mock_discord):
+		""" A contest that was closed without a winner (e.g. the worker died mid-sweep) gets one on the next sweep """
+		contest = self.contests["closing"][0]
+		Contest.objects.filter(id=contest.id).update(status=Contest.CLOSED)
+
+		Contest.objects.sweep()
+
+		contest.refresh_from_db()
+		self.assertEqual(contest.winning_entry.clue, f"Winner for {contest.word}")
+
+
+def make_response(status_code, headers=None, json_data=None):
+	""" Build a requests.Response-like mock for post_to_discord to return """
+	response = mock.MagicMock(status_code=status_code, headers=headers or {}, text="")
+	response.ok = status_code < 400
+	response.json.return_value = json_data or {}
+	return response
+
+
+class DiscordOutboxTestCase(TestCase):
+	""" Test queueing messages with to_discord and delivering them with deliver_discord_messages """
+	def test_to_discord_queues_message_and_starts_delivery_on_commit(self):
+		""" to_discord saves the message and asks for delivery once the transaction commits """
+		with mock.patch("apps.cryptics.tasks.deliver_discord_messages.apply_async") as mock_task:
+			with self.captureOnCommitCallbacks(execute=True):
+				to_discord("Hello")
+				mock_task.assert_not_called()
+			mock_task.assert_called_once()
+
+		self.assertEqual(list(DiscordMessage.objects.values_list("content", "status")), [("Hello", "P")])
+
+	def test_to_discord_message_is_discarded_if_transaction_rolls_back(self):
+		""" A message about something that never got committed is never sent """
+		with self.assertRaises(RuntimeError):
+			with transaction.atomic():
+				to_discord("This never happened")
+				raise RuntimeError
+
+		self.assertFalse(DiscordMessage.objects.exists())
+
+	@mock.patch("apps.cryptics.delivery.post_to_discord")
+	def test_delivery_sends_due_messages_in_order(self, mock_post: mock.MagicMock):
+		""" Pending messages are posted oldest first and marked as sent """
+		mock_post.return_value = make_response(HTTPStatus.NO_CONTENT)
+		for i in range(3):
+			DiscordMessage.objects.create(content=f"Message {i}")
+		DiscordMessage.objects.create(content="Not due yet", next_attempt_at=timezone.now() + datetime.timedelta(1))
+
+		deliver_discord_messages()
+
+		self.assertEqual([call.args[0] for call in mock_post.call_args_list], ["Message 0", "Message 1", "Message 2"])
+		self.assertEqual(DiscordMessage.objects.filter(status=DiscordMessage.SENT).count(), 3)
+
+		mock_post.reset_mock()
+		deliver_discord_messages()
+		mock_post.assert_not_called()
+
+	@mock.patch("apps.cryptics.delivery.post_to_discord")
+	def test_delivery_waits_as_long_as_discord_asks_after_a_429(self, mock_post: mock.MagicMock):
+		""" A 429 pauses the rest of the batch until Discord's Retry-After """
+		mock_post.side_effect = [
+			make_response(HTTPStatus.NO_CONTENT),
+			make_response(HTTPStatus.TOO_MANY_REQUESTS, headers={"Retry-After": "30"}),
+		]
+		messages = [DiscordMessage.objects.create(content=f"Message {i}") for i in range(3)]
+
+		before = timezone.now()
+		deliver_discord_messages()
+
+		self.assertEqual(mock_post.call_count, 2)
+		for message in messages:
+			message.refresh_from_db()
+		self.assertEqual(messages[0].status, DiscordMessage.SENT)
+		for message in messages[1:]:
+			self.assertEqual(message.status, DiscordMessage.PENDING)
+			self.assertEqual(message.attempts, 0)
+			self.assertGreaterEqual(message.next_attempt_at, before + datetime.timedelta(seconds=30))
+
+	@mock.patch("apps.cryptics.delivery.post_to_discord")
+	def test_delivery_retries_failures_with_backoff_then_gives_up(self, mock_post: mock.MagicMock):
+		""" Errors are retried with growing delays, and the message is marked as failed after too many """
+		mock_post.side_effect = requests.ConnectionError("Discord is down")
+		message = DiscordMessage.objects.create(content="Hello")
+
+		delays = []
+		for _ in range(MAX_ATTEMPTS):
+			DiscordMessage.objects.filter(id=message.id).update(next_attempt_at=timezone.now())
+			deliver_discord_messages()
+			message.refresh_from_db()
+			delays.append(message.next_attempt_at - timezone.now())
+
+		self.assertEqual(message.status, DiscordMessage.FAILED)
+		self.assertEqual(message.attempts, MAX_ATTEMPTS)
+		self.assertIn("Discord is down", message.last_error)
+		self.assertLess(delays[0], delays[1])
+		self.assertLess(delays[1], delays[2])
+
+
+@override_settings(DISCORD_URLS=["1/one", "2/two"])
+class DiscordOutboxAtomicityTestCase(TestCase):
+	""" Test that nothing announced to Discord is saved unless its messages are too """
+	def setUp(self):
+		self.user = User.objects.create_user(username="user")
+		queue = DiscordMessageManager.queue
+
+		def queue_then_fail(manager, *args, **kwargs):
+			""" Queue the first webhook's copy, then fail as if the worker died before the second """
+			if DiscordMessage.objects.exists():
+				raise DatabaseError("Worker died")
+			return queue(manager, *args, **kwargs)
+
+		self.enterContext(mock.patch.object(DiscordMessageManager, "queue", queue_then_fail))
+
+	def test_new_contest(self):
+		with self.assertRaises(DatabaseError):
+			Contest.objects.add(word="WORD (4)", started_by=self.user)
+		self.assertFalse(Contest.objects.exists())
+		self.assertFalse(DiscordMessage.objects.exists())
+
+	def test_new_submission(self):
+		contest = Contest.objects.create(word="WORD (4)", started_by=self.user)
+		with self.assertRaises(DatabaseError):
+			Submission.objects.add(clue="Clue (4)", explanation="", contest=contest, submitted_by=self.user)
+		self.assertFalse(Submission.objects.exists())
+		self.assertFalse(DiscordMessage.objects.exists())
+
+	def test_switch_to_voting(self):
+		contest = Contest.objects.create(word="WORD (4)", started_by=self.user)
+		Contest.objects.filter(id=contest.id).update(created_at=timezone.now() - SUBMISSIONS_LENGTH)
+		with self.assertRaises(DatabaseError):
+			Contest.objects.sweep()
+		contest.refresh_from_db()
+		self.assertEqual(contest.status, Contest.SUBMISSIONS)
+		self.assertFalse(DiscordMessage.objects.exists())
+
+	def test_declare_winner(self):
+		contest = Contest.objects.create(word="WORD (4)", started_by=self.user, status=Contest.CLOSED)
+		contest.submissions.create(clue="Clue (4)", submitted_by=self.user)
+		with self.assertRaises(DatabaseError):
+			Contest.objects.declare_winners()
+		contest.refresh_from_db()
+		self.assertIsNone(contest.winning_entry)
+		self.assertFalse(DiscordMessage.objects.exists())
+
+
+@mock.patch("apps.cryptics.utils._start_discord_delivery")
+@override_settings(DISCORD_URLS=["12345/example"], DISCORD_DIGEST_WINDOW=60)
+class DiscordDigestTestCase(TestCase):
+	""" Test that new submission notifications are combined into one message per contest """
+	def setUp(self):
+		self.server = self.enterContext(StubWebhookServer())
+		self.enterContext(override_settings(DISCORD_API_URL=self.server.url))
+		get_webhook_client.cache_clear()
+		self.user = User.objects.create_user(username="user")
+
+	def end_digest_window(self):
+		DiscordMessage.objects.filter(status=DiscordMessage.PENDING).update(next_attempt_at=timezone.now())
+
+	def test_burst_of_submissions_is_sent_as_one_message_per_contest(self, _):
+		""" Announcements go out straight away, while a burst of clues is held and combined by contest """
+		contests = [Contest.objects.add(word=f"WORD{i} (5)", started_by=self.user) for i in range(2)]
+		for i in range(20):
+			Submission.objects.add(
+				clue=f"Clue {i} (5)", explanation="", contest=contests[i % 2], submitted_by=self.user
+			)
+
+		deliver_discord_messages()
+		self.assertEqual(len(self.server.received), 2)
+		self.assertTrue(all("new contest" in msg.lower() for msg in self.server.received))
+
+		self.end_digest_window()
+		deliver_discord_messages()
+
+		digests = self.server.received[2:]
+		self.assertEqual(len(digests), 2)
+		for contest, digest in zip(contests, digests):
+			lines = digest.split("\n")
+			self.assertEqual(len(lines), 10)
+			self.assertTrue(all(f"New submission for {contest.word}" in line for line in lines))
+		self.assertEqual(
+			[line.split(": ")[1].split(" --")[0] for line in digests[0].split("\n")],
+			[f"Clue {i} (5)" for i in range(0, 20, 2)],
+		)
+		self.assertFalse(DiscordMessage.objects.exclude(status=DiscordMessage.SENT).exists())
+
+	def test_digest_is_split_to_fit_discord_length_limit(self, _):
+		""" A digest that would be too long for one Discord message is sent in order over several """
+		contest = Contest.objects.add(word="LONG (4)", started_by=self.user)
+		clues = [f"{i:02d} " + "x" * 300 for i in range(15)]
+		for clue in clues:
+			Submission.objects.add(clue=clue, explanation="", contest=contest, submitted_by=self.user)
+		self.end_digest_window()
+
+		deliver_discord_messages()
+
+		digests = self.server.received[1:]
+		self.assertGreater(len(digests), 1)
+		self.assertTrue(all(len(digest) <= DISCORD_MAX_LENGTH for digest in digests))
+		lines = [line for digest in digests for line in digest.split("\n")]
+		self.assertEqual([line.split(": ")[1][:2] for line in lines], [f"{i:02d}" for i in range(15)])
+
+	def test_submissions_wait_for_the_digest_window(self, _):
+		""" Clues aren't posted until the window that started with the first one has passed """
+		contest = Contest.objects.add(word="WAIT (4)", started_by=self.user)
+		before = timezone.now()
+		Submission.objects.add(clue="First (5)", explanation="", contest=contest, submitted_by=self.user)
+		Submission.objects.add(clue="Second (6)", explanation="", contest=contest, submitted_by=self.user)
+
+		deliver_discord_messages()
+
+		self.assertEqual(len(self.server.received), 1)
+		due_times = set(
+			DiscordMessage.objects.filter(status=DiscordMessage.PENDING).values_list("next_attempt_at", flat=True)
+		)
+		self.assertEqual(len(due_times), 1)
+		self.assertGreaterEqual(due_times.pop(), before + datetime.timedelta(seconds=60))
@@ -12,7 +12,7 @@ from django.test import TestCase
 from django.urls import reverse
 from parameterized import parameterized
 
-from ..models import Contest, Submission
+from ..models import Contest, Submission, SubmissionTerm
 
 
 class CreateContestTestCase(TestCase):
@@ -28,8 +28,7 @@ class CreateContestTestCase(TestCase):
 		self.url = reverse("cryptics:index")
 
 	@mock.patch("apps.cryptics.models.to_discord")
-	@mock.patch("apps.cryptics.models.tasks.update_contest_status.apply_async")
-	def test_create_contest_success(self, mock_task: mock.MagicMock, mock_discord):
+	def test_create_contest_success(self, mock_discord):
 		""" Creating a contest succeeds with valid data """
 
 		post_data = {
@@ -52,8 +51,7 @@ class CreateContestTestCase(TestCase):
 		self.assertContains(res, expected_msg)
 
 	@mock.patch("apps.cryptics.models.to_discord")
-	@mock.patch("apps.cryptics.models.tasks.update_contest_status.apply_async")
-	def test_create_contest_fails_with_another_open_contest(self, mock_task, mock_discord):
+	def test_create_contest_fails_with_another_open_contest(self, mock_discord):
 		""" Display error if a user opens a contest while they have another running """
 		first_contest = Contest.objects.create(word="CONTEST (7)", started_by=self.user)
 		post_data = {
@@ -71,8 +69,7 @@ class CreateContestTestCase(TestCase):
 		self.assertNotContains(res, expected_msg)
 
 	@mock.patch("apps.cryptics.models.to_discord")
-	@mock.patch("apps.cryptics.models.tasks.update_contest_status.apply_async")
-	def test_create_contest_uses_request_user_not_form_data_to_determine_started_by(self, mock_task, mock_discord):
+	def test_create_contest_uses_request_user_not_form_data_to_determine_started_by(self, mock_discord):
 		""" Creating a contest sets started_by based on the logged-in user
 
 		The ContestForm includes a started_by field, but it should be set by the view; if this information is included
@@ -91,10 +88,7 @@ class CreateContestTestCase(TestCase):
 		self.assertEqual(contest.started_by, self.user)
 
 	@mock.patch("apps.cryptics.models.to_discord")
-	@mock.patch("apps.cryptics.models.tasks.update_contest_status.apply_async")
-	def test_create_contest_sends_message_to_discord(
-		self, mock_task, mock_discord: mock.MagicMock
-	):
+	def test_create_contest_sends_message_to_discord(self, mock_discord: mock.MagicMock):
 		""" Send a message to Discord when a contest is created """
 		post_data = {
 			"word": "EXAMPLE CONTEST (7, 7)",
@@ -110,26 +104,17 @@ class CreateContestTestCase(TestCase):
 		msg = mock_discord.call_args[0][0]
 		self.assertIn(expected_msg_fragment, msg)
 
-	@mock.patch("apps.cryptics.models.to_discord")
-	@mock.patch("apps.cryptics.models.tasks.update_contest_status.apply_async")
-	def test_create_contest_queues_celery_tasks(self, mock_task: mock.MagicMock, mock_discord):
-		""" Creating a contest should queue Celery tasks to update their status """
-		post_data = {
-			"word": "EXAMPLE CONTEST (7, 7)",
-		}
-		self.client.post(self.url, post_data)
-		contest = Contest.objects.get(word=post_data["word"])
-
-		one_sec = datetime.timedelta(seconds=1)
-		mock_task.assert_any_call(args=(contest.id,), eta=contest.submissions_end_time+one_sec)
-		mock_task.assert_any_call(args=(contest.id,), eta=contest.voting_end_time+one_sec)
 
 
 class ShowContestTestCase(TestCase):
 	""" Test the show_contest and show_contest_full views """
 
-	def test_show_contest_checks_if_too_old(self):
-		""" The show_contest page will check if the contest is too old and needs to be closed """
+	def test_show_contest_shows_effective_status_without_writing(self):
+		""" The show_contest page treats a contest that's too old as closed, but leaves the update to the task
+
+		Before the background task catches up, the page should still show the contest in the right phase, but a GET
+		request shouldn't write to the database.
+		"""
 		user = User.objects.create_user(username="fake_user")
 		old_contest = Contest.objects.create(word="EXAMPLE CONTEST (7, 7)", started_by=user)
 		old_contest.created_at = datetime.datetime(1970, 1, 1, tzinfo=datetime.timezone.utc)
@@ -138,10 +123,12 @@ class ShowContestTestCase(TestCase):
 
 		url_kwargs = {"contest_id": old_contest.id, "word": old_contest.slugified}
 		url = reverse("cryptics:show_contest_full", kwargs=url_kwargs)
-		self.client.get(url)
+		res = self.client.get(url)
 
+		self.assertTrue(res.context["contest"].is_closed)
+		self.assertNotContains(res, 'name="clue"')
 		old_contest.refresh_from_db()
-		self.assertEqual(old_contest.status, Contest.CLOSED)
+		self.assertEqual(old_contest.status, Contest.SUBMISSIONS)
 
 	@parameterized.expand([(Contest.SUBMISSIONS,), (Contest.VOTING,)])
 	def test_show_contest_sorts_submissions_by_date_created_if_contest_is_not_closed(self, current_status: str):
@@ -198,20 +185,27 @@ class ShowContestTestCase(TestCase):
 		self.assertLess(res_content.index(clues[0].clue), res_content.index(clues[4].clue))
 		self.assertLess(res_content.index(clues[4].clue), res_content.index(clues[1].clue))
 
+	def test_show_contest_lists_likers_if_contest_is_closed(self):
+		""" After a contest is closed, hovering over the like count shows who liked each clue """
+		users = [User.objects.create(username=f"user_{i}") for i in range(3)]
+		contest = Contest.objects.create(word="EXAMPLE (7)", started_by=users[0], status=Contest.CLOSED)
+		clue = contest.submissions.create(clue="Example clue (7)", submitted_by=users[0])
+		clue.likers.add(users[2], users[1])
+
+		url = reverse("cryptics:show_contest_full", kwargs={"contest_id": contest.id, "word": contest.slugified})
+		res = self.client.get(url)
+		self.assertContains(res, '<td title="user_1, user_2">2</td>')
+
 	def test_show_contest_handles_queries_efficiently(self):
 		""" The show_contest_full endpoint gets the number of likes for each clue with a constant number of queries
 
-		This should be 4 queries total:
+		This should be 3 queries total:
 		1. Select the contest with the specified ID and related objects (done in get_object_or_404 inside
 			show_contest_full)
-		2. Check if any submissions exist (in the show.html template, to determine if the table of submissions should
-			be shown at all)
-		3. Select all submissions for this contest, including the like count (in contest.submissions_sorted, called in
-			the show.html template, to construct the table of submissions)
-		4. Select information about all users who liked any clues for this contest (as part of the prefetch_related
-			clause in the contest.submissions_sorted query referenced above—for people not familiar, a
-			prefetch_related clause is used for many-to-many relationships; Django will select rows from table A in
-			one query, table B in another, and then join that data at the Python level)
+		2. Select all submissions for this contest, including the like count and whether the viewer liked each one
+			(in contest.submissions_sorted, called in show_contest_full)
+		3. Select the usernames of everyone who liked any clue for this contest (also in contest.submissions_sorted,
+			but only for closed contests, since that's the only time the names are shown)
 		"""
 		users = [User.objects.create(username=f"user_{i}") for i in range(3)]
 		contest = Contest.objects.create(word="EXAMPLE (7)", started_by=users[0], status=Contest.CLOSED)
@@ -223,10 +217,31 @@ class ShowContestTestCase(TestCase):
 
 		contest.declare_winner()
 
+		url = reverse("cryptics:show_contest_full", kwargs={"contest_id": contest.id, "word": contest.slugified})
+		with self.assertNumQueries(3):
+			res = self.client.get(url)
+		self.assertEqual(res.status_code, HTTPStatus.OK)
+
+	def test_show_contest_during_voting_uses_constant_queries_regardless_of_votes(self):
+		""" A logged-in voter's view of a contest in voting doesn't run any per-clue or per-vote queries
+
+		The 4 queries are the session, the logged-in user, the contest, and the annotated submissions.
+		"""
+		users = [User.objects.create_user(username=f"user_{i}", password="password") for i in range(20)]
+		contest = Contest.objects.create(word="EXAMPLE (7)", started_by=users[0], status=Contest.VOTING)
+		clues = [contest.submissions.create(clue=f"Clue number {i}", submitted_by=users[1]) for i in range(30)]
+		for i, clue in enumerate(clues):
+			clue.likers.add(*users[2:2+i % 18])
+
+		self.client.login(username="user_5", password="password")
 		url = reverse("cryptics:show_contest_full", kwargs={"contest_id": contest.id, "word": contest.slugified})
 		with self.assertNumQueries(4):
 			res = self.client.get(url)
+
 		self.assertEqual(res.status_code, HTTPStatus.OK)
+		liked = [sub for sub in res.context["submissions"] if sub.viewer_liked]
+		self.assertEqual(len(liked), len([clue for clue in clues if clue.likers.filter(id=users[5].id).exists()]))
+		self.assertContains(res, "Un-like this clue?", count=len(liked))
 
 
 class CreateSubmissionTestCase(TestCase):
@@ -398,17 +413,11 @@ class ShowUserTestCase(TestCase):
 
 		The five queries total should be:
 		1. Retrieve information about the user (done in get_object_or_404 inside show_user)
-		2. Select contests the user started (in user_show.html)
-		3. Select contests the user won (in user_show.html)
-		4. Check if the user has any submissions whatsoever (in user_show.html, to determine if the table of
-			submissions should be rendered)
-		5. Retrieve information about all of the user's submissions (in user_show.html, specifically calling
-			this_user.submissions.all_order_by_like_count)
-		6. Select information about all users who liked any clues for this contest (as part of a prefetch_related
-			clause in this_user.submissions.all_order_by_like_count)
-
-		Queries 2 and 3 could be replaced with prefetch_related, but since we'd only be prefetching for one object,
-		it'll work out to the same number of queries.
+		2. Select contests the user started
+		3. Select contests the user won
+		4. Retrieve a page of the user's submissions, with their like counts and contests (hiding clues for
+			contests that aren't closed yet in the same query)
+		5. Select the names of the users who liked those clues (in attach_liker_names)
 		"""
 		user = User.objects.create(username="user")
 		liking_user = User.objects.create(username="liking_user")
@@ -419,10 +428,68 @@ class ShowUserTestCase(TestCase):
 				submission.likers.add(liking_user)
 
 		url = reverse("cryptics:show_user", kwargs={"user_id": user.id})
-		with self.assertNumQueries(6):
+		with self.assertNumQueries(5):
 			res = self.client.get(url)
 
 		self.assertEqual(res.status_code, HTTPStatus.OK, msg=res.content)
+		self.assertContains(res, 'title="liking_user"', count=5)
+
+	def test_show_user_shows_the_owner_their_open_clues(self):
+		""" Users can see (and delete) their own clues for contests that haven't closed yet """
+		user = User.objects.create(username="user")
+		contest = Contest.objects.create(word="OPEN (4)", started_by=user)
+		submission = contest.submissions.create(clue="Still open", submitted_by=user)
+
+		self.client.force_login(user)
+		res = self.client.get(reverse("cryptics:show_user", kwargs={"user_id": user.id}))
+		self.assertContains(res, submission.clue)
+		self.assertContains(res, reverse("cryptics:delete_submission", kwargs={"submission_id": submission.id}))
+
+	def test_show_user_marks_the_viewers_likes(self):
+		""" Logged-in visitors see a filled star by the clues they liked """
+		user = User.objects.create(username="user")
+		viewer = User.objects.create(username="viewer")
+		contest = Contest.objects.create(word="CONTEST (7)", started_by=user, status=Contest.CLOSED)
+		liked = contest.submissions.create(clue="Liked", submitted_by=user)
+		contest.submissions.create(clue="Not liked", submitted_by=user)
+		liked.likers.add(viewer)
+
+		self.client.force_login(viewer)
+		res = self.client.get(reverse("cryptics:show_user", kwargs={"user_id": user.id}))
+		self.assertContains(res, "filled_star.png", count=1)
+		self.assertContains(res, "empty_star.png", count=1)
+
+	@mock.patch("apps.cryptics.views.USER_PAGE_SIZE", 2)
+	def test_show_user_pages_through_clues(self):
+		""" Clues are shown a page at a time, following the "More clues" link from one page to the next """
+		user = User.objects.create(username="user")
+		liker = User.objects.create(username="liker")
+		contest = Contest.objects.create(word="CONTEST (7)", started_by=user, status=Contest.CLOSED)
+		clues = [contest.submissions.create(clue=f"Clue number {i}", submitted_by=user) for i in range(5)]
+		clues[3].likers.add(liker)
+
+		url = reverse("cryptics:show_user", kwargs={"user_id": user.id})
+		seen = []
+		data = {}
+		while True:
+			res = self.client.get(url, data=data)
+			self.assertEqual(res.status_code, HTTPStatus.OK, msg=res.content)
+			seen.extend(sub.id for sub in res.context["submissions"])
+			if not res.context["next_cursor"]:
+				break
+			self.assertContains(res, f"?after={res.context['next_cursor']}")
+			data = {"after": res.context["next_cursor"]}
+
+		self.assertEqual(seen, [clues[i].id for i in [3, 0, 1, 2, 4]])
+
+	def test_show_user_ignores_invalid_cursors(self):
+		""" A mangled "after" parameter shows the first page rather than an error """
+		user = User.objects.create(username="user")
+		contest = Contest.objects.create(word="CONTEST (7)", started_by=user, status=Contest.CLOSED)
+		contest.submissions.create(clue="The first clue", submitted_by=user)
+
+		res = self.client.get(reverse("cryptics:show_user", kwargs={"user_id": user.id}), data={"after": "nonsense"})
+		self.assertContains(res, "The first clue")
 
 
 class AllClosedContestsTestCase(TestCase):
@@ -448,6 +515,62 @@ class AllClosedContestsTestCase(TestCase):
 		self.assertEqual(res.status_code, HTTPStatus.OK)
 
 
+@mock.patch("apps.cryptics.views.ARCHIVE_PAGE_SIZE", 3)
+class ArchivePaginationTestCase(TestCase):
+	""" Test the keyset-paginated archive page and all_closed_contests_json """
+	def setUp(self):
+		self.user = User.objects.create(username="user")
+		self.winner = User.objects.create(username="winner")
+		self.contests = [
+			Contest.objects.create(word=f"CONTEST {i} (7 1)", started_by=self.user, status=Contest.CLOSED)
+			for i in range(8)
+		]
+		Contest.objects.create(word="OPEN (4)", started_by=self.user)
+		# Ties on created_at are broken by ID
+		Contest.objects.filter(id__in=[contest.id for contest in self.contests[2:5]]).update(
+			created_at=self.contests[2].created_at
+		)
+		submission = self.contests[0].submissions.create(clue="Winning clue", explanation="Line 1\nLine 2", submitted_by=self.winner)
+		Contest.objects.filter(id=self.contests[0].id).update(winning_entry=submission, winning_user=self.winner)
+		self.url = reverse("cryptics:all_closed_contests_json")
+
+	def test_pages_cover_every_closed_contest_once(self):
+		words = []
+		params = {}
+		while True:
+			with self.assertNumQueries(1):
+				res = self.client.get(self.url, data=params)
+			self.assertEqual(res.status_code, HTTPStatus.OK, msg=res.content)
+			data = res.json()
+			words.extend(contest["word"] for contest in data["contests"])
+			if not data["next"]:
+				break
+			params = {"after": data["next"]}
+
+		self.assertEqual(words, [contest.word for contest in self.contests])
+
+	def test_json_includes_winner_and_setter(self):
+		contest = self.client.get(self.url).json()["contests"][0]
+		self.assertEqual(contest["started_by"], {"username": "user", "url": f"/user/{self.user.id}"})
+		self.assertEqual(contest["winner"]["user"]["username"], "winner")
+		self.assertEqual(contest["winner"]["clue"], "Winning clue")
+		self.assertEqual(contest["url"], self.contests[0].get_absolute_url())
+		self.assertIsNone(self.client.get(self.url).json()["contests"][1]["winner"])
+
+	def test_invalid_cursor(self):
+		res = self.client.get(self.url, data={"after": "not a cursor"})
+		self.assertEqual(res.status_code, HTTPStatus.BAD_REQUEST)
+		self.assertIn("after", res.json()["errors"])
+
+	def test_html_page_links_to_the_next_page(self):
+		res = self.client.get(reverse("cryptics:all_closed_contests"))
+		self.assertEqual(len(res.context["contests"]), 3)
+		self.assertContains(res, f'href="?after={res.context["next_cursor"]}"')
+
+		res = self.client.get(reverse("cryptics:all_closed_contests"), data={"after": res.context["next_cursor"]})
+		self.assertEqual(res.context["contests"], self.contests[3:6])
+
+
 class ContestSearchTestCase(TestCase):
 	""" Test the contest_search_json endpoint """
 	def setUp(self):
@@ -503,6 +626,16 @@ class ContestSearchTestCase(TestCase):
 		self.assertEqual(res_data["contests"][0]["word"], contest.word)
 		self.assertEqual(res_data["contests"][0]["url"], contest.get_absolute_url())
 
+	def test_contest_search_ignores_accents_spacing_and_enumeration(self):
+		""" contest_search matches words however they were typed, and lists exact matches first """
+		contests = [
+			Contest.objects.create(word="CAFÉ  AU LAIT (4,2,4)", started_by=self.user),
+			Contest.objects.create(word="Cafe (4)", started_by=self.user),
+		]
+		res = self.client.get(self.url, data={"search": "cafe (4)"})
+		self.assertEqual(res.status_code, HTTPStatus.OK, msg=res.content)
+		self.assertEqual([contest["word"] for contest in res.json()["contests"]], [contests[1].word, contests[0].word])
+
 	def test_contest_search_errors_with_blank_search(self):
 		""" contest_search returns an error if the required search term is missing """
 		res = self.client.get(self.url)
@@ -529,8 +662,104 @@ class ContestSearchTestCase(TestCase):
 		for i in range(9):
 			Contest.objects.create(word=f"CONTEST {i} (7 1)", started_by=self.user)
 
-		# The two queries are to get the count of matching contests, then retrieve the actual information
-		with self.assertNumQueries(2):
+		# The matching contests are annotated with the total number of matches, so one query does both
+		with self.assertNumQueries(1):
 			res = self.client.get(self.url, data={"search": "TEST"})
 
 		self.assertEqual(res.status_code, HTTPStatus.OK)
+
+
+class ClueSearchTestCase(TestCase):
+	""" Test the search_clues page and clue_search_json endpoint """
+	def setUp(self):
+		self.users = [User.objects.create_user(username=f"user_{i}", password="password") for i in range(2)]
+		self.url = reverse("cryptics:clue_search")
+		self.closed = Contest.objects.create(word="CLOSED (6)", started_by=self.users[0], status=Contest.CLOSED)
+		self.open = Contest.objects.create(word="OPEN (4)", started_by=self.users[0])
+
+	def search(self, **params):
+		res = self.client.get(self.url, data=params)
+		self.assertEqual(res.status_code, HTTPStatus.OK, msg=res.content)
+		return res.json()
+
+	def test_clue_search_ranks_clue_matches_above_explanation_matches(self):
+		""" A search word in the clue counts for more than one in the explanation """
+		in_explanation = Submission.objects.create(
+			clue="Something else (5)", explanation="Anagram of bread", contest=self.closed, submitted_by=self.users[0]
+		)
+		in_clue = Submission.objects.create(
+			clue="Bread baked (5)", explanation="Anagram of BREAD", contest=self.closed, submitted_by=self.users[1]
+		)
+		Submission.objects.create(clue="Unrelated (9)", explanation="Nothing", contest=self.closed, submitted_by=self.users[1])
+
+		data = self.search(q="anagram BREAD")
+
+		self.assertEqual([clue["id"] for clue in data["clues"]], [in_clue.id, in_explanation.id])
+		self.assertEqual(data["clues"][1]["submitted_by"], "user_0")
+
+	def test_clue_search_hides_explanations_and_authors_of_open_contests(self):
+		""" Explanations of clues in open contests aren't searched or shown, and authors aren't shown """
+		clue = Submission.objects.create(
+			clue="Secret hidden (6)", explanation="Definition is secret", contest=self.open, submitted_by=self.users[1]
+		)
+
+		self.assertEqual(self.search(q="definition")["clues"], [])
+		data = self.search(q="secret")
+		self.assertEqual(len(data["clues"]), 1)
+		self.assertEqual(data["clues"][0]["id"], clue.id)
+		self.assertIsNone(data["clues"][0]["explanation"])
+		self.assertIsNone(data["clues"][0]["submitted_by"])
+
+		res = self.client.get(reverse("cryptics:search_clues"), data={"q": "secret"})
+		self.assertContains(res, clue.clue)
+		self.assertNotContains(res, clue.explanation)
+
+	def test_clue_search_author_filter_only_reveals_closed_contests(self):
+		""" Filtering by author can't be used to find out who wrote a clue in a contest that's still open """
+		closed_clue = Submission.objects.create(
+			clue="Mine closed (4)", explanation="x", contest=self.closed, submitted_by=self.users[1]
+		)
+		open_clue = Submission.objects.create(
+			clue="Mine open (4)", explanation="x", contest=self.open, submitted_by=self.users[1]
+		)
+
+		self.assertEqual([clue["id"] for clue in self.search(q="mine", author="user_1")["clues"]], [closed_clue.id])
+
+		self.client.login(username="user_1", password="password")
+		self.assertEqual(
+			{clue["id"] for clue in self.search(q="mine", author="user_1")["clues"]}, {closed_clue.id, open_clue.id}
+		)
+
+	def test_clue_search_status_filter(self):
+		""" status limits results to contests in that (effective) phase """
+		Submission.objects.create(clue="Word closed (4)", explanation="x", contest=self.closed, submitted_by=self.users[1])
+		open_clue = Submission.objects.create(
+			clue="Word open (4)", explanation="x", contest=self.open, submitted_by=self.users[1]
+		)
+
+		self.assertEqual([clue["id"] for clue in self.search(q="word", status="S")["clues"]], [open_clue.id])
+
+	def test_clue_search_paginates_with_a_constant_number_of_queries(self):
+		""" Results come a page at a time, with a fixed number of queries
+
+		Those are: how common each search word is, the count, the page, and loading the page's clues.
+		"""
+		Submission.objects.bulk_create([
+			Submission(clue=f"Page clue {i}", explanation="x", contest=self.closed, submitted_by=self.users[0])
+			for i in range(25)
+		])
+		SubmissionTerm.objects.index(Submission.objects.all())
+
+		with self.assertNumQueries(4):
+			first = self.search(q="page clue")
+		second = self.search(q="page clue", page=2)
+
+		self.assertEqual((first["count"], first["num_pages"], len(first["clues"])), (25, 2, 20))
+		self.assertEqual(len(second["clues"]), 5)
+		self.assertFalse({clue["id"] for clue in first["clues"]} & {clue["id"] for clue in second["clues"]})
+
+	def test_clue_search_errors_without_search_terms(self):
+		""" The q param is required """
+		res = self.client.get(self.url)
+		self.assertEqual(res.status_code, HTTPStatus.BAD_REQUEST)
+		self.assertEqual(res.json()["errors"], {"q": ["This field is required."]})
@@ -0,0 +1,109 @@
+""" Test the webhook client, and delivering the Discord outbox to more than one server """
+import datetime
+import time
+from http import HTTPStatus
+from unittest import mock
+
+from django.test import SimpleTestCase, TestCase, override_settings
+import requests
+
+from ..models import DiscordMessage
+from ..tasks import deliver_discord_messages
+from ..utils import get_webhook_client, to_discord
+from ..webhooks import CircuitBreaker, CircuitOpenError, WebhookClient
+from .webhook_stub import StubWebhookServer
+
+
+class WebhookClientTestCase(SimpleTestCase):
+	""" Test WebhookClient against a local stub server """
+	def test_connections_are_reused(self):
+		""" Several posts to the same server go over one kept-alive connection """
+		with StubWebhookServer() as server:
+			client = WebhookClient()
+			for i in range(5):
+				client.post(server.url, {"content": f"Message {i}"})
+
+		self.assertEqual(server.received, [f"Message {i}" for i in range(5)])
+		self.assertEqual(len({request["client"] for request in server.requests}), 1)
+
+	def test_slow_server_times_out(self):
+		""" A server that doesn't answer within the read timeout raises rather than hanging """
+		with StubWebhookServer(delay=0.5) as server:
+			client = WebhookClient(timeout=(1, 0.1))
+			with self.assertRaises(requests.Timeout):
+				client.post(server.url, {"content": "Hello"})
+
+	def test_circuit_opens_after_repeated_failures(self):
+		""" After enough server errors, the client stops calling the server until the cool-down ends """
+		with StubWebhookServer(status=HTTPStatus.INTERNAL_SERVER_ERROR) as server:
+			client = WebhookClient(breaker=CircuitBreaker(threshold=3, cooldown=datetime.timedelta(minutes=1)))
+			for _ in range(3):
+				client.post(server.url, {"content": "Hello"}, target="server")
+
+			with self.assertRaises(CircuitOpenError):
+				client.post(server.url, {"content": "Hello"}, target="server")
+			self.assertEqual(len(server.requests), 3)
+
+			# Once the cool-down is over, a trial call is let through, and a success closes the circuit again
+			server.status = HTTPStatus.NO_CONTENT
+			with mock.patch("apps.cryptics.webhooks.timezone.now") as mock_now:
+				mock_now.return_value = datetime.datetime.now(datetime.timezone.utc) + datetime.timedelta(minutes=2)
+				client.post(server.url, {"content": "Hello"}, target="server")
+			client.post(server.url, {"content": "Hello"}, target="server")
+			self.assertEqual(len(server.requests), 5)
+
+	def test_rate_limiting_does_not_open_circuit(self):
+		""" A 429 means "slow down", not "this server is broken" """
+		with StubWebhookServer(status=HTTPStatus.TOO_MANY_REQUESTS) as server:
+			client = WebhookClient(breaker=CircuitBreaker(threshold=1))
+			for _ in range(3):
+				client.post(server.url, {"content": "Hello"})
+			self.assertEqual(len(server.requests), 3)
+
+
+@mock.patch("apps.cryptics.utils._start_discord_delivery")
+class MultipleWebhooksTestCase(TestCase):
+	""" Test posting the Discord outbox to several webhooks at once """
+	def setUp(self):
+		self.server = self.enterContext(StubWebhookServer(delay=0.3))
+		self.enterContext(override_settings(DISCORD_API_URL=self.server.url, DISCORD_URLS=["1/one", "2/two", "3/three"]))
+		get_webhook_client.cache_clear()
+
+	def test_every_webhook_gets_every_message_in_order(self, _):
+		""" Each webhook gets its own copy of each message, in the order they were queued """
+		for i in range(2):
+			to_discord(f"Message {i}")
+
+		deliver_discord_messages()
+
+		for path in ("/1/one", "/2/two", "/3/three"):
+			received = [request["content"] for request in self.server.requests if request["path"] == path]
+			self.assertEqual(received, ["Message 0", "Message 1"])
+		self.assertEqual(DiscordMessage.objects.filter(status=DiscordMessage.SENT).count(), 6)
+
+	def test_webhooks_are_posted_to_concurrently(self, _):
+		""" Adding servers doesn't add their delays together """
+		to_discord("Hello")
+
+		start = time.monotonic()
+		deliver_discord_messages()
+
+		self.assertEqual(len(self.server.requests), 3)
+		self.assertLess(time.monotonic() - start, 0.3 * 2)
+
+	def test_failing_webhook_does_not_affect_the_others(self, _):
+		""" Errors are recorded against the failing webhook's copy of the message only """
+		to_discord("Hello")
+		real_post = get_webhook_client().post
+
+		def post(url, payload, target=None):
+			if target == "2":
+				raise requests.ConnectionError("Server 2 is down")
+			return real_post(url, payload, target=target)
+
+		with mock.patch.object(get_webhook_client(), "post", side_effect=post):
+			deliver_discord_messages()
+
+		statuses = dict(DiscordMessage.objects.values_list("target", "status"))
+		self.assertEqual(statuses, {"1": DiscordMessage.SENT, "2": DiscordMessage.PENDING, "3": DiscordMessage.SENT})
+		self.assertEqual(DiscordMessage.objects.get(target="2").attempts, 1)
@@ -0,0 +1,116 @@
+""" Test the in-memory contest word index and the autocomplete endpoint that uses it """
+from http import HTTPStatus
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.test import TestCase
+from django.urls import reverse
+
+from ..models import Contest
+from ..word_index import ContestWordIndex, contest_word_index
+
+
+class ContestWordIndexTestCase(TestCase):
+	""" Test ContestWordIndex """
+	def setUp(self):
+		cache.clear()
+		self.user = User.objects.create_user(username="user")
+		for word in ["CAFÉ AU LAIT (4,2,4)", "LAITY (5)", "CAFETERIA (9)", "TEAPOT (6)"]:
+			Contest.objects.create(word=word, started_by=self.user)
+
+	def words(self, index, text, **kwargs):
+		contests, _ = index.lookup(text, **kwargs)
+		return [contest["word"] for contest in contests]
+
+	def test_lookup_matches_the_start_of_any_word(self):
+		""" Contests are found by a prefix of any of their words, ignoring case and accents """
+		index = ContestWordIndex()
+		self.assertEqual(self.words(index, "cafe"), ["CAFÉ AU LAIT (4,2,4)", "CAFETERIA (9)"])
+		self.assertEqual(self.words(index, "lait"), ["CAFÉ AU LAIT (4,2,4)", "LAITY (5)"])
+		self.assertEqual(self.words(index, "au l"), ["CAFÉ AU LAIT (4,2,4)"])
+		self.assertEqual(self.words(index, "eria"), [])
+
+	def test_lookup_limit(self):
+		""" Only limit contests are returned, with a flag to say there were more """
+		index = ContestWordIndex()
+		contests, more = index.lookup("C", limit=1)
+		self.assertEqual(len(contests), 1)
+		self.assertTrue(more)
+		contests, more = index.lookup("C", limit=2)
+		self.assertEqual(len(contests), 2)
+		self.assertFalse(more)
+
+	def test_index_is_built_once(self):
+		""" The first lookup loads the contests; later ones don't touch the database """
+		index = ContestWordIndex()
+		with self.assertNumQueries(1):
+			index.lookup("TEA")
+		with self.assertNumQueries(0):
+			self.assertEqual(self.words(index, "TEA"), ["TEAPOT (6)"])
+
+	def test_new_contests_are_added_without_a_rebuild(self):
+		""" A contest created in this worker is added to its index once it's committed """
+		contest_word_index.lookup("TEA")
+		with self.captureOnCommitCallbacks(execute=True):
+			Contest.objects.add(word="Teacup (6)", started_by=self.user)
+
+		with self.assertNumQueries(0):
+			self.assertEqual(self.words(contest_word_index, "TEA"), ["TEACUP (6)", "TEAPOT (6)"])
+
+	def test_other_workers_rebuild_after_changes(self):
+		""" Another worker's index (here, another instance) notices the version stamp change and rebuilds """
+		other_worker = ContestWordIndex()
+		other_worker.lookup("TEA")
+		contest_word_index.lookup("TEA")
+
+		with self.captureOnCommitCallbacks(execute=True):
+			Contest.objects.add(word="Teacup (6)", started_by=self.user)
+		with self.assertNumQueries(1):
+			self.assertEqual(self.words(other_worker, "TEA"), ["TEACUP (6)", "TEAPOT (6)"])
+
+		teapot = Contest.objects.get(word="TEAPOT (6)")
+		with self.captureOnCommitCallbacks(execute=True):
+			teapot.word = "KETTLE (6)"
+			teapot.save()
+		self.assertEqual(self.words(contest_word_index, "TEA"), ["TEACUP (6)"])
+		self.assertEqual(self.words(other_worker, "KET"), ["KETTLE (6)"])
+
+		with self.captureOnCommitCallbacks(execute=True):
+			teapot.delete()
+		self.assertEqual(self.words(other_worker, "KET"), [])
+
+	def test_saving_without_changing_the_word_does_not_invalidate(self):
+		""" Status changes and the like leave the index alone """
+		contest_word_index.lookup("TEA")
+		contest = Contest.objects.get(word="TEAPOT (6)")
+		with self.captureOnCommitCallbacks(execute=True):
+			contest.status = Contest.VOTING
+			contest.save()
+
+		with self.assertNumQueries(0):
+			contest_word_index.lookup("TEA")
+
+
+class ContestAutocompleteTestCase(TestCase):
+	""" Test the contest_autocomplete_json endpoint """
+	def setUp(self):
+		cache.clear()
+		self.user = User.objects.create_user(username="user")
+		self.url = reverse("cryptics:contest_autocomplete")
+
+	def test_contest_autocomplete(self):
+		""" contest_autocomplete returns matching contests' words and URLs """
+		contest = Contest.objects.create(word="EXAMPLE (7)", started_by=self.user)
+		Contest.objects.create(word="OTHER (5)", started_by=self.user)
+
+		res = self.client.get(self.url, data={"search": "exa"})
+
+		self.assertEqual(res.status_code, HTTPStatus.OK, msg=res.content)
+		self.assertEqual(
+			res.json(), {"contests": [{"word": contest.word, "url": contest.get_absolute_url()}], "more": False}
+		)
+
+	def test_contest_autocomplete_errors_with_blank_search(self):
+		res = self.client.get(self.url)
+		self.assertEqual(res.status_code, HTTPStatus.BAD_REQUEST)
+		self.assertEqual(res.json()["errors"], {"search": ["This field is required."]})
@@ -0,0 +1,116 @@
+""" Test the anagram and letter-pattern index, and the wordplay helper endpoint that uses it """
+import os
+import tempfile
+from http import HTTPStatus
+from unittest import mock
+
+from django.contrib.auth.models import User
+from django.core.management import call_command
+from django.test import SimpleTestCase, TestCase, override_settings
+from django.urls import reverse
+
+from ..models import Contest
+from ..wordplay import WordplayIndex, build_index, get_wordplay_index
+
+WORDS = ["LATE", "TALE", "TEAL", "TEA", "EAT", "ATE", "TA", "TALES", "STEAL", "LEAST", "SALE", "CAFE", "KALE", "Café"]
+
+
+class WordplayIndexTestCase(SimpleTestCase):
+	""" Test building and reading the wordplay index file """
+	def setUp(self):
+		directory = self.enterContext(tempfile.TemporaryDirectory())
+		self.path = os.path.join(directory, "wordplay.idx")
+		build_index(WORDS, self.path)
+		self.index = WordplayIndex(self.path)
+		self.addCleanup(self.index.close)
+
+	def test_words_are_normalized_and_deduplicated(self):
+		self.assertEqual(len(self.index), len(WORDS) - 1)
+
+	def test_index_is_readable_by_everyone(self):
+		""" The web workers can read an index rebuilt by Celery running as another user """
+		self.assertEqual(os.stat(self.path).st_mode & 0o777, 0o644)
+
+	def test_index_is_read_as_little_endian(self):
+		""" On a big-endian machine, the values are swapped into native order """
+		with mock.patch("apps.cryptics.wordplay.sys.byteorder", "big"):
+			swapped = WordplayIndex(self.path)
+		self.addCleanup(swapped.close)
+		masks = self.index._masks  # pylint: disable=protected-access
+		swapped_masks = swapped._masks  # pylint: disable=protected-access
+		self.assertEqual(list(swapped_masks), [int.from_bytes(mask.to_bytes(4, "little"), "big") for mask in masks])
+
+	def test_anagrams(self):
+		""" Anagrams use exactly the same letters, and don't include the word itself """
+		self.assertEqual(self.index.anagrams("late (4)"), ["TALE", "TEAL"])
+		self.assertEqual(self.index.anagrams("STEAL"), ["LEAST", "TALES"])
+		self.assertEqual(self.index.anagrams("Face"), ["CAFE"])
+		self.assertEqual(self.index.anagrams("QUIZ"), [])
+
+	def test_subanagrams(self):
+		""" Sub-anagrams use some of the letters, no more often than they're in the word, longest first """
+		self.assertEqual(self.index.subanagrams("STEAL"), ["LEAST", "TALES", "LATE", "SALE", "TALE", "TEAL", "ATE", "EAT", "TEA"])
+		self.assertEqual(self.index.subanagrams("TEAL", min_length=2), ["LATE", "TALE", "ATE", "EAT", "TEA", "TA"])
+
+	def test_subanagrams_of_long_phrases(self):
+		""" Phrases with too many distinct letters to try each subset still find their sub-anagrams """
+		self.assertEqual(self.index.subanagrams("THE QUICK BROWN FOX (3,5,5,3)"), [])
+		self.assertEqual(self.index.subanagrams("A QUICK BROWN FOX STEALS (1,5,5,3,6)")[:3], ["LEAST", "STEAL", "TALES"])
+
+	def test_pattern(self):
+		""" ? (or . or _) matches any one letter """
+		self.assertEqual(self.index.pattern("?A?E"), ["CAFE", "KALE", "LATE", "SALE", "TALE"])
+		self.assertEqual(self.index.pattern("t.a_"), ["TEAL"])
+		self.assertEqual(self.index.pattern("???"), ["ATE", "EAT", "TEA"])
+		self.assertEqual(self.index.pattern("?A?E?S"), [])
+
+	def test_rebuilt_index_is_reopened(self):
+		""" A worker picks up a rebuilt index on its next lookup """
+		self.assertEqual(get_wordplay_index(self.path).pattern("??"), ["TA"])
+		build_index(WORDS + ["AT"], self.path)
+		self.assertEqual(get_wordplay_index(self.path).pattern("??"), ["AT", "TA"])
+
+	def test_missing_index(self):
+		self.assertIsNone(get_wordplay_index(self.path + ".missing"))
+
+
+class ContestWordplayTestCase(TestCase):
+	""" Test the contest_wordplay_json endpoint and the build_wordplay_index command """
+	def setUp(self):
+		directory = self.enterContext(tempfile.TemporaryDirectory())
+		word_list = os.path.join(directory, "words.txt")
+		with open(word_list, "w", encoding="utf-8") as f:
+			f.write("\n".join(WORDS))
+		self.enterContext(override_settings(WORDPLAY_INDEX_PATH=os.path.join(directory, "wordplay.idx")))
+
+		user = User.objects.create_user(username="user")
+		self.contest = Contest.objects.create(word="STEAL (5)", started_by=user)
+		Contest.objects.create(word="SLATE (5)", started_by=user)
+		self.url = reverse("cryptics:contest_wordplay", kwargs={"contest_id": self.contest.id})
+		self.word_list = word_list
+
+	def test_contest_wordplay(self):
+		""" The index includes the word list and every contest's word """
+		call_command("build_wordplay_index", word_list=self.word_list, stdout=open(os.devnull, "w"))
+
+		res = self.client.get(self.url, data={"pattern": "??a?e"})
+
+		self.assertEqual(res.status_code, HTTPStatus.OK, msg=res.content)
+		data = res.json()
+		self.assertEqual(data["word"], "STEAL (5)")
+		self.assertEqual(data["anagrams"], ["LEAST", "SLATE", "TALES"])
+		self.assertEqual(data["subanagrams"][:4], ["LEAST", "SLATE", "TALES", "LATE"])
+		self.assertEqual(data["pattern"], ["SLATE"])
+		self.assertFalse(data["more_anagrams"])
+
+	def test_contest_wordplay_errors(self):
+		res = self.client.get(self.url)
+		self.assertEqual(res.status_code, HTTPStatus.SERVICE_UNAVAILABLE)
+
+		call_command("build_wordplay_index", stdout=open(os.devnull, "w"))
+		res = self.client.get(self.url, data={"pattern": "A*"})
+		self.assertEqual(res.status_code, HTTPStatus.BAD_REQUEST)
+		self.assertIn("pattern", res.json()["errors"])
+
+		res = self.client.get(reverse("cryptics:contest_wordplay", kwargs={"contest_id": self.contest.id + 100}))
+		self.assertEqual(res.status_code, HTTPStatus.NOT_FOUND)
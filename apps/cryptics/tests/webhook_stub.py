@@ -0,0 +1,53 @@
+""" A local stand-in for Discord's webhook endpoint, for tests that need real HTTP calls """
+import json
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+class StubWebhookHandler(BaseHTTPRequestHandler):
+	""" Record each message posted, then answer with the server's status after its delay """
+	protocol_version = "HTTP/1.1"  # So connections can be kept alive
+
+	def do_POST(self):  # pylint: disable=invalid-name
+		body = self.rfile.read(int(self.headers["Content-Length"]))
+		with self.server.lock:
+			self.server.requests.append({
+				"path": self.path,
+				"content": json.loads(body)["content"],
+				"client": self.client_address,
+			})
+		time.sleep(self.server.delay)
+		self.send_response(self.server.status)
+		self.send_header("Content-Length", "0")
+		self.end_headers()
+
+	def log_message(self, format, *args):  # pylint: disable=redefined-builtin
+		pass
+
+
+class StubWebhookServer(ThreadingHTTPServer):
+	""" Usage: with StubWebhookServer() as server: ... post to server.url ... check server.requests """
+	daemon_threads = True
+
+	def __init__(self, status=HTTPStatus.NO_CONTENT, delay=0):
+		super().__init__(("127.0.0.1", 0), StubWebhookHandler)
+		self.status = status
+		self.delay = delay
+		self.requests = []
+		self.lock = threading.Lock()
+		self.url = f"http://127.0.0.1:{self.server_address[1]}/"
+
+	@property
+	def received(self):
+		""" The content of every message posted, in the order they arrived """
+		return [request["content"] for request in self.requests]
+
+	def __enter__(self):
+		threading.Thread(target=self.serve_forever, daemon=True).start()
+		return self
+
+	def __exit__(self, *args):
+		self.shutdown()
+		super().__exit__(*args)
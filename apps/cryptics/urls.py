@@ -8,7 +8,11 @@ urlpatterns = [
 	path("about", views.about, name="about"),
 	path("contest/<int:contest_id>", views.show_contest, name="show_contest"),
 	path("contest/<int:contest_id>-<word>", views.show_contest_full, name="show_contest_full"),
+	path("contest/<int:contest_id>/wordplay", views.contest_wordplay_json, name="contest_wordplay"),
 	path("contest/search", views.contest_search_json, name="contest_search"),
+	path("contest/autocomplete", views.contest_autocomplete_json, name="contest_autocomplete"),
+	path("clues/search", views.search_clues, name="search_clues"),
+	path("clues/search.json", views.clue_search_json, name="clue_search"),
 	path("submission/<int:submission_id>/like", views.add_like, name="add_like"),
 	path("submission/<int:submission_id>/dislike", views.remove_like, name="remove_like"),
 	path("all_users", views.all_users, name="all_users"),
@@ -19,4 +23,6 @@ urlpatterns = [
 		name="delete_submission"
 	),
 	path("archives", views.all_closed_contests, name="all_closed_contests"),
+	path("archives.json", views.all_closed_contests_json, name="all_closed_contests_json"),
+	path("metrics", views.prometheus_metrics, name="metrics"),
 ]
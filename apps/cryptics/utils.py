@@ -1,14 +1,75 @@
 """ Utility functions for the cryptics module """
+import base64
+import binascii
+import datetime
 import logging
-from functools import cache
+import re
+import unicodedata
+from functools import cache, partial
 
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.db import transaction
 from django.templatetags.static import static
+from django.utils import timezone
 import requests
 
+from .metrics import registry, timed
+from .webhooks import DEFAULT_TIMEOUT, CircuitOpenError, WebhookClient
+
 logger = logging.getLogger(__name__)
 
+# Discord rejects webhook messages longer than this
+DISCORD_MAX_LENGTH = 2000
+
+
+def normalize_word(word):
+	""" Fold a contest word (or a search for one) into the form contests are searched by
+
+	The enumeration is removed, accents are stripped, everything is upper case, and runs of
+	whitespace become single spaces, so "Café  au lait (4,2,4)" becomes "CAFE AU LAIT".
+	"""
+	word = re.sub(r"\s*\(.*\)\s*$", "", word)  # The same pattern check_for_repeats.js uses
+	word = "".join(char for char in unicodedata.normalize("NFKD", word) if not unicodedata.combining(char))
+	return " ".join(word.upper().split())
+
+
+def search_terms(text):
+	""" Split text into the set of lower-case, unaccented words that clues are indexed and searched by
+
+	Single characters are left out, as they're too common to be worth indexing.
+	"""
+	text = "".join(char for char in unicodedata.normalize("NFKD", text) if not unicodedata.combining(char))
+	return {term for term in re.findall(r"\w+", text.lower()) if 1 < len(term) <= 50}
+
+
+def trigrams(text):
+	""" The set of three-character substrings of text (empty if it's shorter than that) """
+	return {text[i:i + 3] for i in range(len(text) - 2)}
+
+
+def encode_cursor(*key):
+	""" An opaque string for a position in a keyset-paginated list, from the sort key of its last row
+
+	The key's values can be integers or datetimes, e.g. (created_at, id).
+	"""
+	parts = [value.isoformat() if isinstance(value, datetime.datetime) else str(value) for value in key]
+	return base64.urlsafe_b64encode("|".join(parts).encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor, types):
+	""" The sort key from encode_cursor, given the type of each of its values, raising ValueError if cursor isn't one """
+	try:
+		parts = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode().split("|")
+	except (binascii.Error, UnicodeDecodeError) as e:
+		raise ValueError(f"Invalid cursor {cursor!r}") from e
+	if len(parts) != len(types):
+		raise ValueError(f"Invalid cursor {cursor!r}")
+	return tuple(
+		datetime.datetime.fromisoformat(part) if value_type is datetime.datetime else value_type(part)
+		for part, value_type in zip(parts, types)
+	)
+
 
 @cache
 def get_site_url():
@@ -23,11 +84,63 @@ def get_discord_pingable_role():
 	return ""
 
 
-def to_discord(msg):
-	""" Simple util to post messages to Discord
+def to_discord(msg, digest_key=None):
+	""" Queue a message to be posted to Discord
+
+	The message is saved to the DiscordMessage outbox as part of the current transaction (so it's
+	only sent if whatever it announces is actually committed, and isn't lost if a worker restarts)
+	and posted by the deliver_discord_messages Celery task, so requests never wait on Discord.
+
+	Messages with a digest_key are held for DISCORD_DIGEST_WINDOW seconds and then posted together
+	with any others queued under the same key, as one combined message.
 
-	Arguably, this should be moved to a Celery task so that the message can be sent to Discord
-	asynchronously, but so far there hasn't been an issue.
+	A copy of the message is queued for each webhook in DISCORD_URLS, so each server's delivery
+	(and retries) are tracked separately.
+	"""
+	from .models import DiscordMessage  # Imported here to avoid a circular import
+	for target in get_discord_targets() or [""]:
+		message = DiscordMessage.objects.queue(msg, digest_key=digest_key, target=target)
+	countdown = max((message.next_attempt_at - timezone.now()).total_seconds(), 0)
+	transaction.on_commit(partial(_start_discord_delivery, countdown=countdown))
+
+
+def _start_discord_delivery(countdown=0):
+	""" Ask a Celery worker to deliver queued messages as soon as they're due, rather than on the next
+	periodic run
+	"""
+	from .tasks import deliver_discord_messages  # Imported here to avoid a circular import
+	try:
+		deliver_discord_messages.apply_async(countdown=countdown, retry=False)
+	except Exception:  # pylint: disable=broad-except
+		# The periodic run will pick the message up, so a broker hiccup shouldn't fail the request
+		logger.warning("Couldn't queue Discord delivery task", exc_info=True)
+
+
+def get_discord_targets():
+	""" The configured Discord webhooks, keyed by webhook ID
+
+	Each entry in DISCORD_URLS is "<webhook ID>/<token>".  Only the ID (which isn't a secret) is
+	stored on queued messages and used in logs.
+	"""
+	return {url.split("/")[0]: url for url in settings.DISCORD_URLS}
+
+
+@cache
+def get_webhook_client():
+	""" The WebhookClient (and so the connection pool) shared by everything in this process """
+	return WebhookClient(timeout=DEFAULT_TIMEOUT)
+
+
+def post_to_discord(msg, target=""):
+	""" Post a message to one of the Discord webhooks right away
+
+	target is a webhook ID from get_discord_targets; messages without one (queued before there could
+	be more than one webhook) go to the first.  Returns the requests.Response, or None if no webhook
+	is configured (in which case the message is just printed, for debugging) or target has since
+	been removed from the settings.  Connection errors, and CircuitOpenError if the webhook has been
+	failing, are left for the caller to handle.
+
+	This is called from worker threads, so it mustn't touch the database (get_site_url is cached).
 	"""
 	payload = {
 		"content": msg,
@@ -35,8 +148,57 @@ def to_discord(msg):
 		"avatar_url": get_site_url() + static("cryptics/images/robot_face.png"),
 	}
 
-	if settings.DISCORD_URL:
-		requests.post(f"https://discordapp.com/api/webhooks/{settings.DISCORD_URL}", json=payload)
-		logger.info("Sent to Discord %s", payload)
-	else:
+	if not settings.DISCORD_URLS:
 		print(payload)
+		return None
+
+	targets = get_discord_targets()
+	target = target or next(iter(targets))
+	if target not in targets:
+		logger.warning("Dropping Discord message for webhook %s, which is no longer configured", target)
+		return None
+
+	try:
+		with timed("cryptics_discord_post_seconds"):
+			response = get_webhook_client().post(f"{settings.DISCORD_API_URL}{targets[target]}", payload, target=target)
+	except CircuitOpenError:
+		registry.inc("cryptics_discord_post_failures_total", reason="circuit_open")
+		raise
+	except requests.RequestException:
+		registry.inc("cryptics_discord_post_failures_total", reason="connection")
+		raise
+	if response.status_code >= 400:
+		registry.inc("cryptics_discord_post_failures_total", reason=str(response.status_code))
+	logger.info("Sent to Discord webhook %s %s (%d)", target, payload, response.status_code)
+	return response
+
+
+def get_retry_after(response):
+	""" How many seconds Discord asked us to wait before retrying a rate-limited (429) request """
+	try:
+		return float(response.headers["Retry-After"])
+	except (KeyError, ValueError):
+		pass
+	try:
+		return float(response.json()["retry_after"])
+	except (KeyError, TypeError, ValueError):
+		return 1.0
+
+
+def combine_for_discord(messages, limit=DISCORD_MAX_LENGTH):
+	""" Join messages with newlines into as few chunks as possible, each no longer than limit
+
+	Yields (chunk, count) pairs, where count is how many of the messages went into that chunk.
+	Messages keep their order, and a single message that's too long on its own is truncated.
+	"""
+	chunk, count = "", 0
+	for message in messages:
+		if len(message) > limit:
+			message = message[:limit - 1] + "…"
+		if count and len(chunk) + 1 + len(message) > limit:
+			yield chunk, count
+			chunk, count = "", 0
+		chunk = f"{chunk}\n{message}" if count else message
+		count += 1
+	if count:
+		yield chunk, count
@@ -1,15 +1,37 @@
+import hmac
 from http import HTTPStatus
 
+from django.conf import settings
 from django.contrib import messages
 from django.contrib.auth.decorators import login_required
-from django.http import JsonResponse
+from django.core.paginator import Paginator
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse
+from django.template.defaultfilters import linebreaksbr
 from django.urls import reverse
+from django.utils import timezone
+from django.utils.formats import date_format
+from django.utils.html import format_html
 from django.shortcuts import render, redirect, get_object_or_404
 
-from .forms import ContestForm, ContestSearchForm, SubmissionForm
-from .models import User, Contest, Submission
-
-
+from . import caching, metrics
+from .forms import (
+	ArchivePageForm, ClueSearchForm, ContestForm, ContestSearchForm, SubmissionForm, UserPageForm, WordplayForm,
+)
+from .models import User, Contest, Submission, SubmissionTerm, UserStats, attach_liker_names
+from .query_budget import query_budget
+from .utils import encode_cursor
+from .word_index import contest_word_index
+from .wordplay import get_wordplay_index
+
+CLUE_SEARCH_PAGE_SIZE = 20
+ARCHIVE_PAGE_SIZE = 50
+USER_PAGE_SIZE = 50
+# Part of the cache key for closed contests' pre-rendered clues; change it whenever _render_closed_rows does
+CLOSED_ROWS_FORMAT = 1
+WORDPLAY_RESULT_LIMIT = 100
+
+
+@query_budget(10, post=11)
 def index(request):
 	""" Show the main page """
 	if request.method == "POST":
@@ -25,29 +47,64 @@ def index(request):
 		form = ContestForm()
 
 	context = {"form": form}
+	# The contest lists only change when a contest is saved or moves on to a new phase, so they're kept
+	# until then; the champion and recent clues change with every clue and like
+	context.update(caching.cached(
+		"index-contests",
+		[caching.version_key(caching.CONTEST_LISTS)],
+		_index_contests,
+		expires=Contest.objects.next_recent_change,
+	))
+	context.update(caching.cached("index-clues", [caching.version_key(caching.LEADERBOARD)], _index_clues))
+	if request.user.is_authenticated:
+		# Whether the viewer liked each recent clue is looked up per request, in one query
+		context["liked_ids"] = set(
+			Submission.likers.through.objects.filter(
+				user=request.user, submission__in=[sub.id for sub in context["recent_clues"]]
+			).values_list("submission_id", flat=True)
+		)
+
+	return render(request, "cryptics/index.html", context)
 
-	context["open_contests"] = Contest.objects.filter(status=Contest.SUBMISSIONS).order_by("created_at")
 
-	context["voting_contests"] = Contest.objects.filter(status=Contest.VOTING).order_by("created_at")
+def _index_contests():
+	contests = Contest.objects.select_related("started_by")
+	return {
+		"open_contests": list(contests.with_effective_status(Contest.SUBMISSIONS).order_by("created_at")),
+		"voting_contests": list(contests.with_effective_status(Contest.VOTING).order_by("created_at")),
+		"past_contests": list(
+			Contest.objects.ended_recently().select_related("winning_entry", "winning_entry__submitted_by")
+		),
+	}
 
-	context["past_contests"] = Contest.objects.ended_recently()
-	context["current_champ"] = User.objects.sort_users()[0]
-	context["recent_clues"] = Submission.objects.all().order_by("-created_at")[:3]
 
-	return render(request, "cryptics/index.html", context)
+def _index_clues():
+	return {
+		"current_champ": UserStats.objects.leaderboard().first(),
+		"recent_clues": list(
+			Submission.objects.select_related("contest", "submitted_by").order_by("-created_at")[:3]
+		),
+	}
 
 
+@query_budget(2)
 def about(request):
 	""" Show the about page """
 	return render(request, "cryptics/about.html")
 
 
+@query_budget(3)
 def show_contest(request, contest_id):
 	""" Redirect show_contest requests with just the ID to ID and contest slug URL """
 	contest = get_object_or_404(Contest, id=contest_id)
 	return redirect("cryptics:show_contest_full", contest.id, contest.slugified)
 
 
+@query_budget(14)
+@caching.conditional_page(
+	lambda contest_id, word=None: [caching.version_key(caching.CONTEST, contest_id)],
+	lambda contest_id, word=None: Contest.objects.filter(id=contest_id),
+)
 def show_contest_full(request, contest_id, word=None):
 	""" Show information about a specific contest """
 	contest = get_object_or_404(
@@ -57,8 +114,6 @@ def show_contest_full(request, contest_id, word=None):
 	if word != contest.slugified:
 		return redirect("cryptics:show_contest_full", contest.id, contest.slugified)
 
-	contest.check_if_too_old()
-
 	if request.method == "POST":
 		if request.user.is_anonymous:
 			# This is ugly but apparently the only way to get query params into the redirect
@@ -87,14 +142,65 @@ def show_contest_full(request, contest_id, word=None):
 		"highlight": int(request.GET.get("highlight", -1)),
 	}
 
+	if contest.is_closed:
+		# A closed contest's clues never change, so they're rendered once and kept until something (such as an
+		# admin edit) bumps the contest's version.  Only whether the viewer liked each one is looked up per request.
+		context["closed_rows"] = caching.cached_forever(
+			f"closed-contest-rows:{CLOSED_ROWS_FORMAT}:{contest.id}",
+			[caching.version_key(caching.CONTEST, contest.id)],
+			lambda: _render_closed_rows(contest),
+		)
+		if request.user.is_authenticated:
+			context["liked_ids"] = set(
+				Submission.likers.through.objects.filter(
+					user=request.user, submission__contest=contest
+				).values_list("submission_id", flat=True)
+			)
+	elif request.user.is_authenticated:
+		context["submissions"] = contest.submissions_sorted(request.user)
+	else:
+		context["submissions"] = caching.cached(
+			f"contest-submissions:{contest.id}",
+			[caching.version_key(caching.CONTEST, contest.id)],
+			contest.submissions_sorted,
+			expires=lambda: contest.next_phase_change,
+		)
+
 	return render(request, "cryptics/show.html", context)
 
 
+def _render_closed_rows(contest):
+	""" Pre-render the parts of each clue's row on a closed contest's page that are the same for everyone
+
+	The explanation's hover-to-reveal class and the like star depend on the viewer, so the template
+	fills those in around these pieces.
+	"""
+	rows = []
+	for sub in contest.submissions_sorted():
+		rows.append({
+			"id": sub.id,
+			"clue": sub.clue,
+			"submitted_by_id": sub.submitted_by_id,
+			"head": format_html(
+				'<td><a name="clue{0}" href="{1}">{0}</a></td>\n<td>{2}</td>', sub.id, sub.get_absolute_url(), sub.clue
+			),
+			"explanation": linebreaksbr(sub.explanation, autoescape=True),
+			"tail": format_html(
+				'<td><a href="{}">{}</a></td>\n<td title="{}">{}</td>',
+				reverse("cryptics:show_user", kwargs={"user_id": sub.submitted_by_id}),
+				sub.submitted_by,
+				", ".join(sub.liker_names),
+				sub.like_count,
+			),
+		})
+	return rows
+
+
+@query_budget(10)
 @login_required
 def delete_submission(request, submission_id):
 	""" Let a user delete a clue that they submitted """
-	submission = get_object_or_404(Submission, id=submission_id)
-	submission.contest.check_if_too_old()
+	submission = get_object_or_404(Submission.objects.select_related("contest"), id=submission_id)
 
 	valid = True
 
@@ -127,11 +233,11 @@ def delete_submission(request, submission_id):
 	return redirect("cryptics:show_contest", submission.contest.id)
 
 
+@query_budget(9)
 @login_required
 def add_like(request, submission_id):
 	""" Let a user like a given clue """
-	submission = get_object_or_404(Submission, id=submission_id)
-	submission.contest.check_if_too_old()
+	submission = get_object_or_404(Submission.objects.select_related("contest"), id=submission_id)
 	if not submission.contest.is_voting:
 		if submission.contest.is_submissions:
 			messages.error(request, "Sorry, this contest is not taking votes yet")
@@ -140,7 +246,7 @@ def add_like(request, submission_id):
 	elif request.user == submission.submitted_by:
 		messages.error(request, "Sorry, you can't vote for your own submissions")
 	else:
-		submission.likers.add(request.user)
+		submission.add_like(request.user)
 
 	if "next" in request.GET:
 		return redirect(request.GET["next"])
@@ -148,13 +254,13 @@ def add_like(request, submission_id):
 	return redirect("cryptics:show_contest", submission.contest.id)
 
 
+@query_budget(8)
 @login_required
 def remove_like(request, submission_id):
 	""" Let a user unlike a given clue """
-	submission = get_object_or_404(Submission, id=submission_id)
-	submission.contest.check_if_too_old()
+	submission = get_object_or_404(Submission.objects.select_related("contest"), id=submission_id)
 	if submission.contest.is_voting:
-		submission.likers.remove(request.user)
+		submission.remove_like(request.user)
 	else:
 		if submission.contest.is_submissions:
 			messages.error(request, "Sorry, this contest is not taking votes yet")
@@ -167,46 +273,185 @@ def remove_like(request, submission_id):
 	return redirect("cryptics:show_contest", submission.contest.id)
 
 
+@query_budget(3)
+@caching.conditional_page(lambda: [caching.version_key(caching.LEADERBOARD)])
+@caching.cache_anonymous_page(lambda: [caching.version_key(caching.LEADERBOARD)])
 def all_users(request):
 	""" Show the list of all users """
-	return render(request, "cryptics/all_users.html", {"users": User.objects.sort_users()})
-
-
+	users = caching.cached(
+		"leaderboard", [caching.version_key(caching.LEADERBOARD)], lambda: list(UserStats.objects.leaderboard())
+	)
+	return render(request, "cryptics/all_users.html", {"users": users})
+
+
+@query_budget(9)
+@caching.conditional_page(
+	lambda user_id: [caching.version_key(caching.USER, user_id)],
+	lambda user_id: Contest.objects.filter(submissions__submitted_by=user_id),
+)
+@caching.cache_anonymous_page(
+	lambda user_id: [caching.version_key(caching.USER, user_id)],
+	expires=lambda user_id: Contest.objects.filter(submissions__submitted_by=user_id).next_phase_change(),
+)
 def show_user(request, user_id):
-	""" Show a specific user's page """
+	""" Show a specific user's page, with a page of their clues (most liked first)
+
+	Other people only see clues for closed contests, which is filtered in the query rather than
+	the template, so a prolific setter's page only ever loads one page of clues.
+	"""
 	user = get_object_or_404(User, id=user_id)
+	form = UserPageForm(request.GET)
+	form.is_valid()  # Both params are optional, and bad values are just ignored
+
+	submissions = Submission.objects.visible_on_profile(user, request.user).select_related("contest")
+	submissions, next_key = submissions.annotate_viewer_liked(request.user).page_by_likes(
+		form.cleaned_data.get("after"), USER_PAGE_SIZE
+	)
 
 	context = {
 		"this_user": user,
-		"highlight": int(request.GET.get("highlight", -1)),
-		}
+		"contests_started": user.contests_started.only("id", "word", "started_by"),
+		"contests_won": user.contests_won.only("id", "word", "winning_user"),
+		"submissions": attach_liker_names(submissions),
+		"next_cursor": encode_cursor(*next_key) if next_key else None,
+		"highlight": form.cleaned_data.get("highlight") or -1,
+	}
 
 	return render(request, "cryptics/user_show.html", context)
 
 
+@query_budget(6)
+@caching.conditional_page(lambda: [caching.version_key(caching.LEADERBOARD)], lambda: Contest.objects.all())
+@caching.cache_anonymous_page(
+	lambda: [caching.version_key(caching.LEADERBOARD)], expires=Contest.objects.next_phase_change
+)
 def all_closed_contests(request):
-	""" Show the complete list of all finished contests
+	""" Show a page of finished contests, oldest first
 
-	In the future, this might need to be paginated
+	Later pages are loaded on demand (by load_more_contests.js, from all_closed_contests_json), or
+	by following the "More" link without JavaScript.
 	"""
-	contests = Contest.objects.filter(status=Contest.CLOSED).order_by("created_at")
-	contests = contests.select_related("started_by", "winning_entry", "winning_user")
-	context = {"contests": contests}
+	form = ArchivePageForm(request.GET)
+	after = form.cleaned_data["after"] if form.is_valid() else None
+	contests, next_cursor = _archive_page(after)
+	context = {"contests": contests, "next_cursor": next_cursor}
 	return render(request, "cryptics/all_closed_contests.html", context)
 
 
+@query_budget(3)
+def all_closed_contests_json(request):
+	""" Return a page of finished contests, with their winners, as JSON
+
+	Takes the optional GET param after, the next cursor from the previous page.
+	"""
+	form = ArchivePageForm(request.GET)
+	if not form.is_valid():
+		return JsonResponse({"errors": form.errors}, status=HTTPStatus.BAD_REQUEST)
+
+	contests, next_cursor = _archive_page(form.cleaned_data["after"])
+	return JsonResponse({"contests": [_describe_closed_contest(contest) for contest in contests], "next": next_cursor})
+
+
+def _archive_page(after):
+	""" A page of closed contests starting after the given (created_at, id) key, and the cursor for the next page """
+	def compute():
+		contests = Contest.objects.with_effective_status(Contest.CLOSED).select_related(
+			"started_by", "winning_entry", "winning_user"
+		)
+		page, next_key = contests.page_after(after, ARCHIVE_PAGE_SIZE)
+		return page, encode_cursor(*next_key) if next_key else None
+
+	return caching.cached(
+		f"archives:{after}",
+		[caching.version_key(caching.LEADERBOARD)],
+		compute,
+		expires=Contest.objects.next_phase_change,
+	)
+
+
+def _describe_closed_contest(contest):
+	def describe_user(user):
+		return {"username": user.username, "url": reverse("cryptics:show_user", kwargs={"user_id": user.id})}
+
+	winner = None
+	if contest.winning_entry:
+		winner = {
+			"user": describe_user(contest.winning_user),
+			"clue": contest.winning_entry.clue,
+			"explanation": contest.winning_entry.explanation,
+		}
+	return {
+		"id": contest.id,
+		"word": contest.word,
+		"url": contest.get_absolute_url(),
+		"started_by": describe_user(contest.started_by),
+		"started_at": contest.created_at.isoformat(),
+		"started_at_display": date_format(timezone.localtime(contest.created_at), "DATETIME_FORMAT"),
+		"winner": winner,
+	}
+
+
+@query_budget(3)
+def contest_autocomplete_json(request):
+	""" Return up to ten contests whose word (or any word in it) starts with a given string
+
+	This is answered from the in-memory ContestWordIndex, so it's cheap enough to call on every
+	keystroke.
+	"""
+	search_data = ContestSearchForm(request.GET)
+	if not search_data.is_valid():
+		return JsonResponse({"errors": search_data.errors}, status=HTTPStatus.BAD_REQUEST)
+
+	contests, more = contest_word_index.lookup(search_data.cleaned_data["search"])
+	return JsonResponse({"contests": contests, "more": more})
+
+
+@query_budget(3)
+def contest_wordplay_json(request, contest_id):
+	""" Return anagrams and sub-anagrams of a contest's word, and words matching a pattern like "?A?E"
+
+	These come from the memory-mapped index in wordplay.py (see the build_wordplay_index command).
+	Each list is cut off at WORDPLAY_RESULT_LIMIT words, with a flag to say if it was.
+	"""
+	contest = get_object_or_404(Contest.objects.only("word"), id=contest_id)
+	form = WordplayForm(request.GET)
+	if not form.is_valid():
+		return JsonResponse({"errors": form.errors}, status=HTTPStatus.BAD_REQUEST)
+
+	index = get_wordplay_index(settings.WORDPLAY_INDEX_PATH)
+	if index is None:
+		return JsonResponse(
+			{"errors": {"__all__": ["The wordplay index hasn't been built yet."]}}, status=HTTPStatus.SERVICE_UNAVAILABLE
+		)
+
+	results = {
+		"anagrams": index.anagrams(contest.word),
+		"subanagrams": index.subanagrams(contest.word),
+	}
+	if form.cleaned_data["pattern"]:
+		results["pattern"] = index.pattern(form.cleaned_data["pattern"])
+
+	data = {"word": contest.word}
+	for name, words in results.items():
+		data[name] = words[:WORDPLAY_RESULT_LIMIT]
+		data[f"more_{name}"] = len(words) > WORDPLAY_RESULT_LIMIT
+	return JsonResponse(data)
+
+
+@query_budget(3)
 def contest_search_json(request):
 	""" Return a list of contests matching a given string
 
-	Currently this endpoint is only used for the "check for repeats" functionality, but could be adapted if the full
-	archives page is switched to be paginated with AJAX
+	Currently this endpoint is only used for the "check for repeats" functionality (the archives page loads its
+	pages from all_closed_contests_json)
 	"""
 	search_data = ContestSearchForm(request.GET)
 	if not search_data.is_valid():
 		return JsonResponse({"errors": search_data.errors}, status=HTTPStatus.BAD_REQUEST)
 
-	contests = Contest.objects.filter(word__icontains=search_data.cleaned_data["search"]).order_by("created_at")
-	if (err_count := contests.count()) >= 10:
+	# Every match carries the total number of matches, so one query gets both the count and the contests
+	contests = Contest.objects.search(search_data.cleaned_data["search"]).only("word")[:10]
+	if contests and (err_count := contests[0].total) >= 10:
 		return JsonResponse(
 			{"errors": {"search": [f"Too many matching contests found ({err_count})."]}},
 			status=HTTPStatus.BAD_REQUEST
@@ -214,3 +459,76 @@ def contest_search_json(request):
 
 	contests = [{"word": contest.word, "url": contest.get_absolute_url()} for contest in contests]
 	return JsonResponse({"contests": contests})
+
+
+def _search_clues(request, form):
+	""" Get the requested page of results for a valid ClueSearchForm """
+	results = SubmissionTerm.objects.search(
+		form.cleaned_data["q"],
+		author=form.cleaned_data["author"],
+		status=form.cleaned_data["status"],
+		viewer=request.user,
+	)
+	page = Paginator(results, CLUE_SEARCH_PAGE_SIZE).get_page(request.GET.get("page"))
+	page.object_list = Submission.objects.select_related("contest", "submitted_by").in_search_order(page.object_list)
+	return page
+
+
+@query_budget(5)
+def search_clues(request):
+	""" Show the clue search form and, if a search was made, a page of results """
+	form = ClueSearchForm(request.GET or None)
+	context = {"form": form, "page": _search_clues(request, form) if form.is_valid() else None}
+	return render(request, "cryptics/clue_search.html", context)
+
+
+@query_budget(5)
+def clue_search_json(request):
+	""" Return a page of clues matching a search, as JSON
+
+	Takes the same GET params as search_clues (q, plus the optional author, status, and page).  As on
+	the contest pages, explanations are left out while a contest is taking submissions, and authors
+	until it's closed.
+	"""
+	form = ClueSearchForm(request.GET)
+	if not form.is_valid():
+		return JsonResponse({"errors": form.errors}, status=HTTPStatus.BAD_REQUEST)
+
+	page = _search_clues(request, form)
+	clues = [
+		{
+			"id": sub.id,
+			"clue": sub.clue,
+			"explanation": None if sub.contest.is_submissions else sub.explanation,
+			"submitted_by": sub.submitted_by.username if sub.contest.is_closed else None,
+			"contest": sub.contest.word,
+			"url": sub.get_absolute_url(),
+			"score": sub.score,
+		}
+		for sub in page
+	]
+	return JsonResponse({
+		"clues": clues,
+		"page": page.number,
+		"num_pages": page.paginator.num_pages,
+		"count": page.paginator.count,
+	})
+
+
+@query_budget(2)
+def prometheus_metrics(request):
+	""" Serve the metrics from every web and Celery worker (see metrics.py) in Prometheus' text format
+
+	Only staff can see them, or a scraper sending "Authorization: Bearer <METRICS_TOKEN>".
+	"""
+	if not settings.METRICS_DIR:
+		raise Http404("Metrics are turned off")
+
+	authorization = request.headers.get("Authorization", "")
+	token = settings.METRICS_TOKEN
+	if not (token and hmac.compare_digest(authorization, f"Bearer {token}")) and not request.user.is_staff:
+		return HttpResponseForbidden()
+
+	return HttpResponse(
+		metrics.render(*metrics.collect()), content_type="text/plain; version=0.0.4; charset=utf-8"
+	)
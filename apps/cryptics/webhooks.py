@@ -0,0 +1,109 @@
+""" A small HTTP client for posting to webhooks (i.e. Discord), shared by everything in a worker process """
+import datetime
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.utils import timezone
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+# (connect, read) timeouts in seconds for every webhook call
+DEFAULT_TIMEOUT = (3.05, 10)
+# The most webhooks that are posted to at the same time (and so the most connections kept open)
+MAX_WORKERS = 4
+
+
+class CircuitOpenError(Exception):
+	""" Raised instead of calling an endpoint that's failed too often recently """
+	def __init__(self, target, retry_at):
+		super().__init__(f"Not calling {target} until {retry_at} after repeated failures")
+		self.target = target
+		self.retry_at = retry_at
+
+
+class CircuitBreaker:
+	""" Keep track of which endpoints are failing, so they can be left alone for a while
+
+	After threshold failures in a row, the circuit for that endpoint "opens" for cooldown, during
+	which calls are refused without touching the network.  The next call after that is let through
+	as a trial, and a success resets the count.
+	"""
+	def __init__(self, threshold=5, cooldown=datetime.timedelta(minutes=5)):
+		self.threshold = threshold
+		self.cooldown = cooldown
+		self._failures = {}
+		self._open_until = {}
+		self._lock = threading.Lock()
+
+	def check(self, target):
+		""" Raise CircuitOpenError if target shouldn't be called right now """
+		with self._lock:
+			open_until = self._open_until.get(target)
+		if open_until and open_until > timezone.now():
+			raise CircuitOpenError(target, open_until)
+
+	def record_success(self, target):
+		with self._lock:
+			self._failures.pop(target, None)
+			self._open_until.pop(target, None)
+
+	def record_failure(self, target):
+		with self._lock:
+			self._failures[target] = self._failures.get(target, 0) + 1
+			if self._failures[target] >= self.threshold:
+				self._open_until[target] = timezone.now() + self.cooldown
+				logger.warning("Opening circuit for %s after %d failures", target, self._failures[target])
+
+
+class WebhookClient:
+	""" Post JSON to webhooks over a pool of keep-alive connections
+
+	Every call has a connect and read timeout, and goes through a CircuitBreaker so that an endpoint
+	that's down isn't hammered (or allowed to hold up everything else) while it's down.
+	"""
+	def __init__(self, timeout=DEFAULT_TIMEOUT, max_workers=MAX_WORKERS, breaker=None):
+		self.timeout = timeout
+		self.max_workers = max_workers
+		self.breaker = breaker or CircuitBreaker()
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=max_workers, pool_maxsize=max_workers)
+		self.session.mount("https://", adapter)
+		self.session.mount("http://", adapter)
+
+	def post(self, url, payload, target=None):
+		""" POST payload to url, returning the requests.Response
+
+		target is the name the circuit breaker knows this endpoint by (the url by default).  Raises
+		CircuitOpenError if it's currently refusing calls, and lets connection errors through to the
+		caller.  Server errors and connection errors count as failures, but a 429 doesn't: that just
+		means Discord wants us to slow down.
+		"""
+		target = target or url
+		self.breaker.check(target)
+		try:
+			response = self.session.post(url, json=payload, timeout=self.timeout)
+		except requests.RequestException:
+			self.breaker.record_failure(target)
+			raise
+
+		if response.status_code >= 500:
+			self.breaker.record_failure(target)
+		else:
+			self.breaker.record_success(target)
+		return response
+
+	def fan_out(self, func, items):
+		""" Call func on each of items concurrently (at most max_workers at a time) and return the results in order
+
+		Typically each item is all the work for one webhook, so a slow or failing server only
+		delays its own messages.
+		"""
+		items = list(items)
+		if len(items) <= 1:
+			return [func(item) for item in items]
+
+		with ThreadPoolExecutor(max_workers=min(len(items), self.max_workers)) as executor:
+			return list(executor.map(func, items))
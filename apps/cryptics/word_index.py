@@ -0,0 +1,109 @@
+""" An in-memory prefix index of contest words, for autocompleting them without a database query """
+import bisect
+import threading
+
+from django.urls import reverse
+from django.utils.text import slugify
+
+from .caching import bump_version, get_version
+from .utils import normalize_word
+
+# Bumped whenever any worker adds, changes, or deletes a contest; a worker whose index was built at
+# an older version rebuilds it on its next lookup
+VERSION_KEY = "cryptics:contest_word_index:version"
+
+
+class ContestWordIndex:
+	""" A sorted list of normalized contest words (see utils.normalize_word), searched with bisect
+
+	A contest can be found by the start of any of the words in it, so "AU LA" finds "CAFE AU LAIT".
+	The index is built on first use, and after that only touches the cache (to check the version
+	stamp) unless another worker has changed the contests since.
+	"""
+	def __init__(self):
+		self._keys = []
+		self._entries = []
+		self._contests = {}
+		self._version = None
+		self._lock = threading.Lock()
+
+	def lookup(self, text, limit=10):
+		""" Return up to limit contests (dictionaries of word and url) starting with text, and whether there are more """
+		prefix = normalize_word(text)
+		if not prefix:
+			return [], False
+
+		self._refresh_if_stale()
+		with self._lock:
+			keys, entries, contests = self._keys, self._entries, self._contests
+		found = []
+		for i in range(bisect.bisect_left(keys, prefix), len(keys)):
+			if not keys[i].startswith(prefix):
+				break
+			contest = contests[entries[i][1]]
+			if contest not in found:
+				if len(found) == limit:
+					return found, True
+				found.append(contest)
+		return found, False
+
+	def add(self, contest):
+		""" Add a newly created contest to this worker's index, and tell the other workers to rebuild theirs """
+		version = bump_version(VERSION_KEY)
+		with self._lock:
+			if self._version is None:
+				return
+			if version != self._version + 1:
+				# Something else changed too, so this index can't be brought up to date on its own
+				self._version = None
+				return
+			keys, entries = list(self._keys), list(self._entries)
+			for key in _keys_for(contest.search_word):
+				i = bisect.bisect(entries, (key, contest.id))
+				keys.insert(i, key)
+				entries.insert(i, (key, contest.id))
+			self._contests = {**self._contests, contest.id: _describe(contest.id, contest.word)}
+			self._keys, self._entries, self._version = keys, entries, version
+
+	@staticmethod
+	def invalidate():
+		""" Make every worker rebuild its index on its next lookup (after a contest is changed or deleted) """
+		bump_version(VERSION_KEY)
+
+	def _refresh_if_stale(self):
+		version = get_version(VERSION_KEY)
+		if version == self._version:
+			return
+
+		from .models import Contest  # Imported here to avoid a circular import
+		contests = {}
+		entries = []
+		for contest_id, word, search_word in Contest.objects.values_list("id", "word", "search_word").iterator():
+			contests[contest_id] = _describe(contest_id, word)
+			entries.extend((key, contest_id) for key in _keys_for(search_word))
+		entries.sort()
+
+		with self._lock:
+			self._keys = [key for key, _ in entries]
+			self._entries = entries
+			self._contests = contests
+			# The version was read before the contests were, so anything added while this index was
+			# being built will bump it again and cause another rebuild
+			self._version = version
+
+
+def _keys_for(search_word):
+	""" Each contest is indexed once for each word in it, e.g. "CAFE AU LAIT", "AU LAIT", and "LAIT" """
+	words = search_word.split(" ")
+	return {" ".join(words[i:]) for i in range(len(words)) if words[i]}
+
+
+def _describe(contest_id, word):
+	""" What lookup returns for each contest (the same as Contest.get_absolute_url, without a Contest) """
+	return {
+		"word": word,
+		"url": reverse("cryptics:show_contest_full", kwargs={"contest_id": contest_id, "word": slugify(word)}),
+	}
+
+
+contest_word_index = ContestWordIndex()
@@ -0,0 +1,214 @@
+""" Anagram, sub-anagram, and letter-pattern lookups for clue setters
+
+The word list lives in an index file built by build_index (see the build_wordplay_index command),
+which each worker memory-maps rather than loading, so the operating system shares one copy of it
+between every process and nothing is turned into Python objects until it's returned.  The file is:
+
+* A header: a magic string and the number of words, n
+* masks: n uint32s, a bitmask of the letters each word uses (bit 0 for A, and so on), ascending
+* offsets: n + 1 uint32s, where each word starts in the text (and where the text ends)
+* by_length: n uint32s, the words' positions ordered by length and then alphabetically
+* The words themselves, as ASCII capitals with nothing between them
+
+The words are sorted by (mask, sorted letters, word), so a word's anagrams are all in the run of
+words with the same mask, and its sub-anagrams are in the runs for the masks that are subsets of
+its own.
+"""
+import array
+import bisect
+import mmap
+import os
+import re
+import struct
+import sys
+import tempfile
+from collections import Counter
+
+from django.conf import settings
+
+from .models import Contest
+from .utils import normalize_word
+
+MAGIC = b"CCWORDS1"
+HEADER = struct.Struct("<8sI")
+MAX_WORD_LENGTH = 30
+# Beyond this many distinct letters, there are too many subsets to look each one up, and it's
+# quicker just to check every word's mask
+MAX_SUBSET_LETTERS = 14
+
+
+def letters_of(text):
+	""" The letters of a word or phrase, as they're indexed: "Café au lait (4,2,4)" becomes "CAFEAULAIT" """
+	return re.sub(r"[^A-Z]", "", normalize_word(text))
+
+
+def letter_mask(letters):
+	mask = 0
+	for letter in letters:
+		mask |= 1 << (ord(letter) - ord("A"))
+	return mask
+
+
+def _signature(letters):
+	return "".join(sorted(letters))
+
+
+def build_index(words, path):
+	""" Write the index file for words (any iterable of strings) to path, returning the number of words
+
+	The new file replaces any old one in a single rename, so workers never see a half-written index.
+	"""
+	words = {letters_of(word) for word in words}
+	words = sorted(
+		(word for word in words if 1 < len(word) <= MAX_WORD_LENGTH),
+		key=lambda word: (letter_mask(word), _signature(word), word),
+	)
+
+	text = "".join(words).encode("ascii")
+	offsets = [0]
+	for word in words:
+		offsets.append(offsets[-1] + len(word))
+	by_length = sorted(range(len(words)), key=lambda i: (len(words[i]), words[i]))
+
+	directory = os.path.dirname(os.path.abspath(path))
+	os.makedirs(directory, exist_ok=True)
+	with tempfile.NamedTemporaryFile(dir=directory, delete=False) as f:
+		f.write(HEADER.pack(MAGIC, len(words)))
+		for values in ([letter_mask(word) for word in words], offsets, by_length):
+			f.write(struct.pack(f"<{len(values)}I", *values))
+		f.write(text)
+	# NamedTemporaryFile is only readable by its owner, and Celery may run as a different user from the web workers
+	os.chmod(f.name, 0o644)
+	os.replace(f.name, path)
+	return len(words)
+
+
+def rebuild_wordplay_index(word_list=None):
+	""" Rebuild the index at settings.WORDPLAY_INDEX_PATH, returning the number of words in it
+
+	The words come from word_list (a text file with one word or phrase per line, defaulting to
+	settings.WORDPLAY_WORD_LIST) plus every contest's word.
+	"""
+	word_list = word_list or settings.WORDPLAY_WORD_LIST
+	words = []
+	if word_list:
+		with open(word_list, encoding="utf-8") as f:
+			words = [line.strip() for line in f if line.strip()]
+	words.extend(Contest.objects.values_list("search_word", flat=True).iterator())
+	return build_index(words, settings.WORDPLAY_INDEX_PATH)
+
+
+class WordplayIndex:
+	""" Lookups against a memory-mapped index file written by build_index """
+	def __init__(self, path):
+		with open(path, "rb") as f:
+			self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+		magic, count = HEADER.unpack_from(self._mmap)
+		if magic != MAGIC:
+			raise ValueError(f"{path} isn't a wordplay index")
+
+		start = HEADER.size
+		self._masks = self._uint32s(start, count)
+		start += 4 * count
+		self._offsets = self._uint32s(start, count + 1)
+		start += 4 * (count + 1)
+		self._by_length = self._uint32s(start, count)
+		self._text_start = start + 4 * count
+
+	def _uint32s(self, start, count):
+		""" count of the file's little-endian uint32s, read in place where the machine is little-endian too """
+		values = memoryview(self._mmap)[start:start + 4 * count].cast("I")
+		if sys.byteorder == "big":
+			values = array.array("I", values)
+			values.byteswap()
+		return values
+
+	def __len__(self):
+		return len(self._masks)
+
+	def _word(self, i):
+		start = self._text_start
+		return self._mmap[start + self._offsets[i]:start + self._offsets[i + 1]].decode("ascii")
+
+	def _mask_range(self, mask):
+		return range(bisect.bisect_left(self._masks, mask), bisect.bisect_right(self._masks, mask))
+
+	def anagrams(self, text):
+		""" Words made of exactly the letters of text (other than text itself) """
+		letters = letters_of(text)
+		signature = _signature(letters)
+		words = (self._word(i) for i in self._mask_range(letter_mask(letters)))
+		return sorted(word for word in words if _signature(word) == signature and word != letters)
+
+	def subanagrams(self, text, min_length=3):
+		""" Words of at least min_length that can be made from some of the letters of text, longest first """
+		letters = letters_of(text)
+		available = Counter(letters)
+		mask = letter_mask(letters)
+
+		if len(available) > MAX_SUBSET_LETTERS:
+			candidates = (i for i, word_mask in enumerate(self._masks) if word_mask & ~mask == 0)
+		else:
+			candidates = (i for subset in _subsets(mask) for i in self._mask_range(subset))
+
+		found = []
+		for i in candidates:
+			if self._offsets[i + 1] - self._offsets[i] < min_length:
+				continue
+			word = self._word(i)
+			if word != letters and Counter(word) <= available:
+				found.append(word)
+		return sorted(found, key=lambda word: (-len(word), word))
+
+	def pattern(self, pattern):
+		""" Words matching a pattern like "?A?E", where ? (or . or _) stands for any one letter """
+		pattern = pattern.upper()
+		if not re.fullmatch(r"[A-Z?._]+", pattern):
+			return []
+
+		def length(i):
+			return self._offsets[i + 1] - self._offsets[i]
+
+		regex = re.compile(re.sub(r"[?._]", ".", pattern))
+		start = bisect.bisect_left(self._by_length, len(pattern), key=length)
+		end = bisect.bisect_right(self._by_length, len(pattern), key=length)
+		words = (self._word(self._by_length[i]) for i in range(start, end))
+		return [word for word in words if regex.fullmatch(word)]
+
+	def close(self):
+		for values in (self._masks, self._offsets, self._by_length):
+			if isinstance(values, memoryview):
+				values.release()
+		self._mmap.close()
+
+
+def _subsets(mask):
+	""" Every non-empty subset of the bits in mask """
+	subset = mask
+	while subset:
+		yield subset
+		subset = (subset - 1) & mask
+
+
+_index = None
+_index_stat = None
+
+
+def get_wordplay_index(path):
+	""" The WordplayIndex for path, opened once per process and reopened if the file is rebuilt
+
+	Returns None if the index hasn't been built.
+	"""
+	global _index, _index_stat  # pylint: disable=global-statement
+	try:
+		stat = os.stat(path)
+	except FileNotFoundError:
+		return None
+
+	stat = (path, stat.st_ino, stat.st_mtime_ns, stat.st_size)
+	if stat != _index_stat:
+		# The old index isn't closed, as another thread might still be reading it; it's unmapped
+		# once nothing refers to it
+		_index, _index_stat = WordplayIndex(path), stat
+	return _index
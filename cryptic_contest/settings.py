@@ -44,7 +44,10 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+	"apps.cryptics.metrics.MetricsMiddleware",
 	"django.middleware.security.SecurityMiddleware",
+	"apps.cryptics.query_budget.QueryBudgetMiddleware",
+	"apps.cryptics.query_log.QueryLogMiddleware",
 	"django.contrib.sessions.middleware.SessionMiddleware",
 	"django.middleware.common.CommonMiddleware",
 	"django.middleware.csrf.CsrfViewMiddleware",
@@ -52,6 +55,7 @@ MIDDLEWARE = [
 	"django.contrib.messages.middleware.MessageMiddleware",
 	"django.middleware.clickjacking.XFrameOptionsMiddleware",
 	"allauth.account.middleware.AccountMiddleware",
+	"apps.cryptics.profiling.ProfilingMiddleware",
 ]
 
 ROOT_URLCONF = "cryptic_contest.urls"
@@ -109,6 +113,52 @@ DATABASES = {
 
 DEFAULT_AUTO_FIELD = "django.db.models.AutoField"
 
+# Cache
+# The contest word autocomplete index lives in each worker's memory and uses the cache to tell
+# workers when it's out of date, so in production this should be shared between workers (the
+# file-based cache is enough if they're all on one machine)
+
+CACHE_BACKEND = config("CACHE_BACKEND", default="django.core.cache.backends.locmem.LocMemCache")
+CACHES = {
+	"default": {
+		"BACKEND": CACHE_BACKEND,
+		"LOCATION": config("CACHE_LOCATION", default=""),
+	}
+}
+# The longest (in seconds) that pages and querysets are cached for (see apps/cryptics/caching.py); they're
+# usually replaced sooner, as soon as anything they show changes.  0 turns the cache off, which is the
+# default with the locmem backend: each worker would have its own copy, and only the worker that made a
+# change would see it.
+VIEW_CACHE_TIMEOUT = config(
+	"VIEW_CACHE_TIMEOUT", default=0 if CACHE_BACKEND.endswith(".LocMemCache") else 300, cast=int
+)
+
+# What to do when a request runs more SQL queries than its view's budget (see apps/cryptics/query_budget.py):
+# "raise", "log", or "off"
+QUERY_BUDGET_MODE = config("QUERY_BUDGET_MODE", default="log" if DEBUG else "off")
+
+# Request profiling (see apps/cryptics/profiling.py): the fraction of requests to profile, and a header
+# that staff users can send to have a particular request profiled.  Both are off by default.
+PROFILE_SAMPLE_RATE = config("PROFILE_SAMPLE_RATE", default=0.0, cast=float)
+PROFILE_HEADER = config("PROFILE_HEADER", default="")
+PROFILE_DIR = config("PROFILE_DIR", default=os.path.join(BASE_DIR, "data", "profiles"))
+# Only the newest this many profiles are kept
+PROFILE_KEEP = config("PROFILE_KEEP", default=500, cast=int)
+
+# Metrics (see apps/cryptics/metrics.py) are collected by every web and Celery worker into this
+# directory, which they all need to be able to write to, and served at /metrics.  Blank turns them off.
+METRICS_DIR = config("METRICS_DIR", default="")
+# Scrapers can send this as "Authorization: Bearer <token>" instead of logging in as staff
+METRICS_TOKEN = config("METRICS_TOKEN", default="")
+# How often (in seconds) each worker writes out its metrics
+METRICS_FLUSH_INTERVAL = config("METRICS_FLUSH_INTERVAL", default=5, cast=int)
+
+# Every SQL query is logged by fingerprint (see apps/cryptics/query_log.py) to files in this directory,
+# for `manage.py query_report`; blank turns the query log off
+QUERY_LOG_DIR = config("QUERY_LOG_DIR", default="")
+# SELECTs that take longer than this (in milliseconds) are logged with their EXPLAIN output
+QUERY_LOG_SLOW_MS = config("QUERY_LOG_SLOW_MS", default=100, cast=float)
+
 
 # Password validation
 # https://docs.djangoproject.com/en/2.0/ref/settings/#auth-password-validators
@@ -192,10 +242,39 @@ LOGGING = {
 # Will cause problems if I ever try to unittest that messages are actually logged
 if "test" in sys.argv:
 	LOGGING["loggers"][""]["level"] = "CRITICAL"
+	# The cache outlives each test's database, so it's off unless a test turns it on (and clears it)
+	VIEW_CACHE_TIMEOUT = 0
+	QUERY_BUDGET_MODE = "raise"
 
-# URLs for Discord webhooks
-DISCORD_URL = config("DISCORD_URL", default=None)
+# URLs for Discord webhooks (a comma-separated list, to post to more than one server)
+DISCORD_URLS = config("DISCORD_URL", default="", cast=Csv())
+DISCORD_API_URL = config("DISCORD_API_URL", default="https://discordapp.com/api/webhooks/")
 DISCORD_CRYPTIC_CONTEST_ROLE_ID = config("DISCORD_CRYPTIC_CONTEST_ROLE_ID", default=None)
+# How long (in seconds) to collect new submission notifications for a contest before posting them
+# as a single message
+DISCORD_DIGEST_WINDOW = config("DISCORD_DIGEST_WINDOW", default=60, cast=int)
+
+# The anagram and letter-pattern helper's index (see apps/cryptics/wordplay.py) is built from this
+# word list, one word or phrase per line, plus every contest's word
+WORDPLAY_WORD_LIST = config("WORDPLAY_WORD_LIST", default=None)
+WORDPLAY_INDEX_PATH = config("WORDPLAY_INDEX_PATH", default=os.path.join(BASE_DIR, "data", "wordplay.idx"))
 
 # Celery settings
 CELERY_BROKER_URL = config("CELERY_BROKER_URL")
+
+# Contests are moved between phases by a single periodic sweep rather than one ETA task per contest
+# (pages already show the right phase in between sweeps, see Contest.effective_status)
+CELERY_BEAT_SCHEDULE = {
+	"sweep-contests": {
+		"task": "sweep_contests",
+		"schedule": config("CONTEST_SWEEP_INTERVAL", default=60, cast=int),
+	},
+	"deliver-discord-messages": {
+		"task": "deliver_discord_messages",
+		"schedule": 30,
+	},
+	"rebuild-wordplay-index": {
+		"task": "rebuild_wordplay_index",
+		"schedule": 24 * 60 * 60,
+	},
+}